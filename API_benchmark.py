@@ -0,0 +1,374 @@
+# -*- coding: utf-8 -*-
+# Load test of the wind REST API
+#
+# Generates a database of synthetic readings, starts the API on it with the
+# production runner (wind/runner.py) and sends requests to every route of
+# wind/resourcess.py at the given concurrency. The latency percentiles and
+# the throughput of every request are written as JSON.
+#
+# In the project root folder:
+#
+#   python API_benchmark.py --devices 2 --years 1 --concurrency 8 --output results.json
+#
+# or against a server that is already running on a database created with the
+# same --devices and --years (e.g. on Windows, where the runner is not available):
+#
+#   python API_benchmark.py --url http://localhost:5000 --db db/benchmark.db
+
+import argparse, http.client, json, os, platform, random, signal, socket, sqlite3, subprocess, sys, tempfile, \
+    threading, time
+from shutil import rmtree
+from string import Template
+from urllib.parse import urlsplit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'wind'))
+import dbhandler
+
+WIND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'wind')
+
+# Requests sent to each endpoint of resourcess.py: endpoint -> list of
+# (method, query string, body). $id, $timestamp, $start, $end and $quantity
+# are replaced by a random device, timestamp, one day range and collection
+# for every request. Endpoints missing here get a plain GET
+REQUESTS = {
+    'devices': [('GET', '', None)],
+    'device': [('GET', '', None)],
+    'speeds': [('GET', 'limit=100', None), ('GET', 'start=$start&end=$end', None),
+               ('GET', 'start=$start&end=$end&stream=true', None), ('GET', 'points=500', None)],
+    'batteries': [('GET', 'limit=100', None)],
+    'directions': [('GET', 'limit=100', None)],
+    'temperatures': [('GET', 'start=$start&end=$end&format=columns', None)],
+    'humidities': [('GET', 'limit=100', None)],
+    'aggregate': [('GET', 'bucket=1h&start=$start&end=$end', None), ('GET', 'bucket=1d', None)],
+    'export': [('GET', 'format=npz&start=$start&end=$end', None)],
+    'series': [('GET', 'fields=speed,direction,temperature&start=$start&end=$end', None),
+               ('GET', 'fields=speed,temperature&points=500&format=columns', None)],
+    'data': [('PATCH', '', '[{"timestamp": $timestamp, "field": "humidity", "value": 80}]'),
+             ('POST', '', '[{"timestamp": $timestamp, "speed": 5.5, "direction": 120.0, "temperature": 100}]')],
+    'cache': [('GET', '', None)],
+    'speed': [('GET', '', None)],
+    'temperature': [('GET', '', None), ('PUT', '', '{"temperature": 101}')],
+    'humidity': [('GET', '', None), ('PUT', '', '{"humidity": 81}')],
+    'direction': [('GET', '', None)],
+    'battery': [('GET', '', None)],
+}
+
+# Collections used for $quantity
+COLLECTIONS = ('speeds', 'batteries', 'directions', 'temperatures', 'humidities')
+
+# Endpoints of the app that are not part of the API. /_metrics is only
+# served in admin mode (runner.py --metrics), otherwise it answers 404
+SKIPPED_ENDPOINTS = ('static', 'metrics')
+
+# Seconds to wait for the server to answer after it was started
+STARTUP_TIMEOUT = 30
+
+
+def get_routes():
+    '''
+    :return: list of (endpoint, rule, methods) of the routes registered in resourcess.py
+    '''
+    cwd = os.getcwd()
+    #the default database path of resourcess is relative to the wind folder
+    os.chdir(WIND_DIR)
+    try:
+        import resourcess
+    finally:
+        os.chdir(cwd)
+    routes = []
+    for rule in resourcess.app.url_map.iter_rules():
+        if rule.endpoint not in SKIPPED_ENDPOINTS:
+            routes.append((rule.endpoint, rule.rule, rule.methods - {'HEAD', 'OPTIONS'}))
+    return sorted(routes)
+
+
+def get_requests(routes, read_only=False):
+    '''
+    :return: list of (endpoint, method, path template, query template, body template)
+    '''
+    requests = []
+    for endpoint, rule, methods in routes:
+        path = rule.replace('<', '${').replace('>', '}')
+        for method, query, body in REQUESTS.get(endpoint, [('GET', '', None)]):
+            if method not in methods:
+                raise ValueError("Route %s has no method %s" % (rule, method))
+            if read_only and method != 'GET':
+                continue
+            requests.append((endpoint, method, path, query, body))
+    return requests
+
+
+def percentile(values, p):
+    '''
+    :param values: sorted list
+    :return: the nearest-rank percentile p (0-100) of the values
+    '''
+    if not values:
+        return None
+    rank = max(int(-(-p * len(values) // 100)), 1)
+    return values[rank - 1]
+
+
+class LoadGenerator(object):
+    '''
+    Sends requests to the server from concurrency threads, each with its own
+    keep-alive connection, and records the latency of every request.
+
+    :param url: base url of the server
+    :param options: parsed command line options
+    '''
+
+    def __init__(self, url, options):
+        super(LoadGenerator, self).__init__()
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.options = options
+        count = int(options.years * 365 * 86400 / options.interval)
+        self.timestamps = (dbhandler.SYNTHETIC_START, dbhandler.SYNTHETIC_START + (count - 1) * options.interval)
+
+    def get_values(self, rng):
+        '''
+        :return: random values of the placeholders of REQUESTS
+        '''
+        start = rng.randrange(self.timestamps[0], max(self.timestamps[1] - 86400, self.timestamps[0]) + 1,
+                              self.options.interval)
+        return {'id': rng.randint(1, self.options.devices),
+                'timestamp': rng.randrange(self.timestamps[0], self.timestamps[1] + 1, self.options.interval),
+                'start': start, 'end': start + 86400, 'quantity': rng.choice(COLLECTIONS)}
+
+    def run(self, endpoint, method, path, query, body):
+        '''
+        Sends warmup and then options.requests requests.
+
+        :return: dict of the results
+        '''
+        self.send(method, path, query, body, self.options.warmup, random.Random(self.options.seed))
+        started = time.perf_counter()
+        latencies, statuses, failures = self.send(method, path, query, body, self.options.requests,
+                                                random.Random(self.options.seed + 1))
+        elapsed = time.perf_counter() - started
+
+        latencies.sort()
+        #all the requests are valid on the synthetic database
+        errors = failures + sum(count for status, count in statuses.items() if status >= 400)
+        result = {'endpoint': endpoint, 'method': method, 'path': path, 'query': query,
+                  'requests': len(latencies) + failures, 'errors': errors,
+                  'statuses': dict((str(k), v) for k, v in sorted(statuses.items())),
+                  'seconds': round(elapsed, 3),
+                  'requests_per_second': round(len(latencies) / elapsed, 1) if elapsed else None,
+                  'latency_ms': self.summary(latencies)}
+        return result
+
+    def summary(self, latencies):
+        if not latencies:
+            return None
+        return {'min': round(latencies[0] * 1000, 3),
+                'mean': round(sum(latencies) * 1000 / len(latencies), 3),
+                'p50': round(percentile(latencies, 50) * 1000, 3),
+                'p95': round(percentile(latencies, 95) * 1000, 3),
+                'p99': round(percentile(latencies, 99) * 1000, 3),
+                'max': round(latencies[-1] * 1000, 3)}
+
+    def send(self, method, path, query, body, count, rng):
+        '''
+        :return: (latencies in seconds, status -> count, number of requests without response)
+        '''
+        #the requests are prepared first so the threads only send them
+        requests = []
+        for i in range(count):
+            values = self.get_values(rng)
+            url = Template(path).substitute(values) + ('?' + Template(query).substitute(values) if query else '')
+            data = Template(body).substitute(values).encode('utf-8') if body is not None else None
+            requests.append((url, data))
+
+        lock = threading.Lock()
+        latencies = []
+        statuses = {}
+        failures = [0]
+        pending = iter(requests)
+
+        def worker():
+            connection = http.client.HTTPConnection(self.host, self.port, timeout=self.options.timeout)
+            headers = {'Accept': 'application/hal+json', 'Content-Type': 'application/json'}
+            try:
+                while True:
+                    with lock:
+                        request = next(pending, None)
+                    if request is None:
+                        return
+                    url, data = request
+                    started = time.perf_counter()
+                    try:
+                        connection.request(method, url, body=data, headers=headers)
+                        response = connection.getresponse()
+                        response.read()
+                    except (OSError, http.client.HTTPException):
+                        connection.close()
+                        with lock:
+                            failures[0] += 1
+                        continue
+                    latency = time.perf_counter() - started
+                    with lock:
+                        latencies.append(latency)
+                        statuses[response.status] = statuses.get(response.status, 0) + 1
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=worker) for i in range(self.options.concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return latencies, statuses, failures[0]
+
+
+def create_database(options):
+    '''
+    :return: (path of the database, temporary folder to remove or None)
+    '''
+    if options.db and os.path.exists(options.db):
+        return options.db, None
+    folder = None
+    path = options.db
+    if path is None:
+        folder = tempfile.mkdtemp(prefix='wind-benchmark-')
+        path = os.path.join(folder, 'benchmark.db')
+    print("Generating %d devices x %s years of readings..." % (options.devices, options.years), file=sys.stderr)
+    started = time.time()
+    engine = dbhandler.Engine(path, profile='performance')
+    rows = engine.populate_synthetic(options.devices, options.years, options.interval, seed=options.seed)
+    print("%d readings in %.1f s" % (rows, time.time() - started), file=sys.stderr)
+    return path, folder
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(db_path, options):
+    '''
+    Starts wind/runner.py on the database.
+
+    :return: (the server process, its url)
+    '''
+    if not hasattr(os, 'fork'):
+        sys.exit("The runner needs os.fork (Linux or macOS), start the server yourself and use --url")
+    port = free_port()
+    command = [sys.executable, 'runner.py', '--port', str(port), '--db', os.path.abspath(db_path),
+               '--workers', str(options.workers), '--max-requests', '0']
+    server = subprocess.Popen(command, cwd=WIND_DIR, stdout=subprocess.DEVNULL,
+                              stderr=None if options.verbose else subprocess.DEVNULL)
+    url = 'http://127.0.0.1:%d' % port
+    deadline = time.time() + STARTUP_TIMEOUT
+    while True:
+        try:
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
+            connection.request('GET', '/wind/api/devices/')
+            connection.getresponse().read()
+            connection.close()
+            return server, url
+        except OSError:
+            if server.poll() is not None or time.time() > deadline:
+                server.kill()
+                sys.exit("The server did not start")
+            time.sleep(0.2)
+
+
+def stop_server(server):
+    server.send_signal(signal.SIGTERM)
+    try:
+        server.wait(STARTUP_TIMEOUT)
+    except subprocess.TimeoutExpired:
+        server.kill()
+
+
+def get_json(url, path):
+    parts = urlsplit(url)
+    connection = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=10)
+    try:
+        connection.request('GET', path)
+        return json.loads(connection.getresponse().read().decode('utf-8'))
+    except (OSError, ValueError):
+        return None
+    finally:
+        connection.close()
+
+
+def parse_options(args=None):
+    parser = argparse.ArgumentParser(description="Measures the latency and throughput of every route of the wind API")
+    parser.add_argument('--devices', type=int, default=2, help="number of synthetic devices")
+    parser.add_argument('--years', type=float, default=1, help="years of readings per device")
+    parser.add_argument('--interval', type=int, default=dbhandler.SYNTHETIC_INTERVAL,
+                        help="seconds between the readings")
+    parser.add_argument('--seed', type=int, default=0, help="seed of the data and of the requests")
+    parser.add_argument('--db', default=None,
+                        help="database file, generated if it does not exist. A temporary one by default")
+    parser.add_argument('--url', default=None, help="url of a running server, otherwise one is started")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help="worker processes of the server")
+    parser.add_argument('--concurrency', type=int, default=8, help="requests sent at the same time")
+    parser.add_argument('--requests', type=int, default=200, help="measured requests per route")
+    parser.add_argument('--warmup', type=int, default=20, help="requests per route before measuring")
+    parser.add_argument('--timeout', type=float, default=60, help="seconds to wait for a response")
+    parser.add_argument('--endpoint', action='append', default=None,
+                        help="only measure this endpoint, can be repeated")
+    parser.add_argument('--read-only', action='store_true', help="do not send PUT, POST or PATCH requests")
+    parser.add_argument('--output', default=None, help="file of the JSON results, standard output by default")
+    parser.add_argument('--verbose', action='store_true', help="show the log of the server")
+    options = parser.parse_args(args)
+    if options.devices < 1 or options.concurrency < 1 or options.requests < 1:
+        parser.error("--devices, --concurrency and --requests must be at least 1")
+    return options
+
+
+def main(options):
+    requests = get_requests(get_routes(), options.read_only)
+    if options.endpoint:
+        requests = [r for r in requests if r[0] in options.endpoint]
+
+    db_path, folder = create_database(options)
+    server = None
+    try:
+        if options.url:
+            url = options.url
+        else:
+            server, url = start_server(db_path, options)
+
+        generator = LoadGenerator(url, options)
+        results = []
+        for request in requests:
+            result = generator.run(*request)
+            print("%-7s %-50s %8s req/s  p50 %8s ms  p99 %8s ms" % (
+                request[1], request[2] + ('?' + request[3] if request[3] else ''), result['requests_per_second'],
+                result['latency_ms'] and result['latency_ms']['p50'],
+                result['latency_ms'] and result['latency_ms']['p99']), file=sys.stderr)
+            results.append(result)
+        cache = get_json(url, '/wind/api/_cache')
+    finally:
+        if server is not None:
+            stop_server(server)
+        if folder is not None:
+            rmtree(folder, ignore_errors=True)
+
+    config = dict(vars(options))
+    config.update({'python': platform.python_version(), 'sqlite': sqlite3.sqlite_version,
+                   'platform': platform.platform(), 'cpus': os.cpu_count(), 'time': int(time.time())})
+    if cache is not None:
+        cache.pop('_links', None)
+    report = {'config': config, 'results': results, 'response_cache': cache}
+
+    dump = json.dumps(report, indent=2)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(dump + '\n')
+    else:
+        print(dump)
+    return report
+
+
+if __name__ == '__main__':
+    report = main(parse_options())
+    if any(result['errors'] for result in report['results']):
+        sys.exit(1)
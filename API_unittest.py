@@ -0,0 +1,948 @@
+# -*- coding: utf-8 -*-
+# Tests of the wind API, run against a copy of the test database with the
+# flask test client. The test will run from root folder with command:
+#
+#   python API_unittest.py
+
+import ast, asyncio, gzip, http.client, io, json, os, pstats, re, signal, socket, struct, subprocess, sys, tempfile, time, \
+    unittest, zipfile
+from shutil import copy2, rmtree
+from string import Template
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'wind'))
+
+import API_benchmark
+import asgi
+import cache
+import export
+import profiler
+import resourcess
+
+app = resourcess.app
+
+# PARAMS
+ID = 1
+ROWCOUNT = 145
+SPEEDS_URL = '/wind/api/device/1/speeds/'
+WIND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'wind')
+
+
+class ApiTestCase(unittest.TestCase):
+    '''
+    Serves the API from a copy of the test database with empty caches
+    '''
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.tmpdir, 'PWP_DATA.db')
+        copy2('db/PWP_DATA_restore.db', self.db_path)
+        self.config = dict(app.config)
+        app.config.update({"Engine": resourcess.create_engine(self.db_path),
+                           "RESPONSE_CACHE": cache.ResponseCache(),
+                           "COMPRESSED_CACHE": cache.ResponseCache()})
+        self.client = app.test_client()
+
+    def tearDown(self):
+        app.config["Engine"].dispose()
+        app.config.clear()
+        app.config.update(self.config)
+        rmtree(self.tmpdir)
+
+
+class ResponseCacheTests(unittest.TestCase):
+    '''
+    Tests for the LRU cache of the response bodies
+    '''
+
+    def test_get_put(self):
+        print('('+self.test_get_put.__name__+')', \
+              self.test_get_put.__doc__)
+
+        response_cache = cache.ResponseCache()
+        self.assertIsNone(response_cache.get(('a',), 1))
+        response_cache.put(('a',), '1', 1, b'body', 200, [('ETag', 'x')])
+        self.assertEqual(response_cache.get(('a',), 1), (b'body', 200, [('ETag', 'x')]))
+        stats = response_cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['entries'], stats['bytes']), (1, 1, 1, 4))
+
+    def test_lru_entries(self):
+        '''
+        The least recently used entry is evicted first
+        '''
+        print('('+self.test_lru_entries.__name__+')', \
+              self.test_lru_entries.__doc__)
+
+        response_cache = cache.ResponseCache(max_entries=2)
+        response_cache.put(('a',), '1', 1, b'a', 200, [])
+        response_cache.put(('b',), '1', 1, b'b', 200, [])
+        self.assertIsNotNone(response_cache.get(('a',), 1))
+        response_cache.put(('c',), '1', 1, b'c', 200, [])
+        self.assertIsNone(response_cache.get(('b',), 1))
+        self.assertIsNotNone(response_cache.get(('a',), 1))
+        self.assertIsNotNone(response_cache.get(('c',), 1))
+        self.assertEqual(response_cache.stats()['evictions'], 1)
+
+    def test_max_bytes(self):
+        print('('+self.test_max_bytes.__name__+')', \
+              self.test_max_bytes.__doc__)
+
+        response_cache = cache.ResponseCache(max_bytes=10)
+        response_cache.put(('a',), '1', 1, b'12345', 200, [])
+        response_cache.put(('b',), '1', 1, b'12345', 200, [])
+        self.assertEqual(response_cache.stats()['bytes'], 10)
+        response_cache.put(('c',), '1', 1, b'123', 200, [])
+        self.assertIsNone(response_cache.get(('a',), 1))
+        self.assertEqual(response_cache.stats()['bytes'], 8)
+        #too large to be kept at all
+        response_cache.put(('d',), '1', 1, b'12345678901', 200, [])
+        self.assertIsNone(response_cache.get(('d',), 1))
+        self.assertIsNotNone(response_cache.get(('b',), 1))
+
+    def test_ttl(self):
+        print('('+self.test_ttl.__name__+')', \
+              self.test_ttl.__doc__)
+
+        response_cache = cache.ResponseCache(ttl=0.05)
+        response_cache.put(('a',), '1', 1, b'a', 200, [])
+        self.assertIsNotNone(response_cache.get(('a',), 1))
+        time.sleep(0.1)
+        self.assertIsNone(response_cache.get(('a',), 1))
+        self.assertEqual(response_cache.stats()['entries'], 0)
+
+    def test_version(self):
+        '''
+        An entry of an older data version is dropped
+        '''
+        print('('+self.test_version.__name__+')', \
+              self.test_version.__doc__)
+
+        response_cache = cache.ResponseCache()
+        response_cache.put(('a',), '1', 1, b'a', 200, [])
+        self.assertIsNone(response_cache.get(('a',), 2))
+        self.assertIsNone(response_cache.get(('a',), 1))
+
+    def test_invalidate_device(self):
+        print('('+self.test_invalidate_device.__name__+')', \
+              self.test_invalidate_device.__doc__)
+
+        response_cache = cache.ResponseCache()
+        response_cache.put(('a',), '1', 1, b'a', 200, [])
+        response_cache.put(('b',), '1', 1, b'b', 200, [])
+        response_cache.put(('c',), '2', 1, b'c', 200, [])
+        response_cache.invalidate_device('1')
+        self.assertIsNone(response_cache.get(('a',), 1))
+        self.assertIsNone(response_cache.get(('b',), 1))
+        self.assertIsNotNone(response_cache.get(('c',), 1))
+        self.assertEqual(response_cache.stats()['invalidations'], 2)
+
+
+class ApiResponseCacheTests(ApiTestCase):
+    '''
+    Tests for serving the GET requests from the response cache
+    '''
+
+    def get(self, url, **kwargs):
+        response = self.client.get(url, **kwargs)
+        cached = 'cache;desc="hit"' in response.headers.get('Server-Timing', '')
+        return response, cached
+
+    def test_cache_hit(self):
+        print('('+self.test_cache_hit.__name__+')', \
+              self.test_cache_hit.__doc__)
+
+        first, cached = self.get(SPEEDS_URL)
+        self.assertEqual(first.status_code, 200)
+        self.assertFalse(cached)
+        second, cached = self.get(SPEEDS_URL)
+        self.assertTrue(cached)
+        self.assertEqual(second.get_data(), first.get_data())
+        self.assertEqual(second.headers['ETag'], first.headers['ETag'])
+        self.assertEqual(len(second.get_json()['items']), ROWCOUNT)
+
+        #other query parameters are another entry
+        third, cached = self.get(SPEEDS_URL + '?limit=5')
+        self.assertFalse(cached)
+        self.assertEqual(len(third.get_json()['items']), 5)
+
+    def test_cache_conditional(self):
+        '''
+        A cached response is answered with 304 if the client has it
+        '''
+        print('('+self.test_cache_conditional.__name__+')', \
+              self.test_cache_conditional.__doc__)
+
+        first, cached = self.get(SPEEDS_URL)
+        second, cached = self.get(SPEEDS_URL, headers={'If-None-Match': first.headers['ETag']})
+        self.assertTrue(cached)
+        self.assertEqual(second.status_code, 304)
+
+    def test_cache_quantities(self):
+        '''
+        The quantities of a route are cached apart
+        '''
+        print('('+self.test_cache_quantities.__name__+')', \
+              self.test_cache_quantities.__doc__)
+
+        speeds, cached = self.get('/wind/api/device/1/speeds/aggregate?bucket=1d')
+        self.assertEqual(speeds.status_code, 200)
+        temperatures, cached = self.get('/wind/api/device/1/temperatures/aggregate?bucket=1d')
+        self.assertFalse(cached)
+        self.assertNotEqual(temperatures.get_data(), speeds.get_data())
+        self.assertIn('/temperatures/', temperatures.get_json()['_links']['list']['href'])
+        self.assertEqual(self.get('/wind/api/device/1/temperatures/aggregate?bucket=1d')[1], True)
+
+    def test_cache_representations(self):
+        '''
+        The items and the columns of a collection are cached apart
+        '''
+        print('('+self.test_cache_representations.__name__+')', \
+              self.test_cache_representations.__doc__)
+
+        items, cached = self.get(SPEEDS_URL)
+        columns, cached = self.get(SPEEDS_URL, headers={'Accept': resourcess.COLUMNS_JSON})
+        self.assertFalse(cached)
+        self.assertIn('speed', columns.get_json())
+        self.assertIn('items', self.get(SPEEDS_URL)[0].get_json())
+
+    def test_cache_invalidated(self):
+        '''
+        A write drops the cached responses of the device
+        '''
+        print('('+self.test_cache_invalidated.__name__+')', \
+              self.test_cache_invalidated.__doc__)
+
+        url = '/wind/api/device/1/temperatures/'
+        before, cached = self.get(url)
+        other, cached = self.get('/wind/api/device/2/temperatures/')
+        response = self.client.put('/wind/api/device/1/temperature/1', json={'timestamp': 1, 'temperature': 1})
+        self.assertEqual(response.status_code, 204)
+        after, cached = self.get(url)
+        self.assertFalse(cached)
+        self.assertEqual(after.get_json()['items'][0], {'timestamp': 1, 'temperature': 1})
+        self.assertNotEqual(after.headers['ETag'], before.headers['ETag'])
+        self.assertTrue(self.get('/wind/api/device/2/temperatures/')[1])
+
+    def test_cache_version(self):
+        '''
+        A change made by another process is seen through the data version
+        '''
+        print('('+self.test_cache_version.__name__+')', \
+              self.test_cache_version.__doc__)
+
+        url = '/wind/api/device/1/temperatures/'
+        self.get(url)
+        connection = resourcess.create_engine(self.db_path).connect()
+        try:
+            connection.modify_temperature(ID, 1, 2)
+        finally:
+            connection.close()
+        after, cached = self.get(url)
+        self.assertFalse(cached)
+        self.assertEqual(after.get_json()['items'][0], {'timestamp': 1, 'temperature': 2})
+
+    def test_cache_not_stored(self):
+        '''
+        Errors and streamed responses are not cached
+        '''
+        print('('+self.test_cache_not_stored.__name__+')', \
+              self.test_cache_not_stored.__doc__)
+
+        self.get('/wind/api/device/9/speeds/')
+        self.assertEqual(self.get('/wind/api/device/9/speeds/')[0].status_code, 404)
+        self.assertFalse(self.get('/wind/api/device/9/speeds/')[1])
+        response, cached = self.get(SPEEDS_URL + '?stream=true')
+        self.assertEqual(len(response.get_json()['items']), ROWCOUNT)
+        self.assertEqual(app.config["RESPONSE_CACHE"].stats()['entries'], 0)
+
+
+def read_npy(data):
+    '''
+    :return: (header dict, array data) of a .npy file
+    '''
+    length = struct.unpack('<H', data[8:10])[0]
+    return ast.literal_eval(data[10:10 + length].decode('latin1')), data[10 + length:]
+
+
+class ApiExportTests(ApiTestCase):
+    '''
+    Tests for the binary export of the device collections
+    '''
+
+    def get_arrays(self, quantity):
+        connection = resourcess.create_engine(self.db_path).connect()
+        try:
+            return connection.get_series_arrays(ID, quantity)
+        finally:
+            connection.close()
+
+    def test_export_npy(self):
+        print('('+self.test_export_npy.__name__+')', \
+              self.test_export_npy.__doc__)
+
+        response = self.client.get('/wind/api/device/1/speeds/export?format=npy')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, export.NPY)
+        header, data = read_npy(response.get_data())
+        self.assertEqual(header['descr'], [('date', '<i8'), ('speed', '<f8')])
+        self.assertEqual(header['shape'], (ROWCOUNT,))
+        dates, values = self.get_arrays('speed')
+        rows = list(struct.iter_unpack('<qd', data))
+        self.assertEqual([row[0] for row in rows], list(dates))
+        self.assertEqual(struct.pack('<%dd' % ROWCOUNT, *[row[1] for row in rows]), values.tobytes())
+
+    def test_export_npz(self):
+        print('('+self.test_export_npz.__name__+')', \
+              self.test_export_npz.__doc__)
+
+        response = self.client.get('/wind/api/device/1/temperatures/export')
+        self.assertEqual(response.mimetype, export.NPZ)
+        npz = zipfile.ZipFile(io.BytesIO(response.get_data()))
+        self.assertEqual(sorted(npz.namelist()), ['date.npy', 'temperature.npy'])
+        header, data = read_npy(npz.read('temperature.npy'))
+        self.assertEqual(header['descr'], '<f8')
+        self.assertEqual(data, self.get_arrays('temperature')[1].tobytes())
+
+    def test_export_quantities(self):
+        '''
+        Exports of two quantities one after the other are not mixed up by the cache
+        '''
+        print('('+self.test_export_quantities.__name__+')', \
+              self.test_export_quantities.__doc__)
+
+        for format in ('npy', 'npz', 'npy'):
+            speeds = self.client.get('/wind/api/device/1/speeds/export?format=' + format)
+            temperatures = self.client.get('/wind/api/device/1/temperatures/export?format=' + format)
+            self.assertEqual(speeds.headers['Content-Disposition'], 'attachment; filename=device-1-speeds.' + format)
+            self.assertEqual(temperatures.headers['Content-Disposition'],
+                             'attachment; filename=device-1-temperatures.' + format)
+            self.assertNotEqual(speeds.get_data(), temperatures.get_data())
+
+
+class ApiDataTests(ApiTestCase):
+    '''
+    Tests for the bulk ingest of readings
+    '''
+
+    def test_post_data(self):
+        print('('+self.test_post_data.__name__+')', \
+              self.test_post_data.__doc__)
+
+        rows = [{'timestamp': 5000, 'speed': 1.5}, {'timestamp': 5600, 'speed': 2.5, 'temperature': 10}]
+        response = self.client.post('/wind/api/device/1/data/', json=rows)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()['count'], 2)
+
+    def test_post_data_malformed(self):
+        '''
+        A value that is not a number or a string is a 400, nothing is written
+        '''
+        print('('+self.test_post_data_malformed.__name__+')', \
+              self.test_post_data_malformed.__doc__)
+
+        for rows in ([{'timestamp': 5, 'speed': [1]}],
+                     [{'timestamp': 5000, 'speed': 1.5}, {'timestamp': 5600, 'humidity': {'value': 1}}]):
+            response = self.client.post('/wind/api/device/1/data/', json=rows)
+            self.assertEqual(response.status_code, 400)
+            self.assertIn('Row', response.get_json()['info'])
+        self.assertEqual(self.client.get('/wind/api/device/1/speed/5000').status_code, 404)
+
+
+class ApiNegotiationTests(ApiTestCase):
+    '''
+    Tests for the representations of the collections chosen with Accept or format
+    '''
+
+    def assertVaryAccept(self, response):
+        self.assertIn('accept', [value.strip().lower() for value in response.headers.get('Vary', '').split(',')])
+
+    def test_vary_accept(self):
+        print('('+self.test_vary_accept.__name__+')', \
+              self.test_vary_accept.__doc__)
+
+        items = self.client.get(SPEEDS_URL)
+        self.assertVaryAccept(items)
+        self.assertVaryAccept(self.client.get(SPEEDS_URL, headers={'Accept': resourcess.COLUMNS_JSON}))
+        self.assertVaryAccept(self.client.get(SPEEDS_URL + '?stream=true'))
+        self.assertVaryAccept(self.client.get(SPEEDS_URL, headers={'If-None-Match': items.headers['ETag']}))
+        self.assertVaryAccept(self.client.get('/wind/api/device/1/series?fields=speed'))
+        #served from the response cache
+        self.assertVaryAccept(self.client.get(SPEEDS_URL))
+
+    def test_etag_representation(self):
+        '''
+        The items and the columns of the same data have different ETags
+        '''
+        print('('+self.test_etag_representation.__name__+')', \
+              self.test_etag_representation.__doc__)
+
+        items = self.client.get(SPEEDS_URL)
+        columns = self.client.get(SPEEDS_URL, headers={'Accept': resourcess.COLUMNS_JSON})
+        self.assertNotEqual(items.headers['ETag'], columns.headers['ETag'])
+        self.assertEqual(columns.headers['ETag'],
+                         self.client.get(SPEEDS_URL + '?format=columns').headers['ETag'])
+
+        #the ETag of the items does not validate the columns
+        response = self.client.get(SPEEDS_URL, headers={'Accept': resourcess.COLUMNS_JSON,
+                                                        'If-None-Match': items.headers['ETag']})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('speed', response.get_json())
+        response = self.client.get(SPEEDS_URL, headers={'Accept': resourcess.COLUMNS_JSON,
+                                                        'If-None-Match': columns.headers['ETag']})
+        self.assertEqual(response.status_code, 304)
+
+    def test_etag_export_format(self):
+        print('('+self.test_etag_export_format.__name__+')', \
+              self.test_etag_export_format.__doc__)
+
+        npz = self.client.get('/wind/api/device/1/speeds/export')
+        npy = self.client.get('/wind/api/device/1/speeds/export?format=npy')
+        self.assertNotEqual(npz.headers['ETag'], npy.headers['ETag'])
+
+
+class AsgiAdapterTests(ApiTestCase):
+    '''
+    Tests for serving the API as an ASGI application
+    '''
+
+    def request(self, adapter, method, path, query_string=b'', headers=(), bodies=(b'',)):
+        '''
+        Runs one http request through the adapter.
+
+        :param bodies: chunks of the request body, one message each
+        :return: (status, headers, list of the chunks of the response body)
+        '''
+        messages = [{'type': 'http.request', 'body': body, 'more_body': i < len(bodies) - 1}
+                    for i, body in enumerate(bodies)]
+        sent = []
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message)
+
+        scope = {'type': 'http', 'method': method, 'path': path, 'query_string': query_string,
+                 'headers': list(headers), 'http_version': '1.1', 'scheme': 'http',
+                 'server': ('localhost', 5000), 'client': ('127.0.0.1', 1234)}
+        asyncio.run(asyncio.wait_for(adapter(scope, receive, send), 10))
+        self.assertEqual(sent[0]['type'], 'http.response.start')
+        self.assertFalse(sent[-1].get('more_body', False))
+        return sent[0]['status'], dict(sent[0]['headers']), [message['body'] for message in sent[1:]]
+
+    def test_asgi_request(self):
+        print('('+self.test_asgi_request.__name__+')', \
+              self.test_asgi_request.__doc__)
+
+        adapter = asgi.AsgiAdapter(app, 2)
+        status, headers, bodies = self.request(adapter, 'GET', '/wind/api/device/1')
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(b''.join(bodies).decode('utf-8'))['device_id'], ID)
+
+        status, headers, bodies = self.request(adapter, 'GET', '/wind/api/device/9')
+        self.assertEqual(status, 404)
+
+        #a request body sent in two messages
+        rows = json.dumps([{'timestamp': 5000, 'speed': 1.5}, {'timestamp': 5600, 'speed': 2.5}]).encode('utf-8')
+        status, headers, bodies = self.request(adapter, 'POST', '/wind/api/device/1/data/',
+                                               headers=[(b'content-type', b'application/json')],
+                                               bodies=(rows[:10], rows[10:]))
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(b''.join(bodies).decode('utf-8'))['count'], 2)
+        adapter.shutdown()
+
+    def test_asgi_disconnect(self):
+        '''
+        A request whose client disconnects during the body is not handled
+        '''
+        print('('+self.test_asgi_disconnect.__name__+')', \
+              self.test_asgi_disconnect.__doc__)
+
+        calls = []
+
+        def wsgi_app(environ, start_response):
+            calls.append(environ)
+            return app(environ, start_response)
+
+        adapter = asgi.AsgiAdapter(wsgi_app, 2)
+        rows = json.dumps([{'timestamp': 5000, 'speed': 1.5}, {'timestamp': 5600, 'speed': 2.5}]).encode('utf-8')
+        messages = [{'type': 'http.request', 'body': rows[:10], 'more_body': True}, {'type': 'http.disconnect'}]
+        sent = []
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message)
+
+        scope = {'type': 'http', 'method': 'POST', 'path': '/wind/api/device/1/data/', 'query_string': b'',
+                 'headers': [(b'content-type', b'application/json')], 'http_version': '1.1'}
+        asyncio.run(asyncio.wait_for(adapter(scope, receive, send), 10))
+        adapter.shutdown()
+        self.assertEqual((calls, sent), ([], []))
+        self.assertEqual(self.client.get(SPEEDS_URL + '?start=5000').status_code, 404)
+
+    def test_asgi_streamed(self):
+        '''
+        A streamed collection is sent in several body messages
+        '''
+        print('('+self.test_asgi_streamed.__name__+')', \
+              self.test_asgi_streamed.__doc__)
+
+        adapter = asgi.AsgiAdapter(app, 2)
+        status, headers, bodies = self.request(adapter, 'GET', SPEEDS_URL, query_string=b'stream=true')
+        self.assertEqual(status, 200)
+        self.assertGreater(len([body for body in bodies if body]), 2)
+        self.assertEqual(len(json.loads(b''.join(bodies).decode('utf-8'))['items']), ROWCOUNT)
+        adapter.shutdown()
+
+    def test_asgi_lifespan(self):
+        '''
+        The shutdown waits for a request being sent without blocking the event loop
+        '''
+        print('('+self.test_asgi_lifespan.__name__+')', \
+              self.test_asgi_lifespan.__doc__)
+
+        shutdowns = []
+        adapter = asgi.AsgiAdapter(app, 2, on_shutdown=lambda: shutdowns.append(True))
+        lifespan_sent = []
+        http_sent = []
+
+        async def run():
+            lifespan_messages = asyncio.Queue()
+
+            async def send_lifespan(message):
+                lifespan_sent.append(message['type'])
+
+            lifespan = asyncio.ensure_future(adapter({'type': 'lifespan'}, lifespan_messages.get, send_lifespan))
+            await lifespan_messages.put({'type': 'lifespan.startup'})
+
+            started = asyncio.Event()
+
+            async def receive():
+                return {'type': 'http.request', 'body': b''}
+
+            async def send(message):
+                http_sent.append(message)
+                started.set()
+                #the worker waits for the slow client while the shutdown begins
+                await asyncio.sleep(0.05)
+
+            scope = {'type': 'http', 'method': 'GET', 'path': SPEEDS_URL, 'query_string': b'stream=true',
+                     'headers': []}
+            http = asyncio.ensure_future(adapter(scope, receive, send))
+            await started.wait()
+            await lifespan_messages.put({'type': 'lifespan.shutdown'})
+            await asyncio.wait_for(asyncio.gather(lifespan, http), 10)
+
+        asyncio.run(run())
+        self.assertEqual(lifespan_sent, ['lifespan.startup.complete', 'lifespan.shutdown.complete'])
+        self.assertEqual(shutdowns, [True])
+        self.assertEqual(http_sent[0]['status'], 200)
+        self.assertFalse(http_sent[-1].get('more_body', False))
+
+
+class ApiMetricsTests(ApiTestCase):
+    '''
+    Tests for the request and statement metrics
+    '''
+
+    def test_metrics_admin_mode(self):
+        '''
+        The metrics are only served in admin mode
+        '''
+        print('('+self.test_metrics_admin_mode.__name__+')', \
+              self.test_metrics_admin_mode.__doc__)
+
+        app.config["METRICS_ENDPOINT"] = False
+        self.assertEqual(self.client.get('/wind/api/_metrics').status_code, 404)
+        self.assertEqual(self.client.delete('/wind/api/_metrics').status_code, 404)
+
+        app.config.update({"METRICS_ENDPOINT": True, "METRICS": resourcess.metrics.Metrics()})
+        self.client.get(SPEEDS_URL)
+        response = self.client.get('/wind/api/_metrics')
+        self.assertEqual(response.status_code, 200)
+        dump = response.get_json()
+        self.assertEqual(dump['routes']['GET speeds']['count'], 1)
+        self.assertTrue(any('WIND_DATA' in query['sql'] for query in dump['queries']))
+        self.assertEqual(self.client.get('/wind/api/_metrics?queries=all').status_code, 400)
+        self.assertEqual(self.client.delete('/wind/api/_metrics').status_code, 204)
+        self.assertEqual(self.client.get('/wind/api/_metrics').get_json()['queries'], [])
+
+    def test_server_timing(self):
+        print('('+self.test_server_timing.__name__+')', \
+              self.test_server_timing.__doc__)
+
+        response = self.client.get(SPEEDS_URL)
+        self.assertIn('db;dur=', response.headers['Server-Timing'])
+        self.assertIn('app;dur=', response.headers['Server-Timing'])
+
+
+@unittest.skipUnless(hasattr(os, 'fork'), "the runner needs os.fork")
+class RunnerTests(unittest.TestCase):
+    '''
+    Tests for serving the API from the pre-forked worker processes of runner.py
+    '''
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.tmpdir, 'PWP_DATA.db')
+        copy2('db/PWP_DATA_restore.db', self.db_path)
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        self.port = sock.getsockname()[1]
+        sock.close()
+        self.master = subprocess.Popen([sys.executable, 'runner.py', '--workers', '2', '--port', str(self.port),
+                                        '--db', self.db_path, '--max-requests', '0', '--metrics'],
+                                       cwd=WIND_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def tearDown(self):
+        if self.master.poll() is None:
+            self.master.kill()
+            self.master.wait()
+        rmtree(self.tmpdir)
+
+    def request(self, method, url, body=None, headers={}):
+        '''
+        :return: (status, parsed JSON body or None)
+        '''
+        connection = http.client.HTTPConnection('127.0.0.1', self.port, timeout=10)
+        try:
+            connection.request(method, url, body, headers)
+            response = connection.getresponse()
+            data = response.read()
+            return response.status, json.loads(data.decode('utf-8')) if data else None
+        finally:
+            connection.close()
+
+    def wait_ready(self):
+        deadline = time.time() + 20
+        while True:
+            try:
+                return self.request('GET', '/wind/api/devices/')
+            except OSError:
+                if time.time() > deadline or self.master.poll() is not None:
+                    raise
+                time.sleep(0.1)
+
+    def worker_pids(self, requests=20):
+        return set(self.request('GET', '/wind/api/_metrics')[1]['pid'] for i in range(requests))
+
+    def test_master_does_not_import_api(self):
+        '''
+        Only the workers import the API, so a reload loads the current code
+        '''
+        print('('+self.test_master_does_not_import_api.__name__+')', \
+              self.test_master_does_not_import_api.__doc__)
+
+        output = subprocess.check_output([sys.executable, '-c', 'import sys, runner; '
+                                          'print(sorted(set(["resourcess", "dbhandler"]) & set(sys.modules)))'],
+                                         cwd=WIND_DIR)
+        self.assertEqual(output.strip(), b'[]')
+
+    def test_runner(self):
+        print('('+self.test_runner.__name__+')', \
+              self.test_runner.__doc__)
+
+        status, dump = self.wait_ready()
+        self.assertEqual(status, 200)
+        status, dump = self.request('GET', SPEEDS_URL)
+        self.assertEqual(len(dump['items']), ROWCOUNT)
+        self.assertEqual(self.request('GET', '/wind/api/_metrics')[1]['read_pool']['size'], 8)
+
+        #the writes are served from the pool of the writers
+        rows = json.dumps([{'timestamp': 5000, 'speed': 1.5}])
+        status, dump = self.request('POST', '/wind/api/device/1/data/', rows, {'Content-Type': 'application/json'})
+        self.assertEqual((status, dump['count']), (200, 1))
+        self.assertEqual(self.request('GET', '/wind/api/device/1/speed/5000')[1]['speed'], 1.5)
+
+        #SIGHUP replaces the workers
+        before = self.worker_pids()
+        self.master.send_signal(signal.SIGHUP)
+        deadline = time.time() + 20
+        while self.worker_pids() & before and time.time() < deadline:
+            time.sleep(0.2)
+        self.assertFalse(self.worker_pids() & before)
+
+        self.master.send_signal(signal.SIGTERM)
+        self.assertEqual(self.master.wait(20), 0)
+
+
+class ApiCompressionTests(ApiTestCase):
+    '''
+    Tests for compressing the responses with the encoding accepted by the client
+    '''
+
+    def get(self, url, encoding=None, **kwargs):
+        headers = kwargs.pop('headers', {})
+        if encoding is not None:
+            headers['Accept-Encoding'] = encoding
+        return self.client.get(url, headers=headers, **kwargs)
+
+    def assertVaryEncoding(self, response):
+        self.assertIn('accept-encoding', [value.strip().lower() for value in response.headers.get('Vary', '').split(',')])
+
+    def test_gzip(self):
+        print('('+self.test_gzip.__name__+')', \
+              self.test_gzip.__doc__)
+
+        plain = self.get(SPEEDS_URL)
+        self.assertNotIn('Content-Encoding', plain.headers)
+        self.assertVaryEncoding(plain)
+        compressed = self.get(SPEEDS_URL, 'gzip')
+        self.assertEqual(compressed.headers['Content-Encoding'], 'gzip')
+        self.assertVaryEncoding(compressed)
+        self.assertLess(len(compressed.get_data()), len(plain.get_data()))
+        self.assertEqual(gzip.decompress(compressed.get_data()), plain.get_data())
+
+    def test_q_values(self):
+        '''
+        The encoding is chosen by the q-values of Accept-Encoding
+        '''
+        print('('+self.test_q_values.__name__+')', \
+              self.test_q_values.__doc__)
+
+        self.assertNotIn('Content-Encoding', self.get(SPEEDS_URL, 'gzip;q=0').headers)
+        self.assertNotIn('Content-Encoding', self.get(SPEEDS_URL, 'identity').headers)
+        self.assertEqual(self.get(SPEEDS_URL, 'identity;q=1, gzip;q=0.5').headers['Content-Encoding'], 'gzip')
+        self.assertEqual(self.get(SPEEDS_URL, 'deflate, *;q=0.1').headers['Content-Encoding'],
+                         resourcess.ENCODINGS[0])
+        #without brotli installed the responses are only gzipped
+        self.assertEqual(self.get(SPEEDS_URL, 'br;q=1.0, gzip;q=0.8').headers['Content-Encoding'],
+                         'br' if resourcess.brotli is not None else 'gzip')
+        self.assertEqual(self.get(SPEEDS_URL, 'br;q=0.5, gzip;q=0.8').headers['Content-Encoding'], 'gzip')
+
+    @unittest.skipIf(resourcess.brotli is None, "brotli is not installed")
+    def test_brotli(self):
+        print('('+self.test_brotli.__name__+')', \
+              self.test_brotli.__doc__)
+
+        plain = self.get(SPEEDS_URL)
+        compressed = self.get(SPEEDS_URL, 'gzip, br')
+        self.assertEqual(compressed.headers['Content-Encoding'], 'br')
+        self.assertEqual(resourcess.brotli.decompress(compressed.get_data()), plain.get_data())
+
+    def test_min_size(self):
+        '''
+        Bodies under COMPRESSION_MIN_SIZE are sent as they are
+        '''
+        print('('+self.test_min_size.__name__+')', \
+              self.test_min_size.__doc__)
+
+        small = self.get('/wind/api/device/1', 'gzip')
+        self.assertLess(len(small.get_data()), app.config["COMPRESSION_MIN_SIZE"])
+        self.assertNotIn('Content-Encoding', small.headers)
+        self.assertVaryEncoding(small)
+
+        app.config["COMPRESSION_MIN_SIZE"] = 10 ** 6
+        self.assertNotIn('Content-Encoding', self.get(SPEEDS_URL + '?limit=100', 'gzip').headers)
+
+    def test_not_compressed(self):
+        '''
+        Streamed, already encoded and binary responses are not compressed
+        '''
+        print('('+self.test_not_compressed.__name__+')', \
+              self.test_not_compressed.__doc__)
+
+        streamed = self.get(SPEEDS_URL + '?stream=true', 'gzip')
+        self.assertNotIn('Content-Encoding', streamed.headers)
+        self.assertEqual(len(json.loads(streamed.get_data())['items']), ROWCOUNT)
+
+        exported = self.get('/wind/api/device/1/speeds/export', 'gzip')
+        self.assertNotIn('Content-Encoding', exported.headers)
+
+        body = b'{"items": []}' * 1000
+        with app.test_request_context(SPEEDS_URL, headers={'Accept-Encoding': 'gzip'}):
+            response = resourcess.Response(body, 200, mimetype=resourcess.JSONHAL,
+                                           headers={'Content-Encoding': 'identity'})
+            response = resourcess.compress_response(response)
+            self.assertEqual(response.headers['Content-Encoding'], 'identity')
+            self.assertEqual(response.get_data(), body)
+
+    def test_cached_responses(self):
+        '''
+        The response cache keeps the plain body, each encoding is compressed once
+        '''
+        print('('+self.test_cached_responses.__name__+')', \
+              self.test_cached_responses.__doc__)
+
+        first = self.get(SPEEDS_URL, 'gzip')
+        self.assertEqual(first.headers['Content-Encoding'], 'gzip')
+        plain = self.get(SPEEDS_URL)
+        self.assertIn('cache;desc="hit"', plain.headers['Server-Timing'])
+        self.assertNotIn('Content-Encoding', plain.headers)
+        self.assertEqual(gzip.decompress(first.get_data()), plain.get_data())
+
+        second = self.get(SPEEDS_URL, 'gzip')
+        self.assertIn('cache;desc="hit"', second.headers['Server-Timing'])
+        self.assertEqual(second.get_data(), first.get_data())
+        self.assertVaryEncoding(second)
+        stats = app.config["COMPRESSED_CACHE"].stats()
+        self.assertEqual((stats['entries'], stats['hits']), (1, 1))
+
+        #a 304 has no body to compress
+        not_modified = self.get(SPEEDS_URL, 'gzip', headers={'If-None-Match': first.headers['ETag']})
+        self.assertEqual(not_modified.status_code, 304)
+        self.assertNotIn('Content-Encoding', not_modified.headers)
+
+
+# A line of a collapsed stacks file: "outer (file:line);...;inner (file:line) count"
+FOLDED_FRAME = r'[^;]+ \([^;:]+:\d+\)'
+FOLDED_LINE = re.compile(r'^%s(;%s)* \d+$' % (FOLDED_FRAME, FOLDED_FRAME))
+
+
+class ApiProfilerTests(ApiTestCase):
+    '''
+    Tests for profiling single requests in admin mode
+    '''
+
+    def setUp(self):
+        super(ApiProfilerTests, self).setUp()
+        self.profile_dir = os.path.join(self.tmpdir, 'profiles')
+        app.config.update({"PROFILING": True, "PROFILE_DIR": self.profile_dir})
+
+    def assertFolded(self, path):
+        with open(path) as f:
+            lines = f.read().splitlines()
+        for line in lines:
+            self.assertRegex(line, FOLDED_LINE)
+        return lines
+
+    def test_profiling_off(self):
+        '''
+        Without admin mode the header and the query parameter are ignored
+        '''
+        print('('+self.test_profiling_off.__name__+')', \
+              self.test_profiling_off.__doc__)
+
+        app.config["PROFILING"] = False
+        for response in (self.client.get(SPEEDS_URL, headers={'X-Profile': 'cprofile'}),
+                         self.client.get(SPEEDS_URL + '?_profile=sample'),
+                         self.client.get(SPEEDS_URL + '?_profile=nothing')):
+            self.assertEqual(response.status_code, 200)
+            self.assertNotIn('X-Profile', response.headers)
+        self.assertFalse(os.path.exists(self.profile_dir))
+
+    def test_profile_cprofile(self):
+        '''
+        A cprofile request writes a pstats file of the route
+        '''
+        print('('+self.test_profile_cprofile.__name__+')', \
+              self.test_profile_cprofile.__doc__)
+
+        response = self.client.get(SPEEDS_URL, headers={'X-Profile': 'cprofile'})
+        self.assertEqual(response.status_code, 200)
+        path = response.headers['X-Profile']
+        self.assertEqual(os.path.dirname(path), os.path.join(os.path.abspath(self.profile_dir), 'GET-speeds'))
+        self.assertTrue(path.endswith('.pstats'))
+        stats = pstats.Stats(path)
+        self.assertIn('series_response', [function for filename, line, function in stats.stats])
+
+    def test_profile_sample(self):
+        '''
+        A sampled request writes collapsed stacks of the route
+        '''
+        print('('+self.test_profile_sample.__name__+')', \
+              self.test_profile_sample.__doc__)
+
+        response = self.client.get(SPEEDS_URL + '?_profile=1&limit=10')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.headers['X-Profile'].endswith('.folded'))
+        self.assertFolded(response.headers['X-Profile'])
+        #the links do not ask for profiles
+        self.assertNotIn('_profile', response.get_json()['_links']['next']['href'])
+        #a profiled request is not answered from the response cache
+        self.assertIn('X-Profile', self.client.get(SPEEDS_URL + '?_profile=1&limit=10').headers)
+
+    def test_profile_malformed(self):
+        '''
+        An unknown profiler is a bad request
+        '''
+        print('('+self.test_profile_malformed.__name__+')', \
+              self.test_profile_malformed.__doc__)
+
+        response = self.client.get(SPEEDS_URL, headers={'X-Profile': 'nothing'})
+        self.assertEqual(response.status_code, 400)
+        self.assertNotIn('X-Profile', response.headers)
+
+    def test_sampling_profiler(self):
+        '''
+        The collapsed stacks have the sampled function innermost
+        '''
+        print('('+self.test_sampling_profiler.__name__+')', \
+              self.test_sampling_profiler.__doc__)
+
+        def busy_function():
+            started = time.perf_counter()
+            while time.perf_counter() - started < 0.2:
+                pass
+
+        sampler = profiler.SamplingProfiler(interval=0.001)
+        sampler.start()
+        busy_function()
+        sampler.stop()
+        self.assertGreater(sampler.samples, 0)
+        path = os.path.join(self.tmpdir, 'busy.folded')
+        sampler.dump(path)
+        lines = self.assertFolded(path)
+        self.assertEqual(sum(int(line.rsplit(' ', 1)[1]) for line in lines), sampler.samples)
+        self.assertTrue(any(';busy_function (API_unittest.py:' in line for line in lines))
+        with self.assertRaises(ValueError):
+            profiler.create_profiler('nothing')
+
+
+class ApiBenchmarkTests(ApiTestCase):
+    '''
+    Tests that the requests of API_benchmark.py are valid
+    '''
+
+    def test_benchmark_requests(self):
+        '''
+        Every request of the load test succeeds on a server not in admin mode
+        '''
+        print('('+self.test_benchmark_requests.__name__+')', \
+              self.test_benchmark_requests.__doc__)
+
+        app.config.update({"METRICS_ENDPOINT": False, "PROFILING": False})
+        requests = API_benchmark.get_requests(API_benchmark.get_routes())
+        self.assertNotIn('metrics', [request[0] for request in requests])
+        values = {'id': ID, 'timestamp': 2, 'start': 2, 'end': 100, 'quantity': 'speeds'}
+        for endpoint, method, path, query, body in requests:
+            url = Template(path).substitute(values) + ('?' + Template(query).substitute(values) if query else '')
+            data = Template(body).substitute(values) if body is not None else None
+            response = self.client.open(url, method=method, data=data, content_type='application/json',
+                                        headers={'Accept': 'application/hal+json'})
+            self.assertLess(response.status_code, 400, '%s %s' % (method, url))
+
+
+class ApiAggregateTests(ApiTestCase):
+    '''
+    Tests for the query parameters of the aggregates
+    '''
+
+    def test_aggregate_range(self):
+        print('('+self.test_aggregate_range.__name__+')', \
+              self.test_aggregate_range.__doc__)
+
+        response = self.client.get('/wind/api/device/1/speeds/aggregate?bucket=1&fn=count&start=10&end=20')
+        self.assertEqual(response.status_code, 200)
+        items = response.get_json()['items']
+        self.assertEqual([item['timestamp'] for item in items], list(range(10, 20)))
+        response = self.client.get('/wind/api/device/1/speeds/aggregate?start=first')
+        self.assertEqual(response.status_code, 400)
+
+    def test_aggregate_page_arguments(self):
+        '''
+        The parameters of the pages of the collection are refused, not ignored
+        '''
+        print('('+self.test_aggregate_page_arguments.__name__+')', \
+              self.test_aggregate_page_arguments.__doc__)
+
+        for query in ('limit=10', 'points=100', 'stream=true', 'format=columns', 'format=items', 'delta=1'):
+            response = self.client.get('/wind/api/device/1/speeds/aggregate?bucket=1h&' + query)
+            self.assertEqual(response.status_code, 400, query)
+            self.assertIn(query.split('=')[0], response.get_json()['info'])
+
+
+if __name__ == '__main__':
+    print('Start running API tests')
+    unittest.main()
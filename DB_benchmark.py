@@ -0,0 +1,378 @@
+# -*- coding: utf-8 -*-
+# Micro-benchmarks of the dbhandler.Connection methods
+#
+# Every method is timed on synthetic databases of growing size (10^3 ... 10^7
+# readings), so a method that scans the whole table shows up as a time per
+# call that grows with the size (see "scaling" in the results). The Python
+# allocations of the calls are measured with tracemalloc.
+#
+# The test will run from root folder with command:
+#
+#   python DB_benchmark.py --sizes 1e3,1e4,1e5 --save-baseline baseline.json
+#   python DB_benchmark.py --sizes 1e3,1e4,1e5 --baseline baseline.json
+#
+# The second run fails if a method got slower than the baseline. Every method
+# is measured --repeats times and the best of the medians of the repeats is
+# compared, relative to a reference statement timed just before it, so a
+# machine that is busy or slower as a whole does not fail it.
+
+import argparse, itertools, json, math, os, platform, random, sqlite3, sys, tempfile, time, tracemalloc
+from shutil import copy2, rmtree
+
+from wind import dbhandler
+
+# Methods of Connection measured: (name, method, function returning the
+# arguments of one call). The arguments are created before the timing starts.
+# d is the Workload of the database
+READ_CASES = [
+    ('get_device', 'get_device', lambda d: (d.device(),)),
+    ('get_devices', 'get_devices', lambda d: ()),
+    ('get_speed', 'get_speed', lambda d: (d.device(), d.timestamp())),
+    ('get_direction', 'get_direction', lambda d: (d.device(), d.timestamp())),
+    ('get_battery', 'get_battery', lambda d: (d.device(), d.timestamp())),
+    ('get_temperature', 'get_temperature', lambda d: (d.device(), d.timestamp())),
+    ('get_humidity', 'get_humidity', lambda d: (d.device(), d.timestamp())),
+    ('get_pressure', 'get_pressure', lambda d: (d.timestamp(),)),
+    ('contains_timestamp', 'contains_timestamp', lambda d: (d.device(), d.timestamp())),
+    ('contains_value', 'contains_value', lambda d: (d.device(), d.timestamp(), 'temperature')),
+    ('get_data_version', 'get_data_version', lambda d: (d.device(),)),
+    ('get_previous_start', 'get_previous_start', lambda d: (d.device(), d.timestamp(), 100)),
+    ('get_speeds_page', 'get_speeds', lambda d: (d.device(), d.timestamp(), None, 100)),
+    ('get_speeds_day', 'get_speeds', lambda d: (d.device(),) + d.day()),
+    ('get_temperatures_day', 'get_temperatures', lambda d: (d.device(),) + d.day()),
+    ('get_series_columns_day', 'get_series_columns', lambda d: (d.device(), 'speed') + d.day()),
+    ('get_series_fields_day', 'get_series_fields',
+     lambda d: (d.device(), ['speed', 'direction', 'temperature']) + d.day()),
+    ('get_series_arrays_day', 'get_series_arrays', lambda d: (d.device(), 'speed') + d.day()),
+    ('get_aggregates_hourly_day', 'get_aggregates',
+     lambda d: (d.device(), 'speed', 3600, ['mean', 'min', 'max']) + d.day()),
+    ('get_aggregates_daily_all', 'get_aggregates', lambda d: (d.device(), 'temperature', 86400, ['mean'])),
+    ('get_decimated_500', 'get_decimated', lambda d: (d.device(), 'speed', 500)),
+]
+
+WRITE_CASES = [
+    ('add_temperature', 'add_temperature', lambda d: (d.device(), d.new_timestamp(), 100)),
+    ('modify_humidity', 'modify_humidity', lambda d: (d.device(), d.timestamp(), 80)),
+    ('delete_temperature', 'delete_temperature', lambda d: (d.device(), d.timestamp())),
+    ('batch_modify_10', 'batch_modify',
+     lambda d: (d.device(), [{'timestamp': d.timestamp(), 'field': 'humidity', 'value': 70} for i in range(10)])),
+    ('bulk_insert_144', 'bulk_insert', lambda d: (d.device(), list(d.new_readings(144)))),
+]
+
+# Times each method is measured, see run_size
+DEFAULT_REPEATS = 5
+
+# Slowdown per call below which a case is not reported as a regression (seconds)
+NOISE_FLOOR = 10e-6
+
+# A case is only reported if it got slower by more than this many times the
+# spread (max - min) of the medians of its repeats
+SPREAD_FACTOR = 3
+
+# Seconds the reference statement is timed before each case, see measure_reference
+REFERENCE_TIME = 0.05
+
+
+class Workload(object):
+    '''
+    Random arguments of the calls on a synthetic database created with
+    :py:meth:`dbhandler.Engine.populate_synthetic`.
+
+    :param devices: number of devices of the database
+    :param readings: readings per device
+    :param seed: seed of the random arguments
+    '''
+
+    def __init__(self, devices, readings, seed=0):
+        super(Workload, self).__init__()
+        self.devices = devices
+        self.readings = readings
+        self.rng = random.Random(seed)
+        self._new = 0
+
+    def device(self):
+        return self.rng.randint(1, self.devices)
+
+    def timestamp(self):
+        return dbhandler.SYNTHETIC_START + self.rng.randrange(self.readings) * dbhandler.SYNTHETIC_INTERVAL
+
+    def new_timestamp(self):
+        #between two readings, so there is no row at it yet
+        self._new += 1
+        return self.timestamp() + self._new % (dbhandler.SYNTHETIC_INTERVAL - 1) + 1
+
+    def day(self):
+        '''
+        :return: (start, end) of 24 hours of readings
+        '''
+        start = self.timestamp()
+        return start, start + 86400
+
+    def new_readings(self, count):
+        return dbhandler.synthetic_readings(self.rng, self.timestamp(), count)
+
+
+def measure(method, arguments, min_time, max_calls):
+    '''
+    Calls method until min_time seconds or max_calls calls have passed.
+
+    :param arguments: function returning the arguments of the next call
+    :return: sorted times of the calls in seconds
+    '''
+    #the first call prepares the statements
+    method(*arguments())
+    times = []
+    total = 0.0
+    while total < min_time and len(times) < max_calls:
+        args = arguments()
+        started = time.perf_counter()
+        method(*args)
+        elapsed = time.perf_counter() - started
+        times.append(elapsed)
+        total += elapsed
+    times.sort()
+    return times
+
+
+def measure_reference(repeats):
+    '''
+    Times a fixed statement on an in-memory database, which does not depend
+    on the code measured. The cases are compared with the baseline relative
+    to it, see :py:func:`compare`.
+
+    :return: best median of the repeats in seconds
+    '''
+    con = sqlite3.connect(':memory:')
+    try:
+        counter = itertools.count()
+        medians = []
+        for repeat in range(repeats):
+            times = measure(lambda i: con.execute('SELECT ?', (i,)).fetchall(), lambda: (next(counter),),
+                            REFERENCE_TIME / repeats, 10 ** 6)
+            medians.append(times[len(times) // 2])
+        return min(medians)
+    finally:
+        con.close()
+
+
+def measure_allocations(method, arguments, calls):
+    '''
+    Measures the memory allocated by Python during the calls. The memory of
+    sqlite itself is not seen by tracemalloc.
+
+    :return: (mean peak bytes during a call, mean bytes still allocated after a call)
+    '''
+    peaks = 0
+    retained = 0
+    tracemalloc.start()
+    try:
+        for i in range(calls):
+            args = arguments()
+            before = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            method(*args)
+            current, peak = tracemalloc.get_traced_memory()
+            peaks += peak - before
+            retained += current - before
+    finally:
+        tracemalloc.stop()
+    return peaks // calls, retained // calls
+
+
+def create_database(path, rows, options):
+    '''
+    Creates a synthetic database of rows readings split between the devices.
+    A database of the same size and seed in options.cache_dir is copied instead.
+    '''
+    cached = None
+    if options.cache_dir:
+        cached = os.path.join(options.cache_dir, 'synthetic-%d-%d-%d.db' % (rows, options.devices, options.seed))
+        if os.path.exists(cached):
+            copy2(cached, path)
+            return
+    started = time.time()
+    engine = dbhandler.Engine(path, profile=options.profile)
+    engine.populate_synthetic(options.devices, readings=rows // options.devices, seed=options.seed)
+    #the benchmarks run on a compact file without write-ahead log
+    engine.checkpoint(mode='TRUNCATE')
+    print("Generated %d readings in %.1f s" % (rows, time.time() - started), file=sys.stderr)
+    if cached is not None:
+        os.makedirs(options.cache_dir, exist_ok=True)
+        copy2(path, cached)
+
+
+def run_size(rows, options):
+    '''
+    Every case is measured options.repeats times, each time for a share of
+    min_time and max_calls. best_us is the smallest median of the repeats
+    and spread_us the difference between the largest and the smallest,
+    which tells how noisy the machine was. reference_us is the time of the
+    reference statement measured just before the case.
+
+    :return: dict case name -> results on a database of rows readings
+    '''
+    folder = tempfile.mkdtemp(prefix='wind-db-benchmark-')
+    try:
+        path = os.path.join(folder, 'benchmark.db')
+        create_database(path, rows, options)
+        connection = dbhandler.Engine(path, profile=options.profile).connect()
+        try:
+            cases = READ_CASES + ([] if options.read_only else WRITE_CASES)
+            results = {}
+            for name, method_name, get_arguments in cases:
+                if options.case and name not in options.case:
+                    continue
+                workload = Workload(options.devices, rows // options.devices, options.seed)
+                method = getattr(connection, method_name)
+                arguments = lambda: get_arguments(workload)
+                reference = measure_reference(options.repeats)
+                medians = []
+                times = []
+                for repeat in range(options.repeats):
+                    repeat_times = measure(method, arguments, options.min_time / options.repeats,
+                                           max(options.max_calls // options.repeats, 1))
+                    medians.append(repeat_times[len(repeat_times) // 2])
+                    times.extend(repeat_times)
+                times.sort()
+                medians.sort()
+                peak, retained = measure_allocations(method, arguments, min(len(times), options.allocation_calls))
+                results[name] = {'calls': len(times),
+                                 'median_us': round(medians[len(medians) // 2] * 1e6, 2),
+                                 'best_us': round(medians[0] * 1e6, 2),
+                                 'spread_us': round((medians[-1] - medians[0]) * 1e6, 2),
+                                 'reference_us': round(reference * 1e6, 3),
+                                 'p95_us': round(times[min(int(len(times) * 0.95), len(times) - 1)] * 1e6, 2),
+                                 'min_us': round(times[0] * 1e6, 2),
+                                 'peak_bytes': peak,
+                                 'retained_bytes': retained}
+                print("%10d %-28s %12.1f us %10d B" % (rows, name, results[name]['median_us'], peak),
+                      file=sys.stderr)
+            return results
+        finally:
+            connection.close()
+    finally:
+        rmtree(folder, ignore_errors=True)
+
+
+def get_scaling(results):
+    '''
+    :param results: dict size -> case -> results
+    :return: dict case -> growth exponent of the median time between the
+        smallest and the largest size: about 0 for a lookup, 1 for a full scan
+    '''
+    sizes = sorted(results, key=int)
+    if len(sizes) < 2:
+        return {}
+    small, large = results[sizes[0]], results[sizes[-1]]
+    ratio = math.log(float(sizes[-1]) / float(sizes[0]))
+    return dict((name, round(math.log(large[name]['median_us'] / small[name]['median_us']) / ratio, 2))
+                for name in small if name in large and small[name]['median_us'] > 0)
+
+
+def compare(results, baseline, tolerance):
+    '''
+    Compares the best medians of the repeats (best_us, median_us in the
+    baselines without it). The time of the baseline is first scaled by the
+    ratio of the reference times of the two runs, so the expected time is
+    the one of the baseline on the machine as fast as it is now. A case is
+    a regression if it is slower than expected by more than tolerance, by
+    more than SPREAD_FACTOR times the larger spread of the two runs and by
+    more than NOISE_FLOOR.
+
+    :return: list of the cases slower than in the baseline
+    '''
+    regressions = []
+    for size, cases in sorted(results.items(), key=lambda item: int(item[0])):
+        for name, result in sorted(cases.items()):
+            old = baseline.get('results', {}).get(size, {}).get(name)
+            if old is None:
+                continue
+            old_best = old.get('best_us', old['median_us'])
+            scale = result['reference_us'] / old['reference_us'] if old.get('reference_us') else 1.0
+            expected = old_best * scale
+            spread = max(old.get('spread_us', 0.0) * scale, result['spread_us'])
+            allowed = max(expected * tolerance, SPREAD_FACTOR * spread, NOISE_FLOOR * 1e6)
+            if result['best_us'] - expected > allowed:
+                regressions.append({'size': int(size), 'case': name, 'baseline_us': old_best,
+                                    'expected_us': round(expected, 2), 'best_us': result['best_us'],
+                                    'allowed_us': round(allowed, 2),
+                                    'ratio': round(result['best_us'] / expected, 2) if expected else None})
+    return regressions
+
+
+def parse_sizes(value):
+    try:
+        sizes = [int(float(size)) for size in value.split(',') if size]
+    except ValueError:
+        raise argparse.ArgumentTypeError("sizes must be numbers of readings, e.g. 1e3,1e4")
+    if not sizes or min(sizes) < 1:
+        raise argparse.ArgumentTypeError("sizes must be positive")
+    return sorted(sizes)
+
+
+def parse_options(args=None):
+    parser = argparse.ArgumentParser(description="Times the dbhandler.Connection methods on synthetic databases")
+    parser.add_argument('--sizes', type=parse_sizes, default=parse_sizes('1e3,1e4,1e5'),
+                        help="comma separated numbers of readings, e.g. 1e3,1e4,1e5,1e6,1e7")
+    parser.add_argument('--devices', type=int, default=4, help="devices the readings are split between")
+    parser.add_argument('--seed', type=int, default=0, help="seed of the data and of the arguments")
+    parser.add_argument('--profile', default='performance', choices=sorted(dbhandler.PROFILES),
+                        help="connection profile of the Engine")
+    parser.add_argument('--min-time', type=float, default=0.2, help="seconds each method is called")
+    parser.add_argument('--max-calls', type=int, default=2000, help="maximum calls of each method")
+    parser.add_argument('--repeats', type=int, default=DEFAULT_REPEATS,
+                        help="times each method is measured, the best median is compared with the baseline")
+    parser.add_argument('--allocation-calls', type=int, default=20, help="calls measured with tracemalloc")
+    parser.add_argument('--case', action='append', default=None, help="only run this case, can be repeated")
+    parser.add_argument('--read-only', action='store_true', help="do not run the methods that write")
+    parser.add_argument('--cache-dir', default=None, help="folder where the generated databases are kept")
+    parser.add_argument('--baseline', default=None, help="JSON results of an earlier run to compare with")
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help="allowed slowdown against the baseline, 0.25 is 25%%")
+    parser.add_argument('--save-baseline', default=None, help="write the results to this file as the new baseline")
+    parser.add_argument('--output', default=None, help="file of the JSON results, standard output by default")
+    options = parser.parse_args(args)
+    if options.devices < 1 or min(options.sizes) < options.devices:
+        parser.error("every size needs at least one reading per device")
+    if options.repeats < 1:
+        parser.error("--repeats must be at least 1")
+    return options
+
+
+def main(options):
+    results = {}
+    for rows in options.sizes:
+        results[str(rows)] = run_size(rows, options)
+
+    config = dict(vars(options))
+    config.update({'python': platform.python_version(), 'sqlite': sqlite3.sqlite_version,
+                   'platform': platform.platform(), 'time': int(time.time())})
+    report = {'config': config, 'results': results, 'scaling': get_scaling(results)}
+
+    for name, exponent in sorted(report['scaling'].items()):
+        if exponent >= 0.5:
+            print("%s grows with the size of the database (exponent %.2f)" % (name, exponent), file=sys.stderr)
+
+    if options.baseline:
+        with open(options.baseline) as f:
+            report['regressions'] = compare(results, json.load(f), options.tolerance)
+        for regression in report['regressions']:
+            print("REGRESSION %(case)s at %(size)d readings: %(baseline_us)s us (%(expected_us)s us on this "
+                  "machine now) -> %(best_us)s us, allowed +%(allowed_us)s us" % regression, file=sys.stderr)
+
+    dump = json.dumps(report, indent=2)
+    if options.save_baseline:
+        with open(options.save_baseline, 'w') as f:
+            f.write(dump + '\n')
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(dump + '\n')
+    elif not options.save_baseline:
+        print(dump)
+    return report
+
+
+if __name__ == '__main__':
+    report = main(parse_options())
+    if report.get('regressions'):
+        sys.exit(1)
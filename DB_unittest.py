@@ -2,8 +2,8 @@
 
 import sqlite3, unittest
 from wind import dbhandler
-from shutil import copy2
-import os
+from shutil import copy2, rmtree
+import os, tempfile, time
 
 # DB restore
 #dirname = os.path.dirname(__file__)
@@ -38,6 +38,20 @@ def extractDictAFromB(A,B):
     return dict([(k,B[k]) for k in A.keys() if k in B.keys()])
 
 
+class DbTestCase(unittest.TestCase):
+    '''
+    Runs the tests on a copy of the test database in a temporary folder
+    '''
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.tmpdir, 'PWP_DATA.db')
+        copy2('db/PWP_DATA_restore.db', self.db_path)
+
+    def tearDown(self):
+        rmtree(self.tmpdir)
+
+
 class DbCreateObjectsTests(unittest.TestCase):
 
     #test object creation
@@ -220,6 +234,217 @@ class DbGetSpeedFromDB(unittest.TestCase):
                 self.assertEqual(len(speed), 2)
                 self.assertEqual(speed, extractDictAFromB(speed, SPEED))
 
+    def test_get_speeds_range(self):
+        self.connection = ENGINE.connect()
+
+        print('('+self.test_get_speeds_range.__name__+')', \
+              self.test_get_speeds_range.__doc__)
+
+        speeds = self.connection.get_speeds(ID, 10, 20)
+        self.assertEqual([speed['timestamp'] for speed in speeds], list(range(10, 20)))
+
+        speeds = self.connection.get_speeds(ID, start=10, limit=3)
+        self.assertEqual([speed['timestamp'] for speed in speeds], [10, 11, 12])
+
+
+    def test_get_speeds_stream(self):
+        self.connection = ENGINE.connect()
+
+        print('('+self.test_get_speeds_stream.__name__+')', \
+              self.test_get_speeds_stream.__doc__)
+
+        speeds = self.connection.get_speeds(ID, 10, 20, stream=True)
+        self.assertNotIsInstance(speeds, list)
+        self.assertEqual(list(speeds), self.connection.get_speeds(ID, 10, 20))
+
+
+    def test_get_previous_start(self):
+        self.connection = ENGINE.connect()
+
+        print('('+self.test_get_previous_start.__name__+')', \
+              self.test_get_previous_start.__doc__)
+
+        self.assertEqual(self.connection.get_previous_start(ID, 10, 3), 7)
+        self.assertEqual(self.connection.get_previous_start(ID, 2, 3), 1)
+        self.assertIsNone(self.connection.get_previous_start(ID, TIMESTAMP, 3))
+
+
+    def test_get_series_columns(self):
+        self.connection = ENGINE.connect()
+
+        print('('+self.test_get_series_columns.__name__+')', \
+              self.test_get_series_columns.__doc__)
+
+        speeds = self.connection.get_speeds(ID, 10, 20)
+        columns = self.connection.get_series_columns(ID, 'speed', 10, 20)
+        self.assertEqual(columns, {'timestamp': [speed['timestamp'] for speed in speeds],
+                                   'speed': [speed['speed'] for speed in speeds]})
+
+        columns = self.connection.get_series_columns(ID, 'speed', start=10, limit=3)
+        self.assertEqual(columns['timestamp'], [10, 11, 12])
+
+        decimated = self.connection.get_decimated(ID, 'speed', 10, columns=True)
+        self.assertEqual(list(zip(decimated['timestamp'], decimated['speed'])),
+                         [(speed['timestamp'], speed['speed']) for speed in self.connection.get_decimated(ID, 'speed', 10)])
+
+        self.assertEqual(self.connection.get_series_columns(ID, 'speed', start=10 ** 12),
+                         {'timestamp': [], 'speed': []})
+        with self.assertRaises(ValueError):
+            self.connection.get_series_columns(ID, 'nothing')
+
+
+    def test_get_series_fields(self):
+        self.connection = ENGINE.connect()
+
+        print('('+self.test_get_series_fields.__name__+')', \
+              self.test_get_series_fields.__doc__)
+
+        rows = self.connection.get_series_fields(ID, ['speed', 'temperature'], 10, 20)
+        self.assertEqual([row['speed'] for row in rows],
+                         [speed['speed'] for speed in self.connection.get_speeds(ID, 10, 20)])
+        self.assertEqual([row['temperature'] for row in rows],
+                         [temperature['temperature'] for temperature in self.connection.get_temperatures(ID, 10, 20)])
+
+        columns = self.connection.get_series_fields(ID, ['speed', 'temperature'], 10, limit=3, columns=True)
+        self.assertEqual(sorted(columns.keys()), ['speed', 'temperature', 'timestamp'])
+        self.assertEqual(columns['timestamp'], [10, 11, 12])
+
+        with self.assertRaises(ValueError):
+            self.connection.get_series_fields(ID, ['speed', 'nothing'])
+        with self.assertRaises(ValueError):
+            self.connection.get_series_fields(ID, [])
+
+
+    def test_get_decimated_fields(self):
+        self.connection = ENGINE.connect()
+
+        print('('+self.test_get_decimated_fields.__name__+')', \
+              self.test_get_decimated_fields.__doc__)
+
+        fields = ['speed', 'temperature', 'humidity']
+        rows = self.connection.get_series_fields(ID, fields)
+        decimated = self.connection.get_decimated_fields(ID, fields, 12)
+        self.assertLessEqual(len(decimated), 12)
+        timestamps = [row['timestamp'] for row in decimated]
+        self.assertEqual(timestamps, sorted(timestamps))
+
+        #peaks of every field are kept
+        for field in fields:
+            values = [float(row[field]) for row in rows if row[field] not in (None, '')]
+            kept = [row[field] for row in decimated if row[field] is not None]
+            self.assertEqual(max(kept), max(values))
+            self.assertEqual(min(kept), min(values))
+
+        #all the rows of a short range
+        self.assertEqual(len(self.connection.get_decimated_fields(ID, fields, 100, 10, 20)), 10)
+
+        with self.assertRaises(ValueError):
+            self.connection.get_decimated_fields(ID, fields, 5)
+
+
+    def test_get_series_arrays(self):
+        self.connection = ENGINE.connect()
+
+        print('('+self.test_get_series_arrays.__name__+')', \
+              self.test_get_series_arrays.__doc__)
+
+        dates, values = self.connection.get_series_arrays(ID, 'speed', 10, 20)
+        self.assertEqual((dates.typecode, values.typecode), ('q', 'd'))
+        speeds = self.connection.get_speeds(ID, 10, 20)
+        self.assertEqual(list(dates), [speed['timestamp'] for speed in speeds])
+        for value, speed in zip(values, speeds):
+            if speed['speed'] in (None, ''):
+                #missing values are NaN
+                self.assertNotEqual(value, value)
+            else:
+                self.assertEqual(value, float(speed['speed']))
+
+        dates, values = self.connection.get_series_arrays(ID, 'speed', start=10 ** 12)
+        self.assertEqual((len(dates), len(values)), (0, 0))
+        with self.assertRaises(ValueError):
+            self.connection.get_series_arrays(ID, 'nothing')
+
+
+class DbGetAggregatesFromDB(unittest.TestCase):
+    '''
+    Tests for aggregating values of device into time buckets
+    '''
+
+    def test_get_aggregates(self):
+        self.connection = ENGINE.connect()
+
+        print('('+self.test_get_aggregates.__name__+')', \
+              self.test_get_aggregates.__doc__)
+
+        speeds = [speed['speed'] for speed in self.connection.get_speeds(ID, 10, 20)]
+        aggregates = self.connection.get_aggregates(ID, 'speed', 10, ['count', 'min', 'max', 'mean'], 10, 20)
+        self.assertEqual(len(aggregates), 1)
+        self.assertEqual(aggregates[0]['timestamp'], 10)
+        self.assertEqual(aggregates[0]['count'], len(speeds))
+        self.assertEqual(aggregates[0]['min'], min(speeds))
+        self.assertEqual(aggregates[0]['max'], max(speeds))
+        self.assertAlmostEqual(aggregates[0]['mean'], sum(speeds) / len(speeds))
+
+
+    def test_get_aggregates_buckets(self):
+        self.connection = ENGINE.connect()
+
+        print('('+self.test_get_aggregates_buckets.__name__+')', \
+              self.test_get_aggregates_buckets.__doc__)
+
+        aggregates = self.connection.get_aggregates(ID, 'speed', 50, ['count'], 0, 100)
+        self.assertEqual([a['timestamp'] for a in aggregates], [0, 50])
+        self.assertEqual(sum(a['count'] for a in aggregates), 99)
+
+
+    def test_get_aggregates_malformed(self):
+        self.connection = ENGINE.connect()
+
+        print('('+self.test_get_aggregates_malformed.__name__+')', \
+              self.test_get_aggregates_malformed.__doc__)
+
+        with self.assertRaises(ValueError):
+            self.connection.get_aggregates(ID, 'speed', 10, ['median'])
+        with self.assertRaises(ValueError):
+            self.connection.get_aggregates(ID, 'wind', 10, ['mean'])
+        with self.assertRaises(ValueError):
+            self.connection.get_aggregates(ID, 'speed', 0, ['mean'])
+
+
+    def test_get_decimated(self):
+        self.connection = ENGINE.connect()
+
+        print('('+self.test_get_decimated.__name__+')', \
+              self.test_get_decimated.__doc__)
+
+        speeds = [speed for speed in self.connection.get_speeds(ID) if speed['speed'] not in (None, '')]
+        decimated = self.connection.get_decimated(ID, 'speed', 10)
+        self.assertLessEqual(len(decimated), 10)
+        timestamps = [speed['timestamp'] for speed in decimated]
+        self.assertEqual(timestamps, sorted(timestamps))
+
+        #peaks are kept
+        values = [speed['speed'] for speed in decimated]
+        self.assertEqual(max(values), max(speed['speed'] for speed in speeds))
+        self.assertEqual(min(values), min(speed['speed'] for speed in speeds))
+
+        #every point is a real value
+        for speed in decimated:
+            self.assertIn(speed, speeds)
+
+
+    def test_get_decimated_short_series(self):
+        self.connection = ENGINE.connect()
+
+        print('('+self.test_get_decimated_short_series.__name__+')', \
+              self.test_get_decimated_short_series.__doc__)
+
+        decimated = self.connection.get_decimated(ID, 'speed', 100, 10, 20)
+        self.assertEqual(decimated, self.connection.get_speeds(ID, 10, 20))
+
+        with self.assertRaises(ValueError):
+            self.connection.get_decimated(ID, 'speed', 1)
+
 
 class DbGetDirectionFromDB(unittest.TestCase):
     '''
@@ -641,6 +866,664 @@ class DbPostDeleteAddTemperatureToDB(unittest.TestCase):
         self.assertFalse(resp)
 
 
+class DbStatementTests(unittest.TestCase):
+    '''
+    Tests for the statement registry and the whitelisted columns
+    '''
+
+    def test_get_statement(self):
+        print('('+self.test_get_statement.__name__+')', \
+              self.test_get_statement.__doc__)
+
+        #the same text every time, so sqlite reuses the prepared statement
+        self.assertIs(dbhandler.get_statement('value', 'speed'), dbhandler.get_statement('value', 'speed'))
+        self.assertIn('"50_speed"', dbhandler.get_statement('value', 'speed'))
+        with self.assertRaises(ValueError):
+            dbhandler.get_statement('value', 'temperature FROM WIND_DEVICES --')
+
+
+    def test_get_range_filter(self):
+        '''
+        The start is included and the end excluded, the values are parameters
+        '''
+        print('('+self.test_get_range_filter.__name__+')', \
+              self.test_get_range_filter.__doc__)
+
+        self.assertEqual(dbhandler.get_range_filter(), ('', []))
+        self.assertEqual(dbhandler.get_range_filter(10, 20), (' AND date >= ? AND date < ?', [10, 20]))
+        self.assertEqual(dbhandler.get_range_filter(None, 20), (' AND date < ?', [20]))
+        self.assertEqual(dbhandler.get_range_filter(10, None, 'bucket'), (' AND bucket >= ?', [10]))
+
+
+    def test_contains_value(self):
+        self.connection = ENGINE.connect()
+
+        print('('+self.test_contains_value.__name__+')', \
+              self.test_contains_value.__doc__)
+
+        self.assertTrue(self.connection.contains_value(ID, TIMESTAMP, 'temperature'))
+        self.assertFalse(self.connection.contains_value(ID, 876, 'temperature'))
+        #values are parameters, not SQL
+        self.assertFalse(self.connection.contains_value(ID, '1 OR 1 = 1', 'temperature'))
+        with self.assertRaises(ValueError):
+            self.connection.contains_value(ID, TIMESTAMP, 'date = 1 OR temperature')
+
+
+    def test_normalize_sql(self):
+        print('('+self.test_normalize_sql.__name__+')', \
+              self.test_normalize_sql.__doc__)
+
+        self.assertEqual(dbhandler.normalize_sql('SELECT date, "50_speed" FROM WIND_DATA\n WHERE date >= 600 '
+                                                 "AND location = 'Oulu' LIMIT -1"),
+                         'SELECT date, "50_speed" FROM WIND_DATA WHERE date >= ? AND location = ? LIMIT ?')
+
+
+    def test_connection_class(self):
+        print('('+self.test_connection_class.__name__+')', \
+              self.test_connection_class.__doc__)
+
+        executed = []
+
+        class CountingConnection(dbhandler.Connection):
+            def _execute(self, query, qvalue=(), row_factory=None):
+                executed.append(query)
+                return super(CountingConnection, self)._execute(query, qvalue, row_factory)
+
+        connection = dbhandler.Engine(DB_BATH, connection_class=CountingConnection).connect()
+        try:
+            self.assertIsInstance(connection, CountingConnection)
+            self.assertEqual(connection.get_speed(ID, TIMESTAMP), SPEED)
+            self.assertEqual(executed, [dbhandler.get_statement('value', 'speed')])
+        finally:
+            connection.close()
+
+
+class DbSchemaMigrationTests(DbTestCase):
+    '''
+    Tests for upgrading the schema of an existing database file
+    '''
+
+    def setUp(self):
+        super(DbSchemaMigrationTests, self).setUp()
+        self.engine = dbhandler.Engine(self.db_path)
+
+    def test_migrate(self):
+        print('('+self.test_migrate.__name__+')', \
+              self.test_migrate.__doc__)
+
+        self.assertEqual(self.engine.get_schema_version(), 0)
+        self.engine.migrate()
+        self.assertEqual(self.engine.get_schema_version(), dbhandler.SCHEMA_VERSION)
+
+        #all rows survive the rebuild
+        connection = self.engine.connect()
+        self.assertEqual(len(connection.get_speeds(ID)), ROWCOUNT)
+        self.assertEqual(connection.get_speed(ID, TIMESTAMP), SPEED)
+        connection.close()
+
+    def test_migrate_twice(self):
+        print('('+self.test_migrate_twice.__name__+')', \
+              self.test_migrate_twice.__doc__)
+
+        self.engine.migrate()
+        self.engine.migrate()
+        self.assertEqual(self.engine.get_schema_version(), dbhandler.SCHEMA_VERSION)
+
+    def test_lookup_uses_primary_key(self):
+        print('('+self.test_lookup_uses_primary_key.__name__+')', \
+              self.test_lookup_uses_primary_key.__doc__)
+
+        connection = self.engine.connect()
+        cur = connection.con.cursor()
+        cur.execute('EXPLAIN QUERY PLAN SELECT * FROM WIND_DATA WHERE device_id = ? AND date = ?', (ID, TIMESTAMP))
+        plan = ' '.join(str(row[-1]) for row in cur.fetchall())
+        connection.close()
+        self.assertIn('SEARCH', plan)
+        self.assertIn('PRIMARY KEY', plan)
+
+    def test_migrate_empty_file(self):
+        print('('+self.test_migrate_empty_file.__name__+')', \
+              self.test_migrate_empty_file.__doc__)
+
+        engine = dbhandler.Engine(os.path.join(self.tmpdir, 'empty.db'))
+        connection = engine.connect()
+        self.assertIsNone(connection.get_speed(ID, TIMESTAMP))
+        connection.close()
+
+    def test_check_sqlite(self):
+        '''
+        An sqlite without upserts or window functions is refused up front
+        '''
+        print('('+self.test_check_sqlite.__name__+')', \
+              self.test_check_sqlite.__doc__)
+
+        dbhandler.check_sqlite()
+        dbhandler.check_sqlite('3.25.0')
+        with self.assertRaisesRegex(RuntimeError, '3.25.0 or later'):
+            dbhandler.check_sqlite('3.24.0')
+        with self.assertRaises(RuntimeError):
+            dbhandler.check_sqlite('3.8.11.1')
+
+
+class DbConnectionPoolTests(DbTestCase):
+    '''
+    Tests for borrowing and returning pooled connections
+    '''
+
+    def setUp(self):
+        super(DbConnectionPoolTests, self).setUp()
+        self.engine = dbhandler.Engine(self.db_path, pool_size=2)
+
+    def tearDown(self):
+        self.engine.dispose()
+        super(DbConnectionPoolTests, self).tearDown()
+
+    def test_acquire_reuses_connection(self):
+        print('('+self.test_acquire_reuses_connection.__name__+')', \
+              self.test_acquire_reuses_connection.__doc__)
+
+        connection = self.engine.acquire()
+        self.assertEqual(connection.get_speed(ID, TIMESTAMP), SPEED)
+        self.engine.release(connection)
+        self.assertEqual(self.engine.pool.idle_count(), 1)
+        self.assertIs(self.engine.acquire(), connection)
+
+    def test_acquire_read_only(self):
+        '''
+        The read only connections come from their own pool and can not write
+        '''
+        print('('+self.test_acquire_read_only.__name__+')', \
+              self.test_acquire_read_only.__doc__)
+
+        engine = dbhandler.Engine(self.db_path, pool_size=1, read_pool_size=2)
+        try:
+            writer = engine.acquire()
+            reader = engine.acquire(0.1, read_only=True)
+            self.assertTrue(reader.read_only)
+            self.assertFalse(writer.read_only)
+            self.assertEqual(reader.get_speed(ID, TIMESTAMP), SPEED)
+            with self.assertRaises(sqlite3.OperationalError):
+                reader.con.execute('DELETE FROM WIND_DATA')
+            engine.release(reader)
+            engine.release(writer)
+            self.assertEqual((engine.pool.idle_count(), engine.read_pool.idle_count()), (1, 1))
+            self.assertIs(engine.acquire(read_only=True), reader)
+        finally:
+            engine.dispose()
+
+        #without a read pool the readers share the pool
+        connection = self.engine.acquire(read_only=True)
+        self.assertFalse(connection.read_only)
+        self.engine.release(connection)
+        self.assertEqual(self.engine.pool.idle_count(), 1)
+
+    def test_acquire_pool_exhausted(self):
+        print('('+self.test_acquire_pool_exhausted.__name__+')', \
+              self.test_acquire_pool_exhausted.__doc__)
+
+        first = self.engine.acquire()
+        second = self.engine.acquire()
+        self.assertIsNot(first, second)
+        with self.assertRaises(dbhandler.PoolTimeoutError):
+            self.engine.acquire(timeout=0.01)
+        self.engine.release(first)
+        self.assertIs(self.engine.acquire(timeout=0.01), first)
+
+    def test_release_rollback(self):
+        print('('+self.test_release_rollback.__name__+')', \
+              self.test_release_rollback.__doc__)
+
+        connection = self.engine.acquire()
+        connection.con.execute('UPDATE WIND_DATA SET temperature = 1 WHERE device_id = ? AND date = ?', (ID, TIMESTAMP))
+        self.engine.release(connection, commit=False)
+        connection = self.engine.acquire()
+        self.assertEqual(connection.get_temperature(ID, TIMESTAMP), TEMPERATURE)
+
+    def test_idle_connection_evicted(self):
+        print('('+self.test_idle_connection_evicted.__name__+')', \
+              self.test_idle_connection_evicted.__doc__)
+
+        self.engine.pool.max_idle = -1
+        connection = self.engine.acquire()
+        self.engine.release(connection)
+        self.assertIsNot(self.engine.acquire(), connection)
+        self.assertTrue(connection.isclosed())
+
+    def test_broken_connection_replaced(self):
+        print('('+self.test_broken_connection_replaced.__name__+')', \
+              self.test_broken_connection_replaced.__doc__)
+
+        connection = self.engine.acquire()
+        self.engine.release(connection)
+        connection.con.close()
+        replacement = self.engine.acquire()
+        self.assertIsNot(replacement, connection)
+        self.assertTrue(replacement.ping())
+
+
+class DbRollupTests(DbTestCase):
+    '''
+    Tests for the hourly and daily rollup tables kept up to date on writes
+    '''
+
+    FUNCTIONS = ['count', 'sum', 'min', 'max', 'mean', 'variance']
+
+    def setUp(self):
+        super(DbRollupTests, self).setUp()
+        self.connection = dbhandler.Engine(self.db_path).connect()
+
+    def tearDown(self):
+        self.connection.close()
+        super(DbRollupTests, self).tearDown()
+
+    def assertRollupsConsistent(self, quantity):
+        for table, width in dbhandler.ROLLUPS:
+            for id in (1, 2):
+                raw = self.connection._get_raw_aggregates(id, quantity, width, self.FUNCTIONS)
+                rollup = self.connection._get_rollup_aggregates(table, id, quantity, width, self.FUNCTIONS)
+                self.assertEqual(len(raw), len(rollup))
+                for a, b in zip(raw, rollup):
+                    self.assertEqual(a['timestamp'], b['timestamp'])
+                    for function in self.FUNCTIONS:
+                        self.assertAlmostEqual(a[function], b[function], places=5)
+
+    def test_rollups_after_migration(self):
+        print('('+self.test_rollups_after_migration.__name__+')', \
+              self.test_rollups_after_migration.__doc__)
+
+        for quantity in dbhandler.QUANTITIES:
+            self.assertRollupsConsistent(quantity)
+
+    def test_rollups_after_modify(self):
+        print('('+self.test_rollups_after_modify.__name__+')', \
+              self.test_rollups_after_modify.__doc__)
+
+        #new maximum, then remove it again
+        self.assertTrue(self.connection.modify_temperature(1, 56, 1000))
+        self.assertRollupsConsistent('temperature')
+        self.assertTrue(self.connection.modify_temperature(1, 56, 10))
+        self.assertRollupsConsistent('temperature')
+        self.assertTrue(self.connection.modify_humidity(1, 56, 0))
+        self.assertRollupsConsistent('humidity')
+
+    def test_rollups_after_delete(self):
+        print('('+self.test_rollups_after_delete.__name__+')', \
+              self.test_rollups_after_delete.__doc__)
+
+        self.assertTrue(self.connection.delete_temperature(1, 56))
+        self.assertRollupsConsistent('temperature')
+        self.assertTrue(self.connection.delete_humidity(1, 56))
+        self.assertRollupsConsistent('humidity')
+
+    def test_rollups_after_add(self):
+        print('('+self.test_rollups_after_add.__name__+')', \
+              self.test_rollups_after_add.__doc__)
+
+        #new timestamp in a new hour and day
+        self.assertTrue(self.connection.add_temperature(1, 200000, 99))
+        self.assertTrue(self.connection.add_humidity(1, 200000, 50))
+        self.assertRollupsConsistent('temperature')
+        self.assertRollupsConsistent('humidity')
+        aggregates = self.connection.get_aggregates(1, 'temperature', 86400, ['count', 'mean'], 86400)
+        self.assertEqual(aggregates, [{'timestamp': 172800, 'count': 1, 'mean': 99.0}])
+
+
+class DbBulkInsertTests(DbTestCase):
+    '''
+    Tests for inserting batches of readings
+    '''
+
+    def setUp(self):
+        super(DbBulkInsertTests, self).setUp()
+        self.connection = dbhandler.Engine(self.db_path).connect()
+
+    def tearDown(self):
+        self.connection.close()
+        super(DbBulkInsertTests, self).tearDown()
+
+    def test_bulk_insert(self):
+        print('('+self.test_bulk_insert.__name__+')', \
+              self.test_bulk_insert.__doc__)
+
+        rows = [{'timestamp': 10000 + i * 600, 'speed': 3.5, 'temperature': 100 + i, 'humidity': 90}
+                for i in range(144)]
+        self.assertEqual(self.connection.bulk_insert(2, rows), 144)
+        self.assertEqual(self.connection.get_temperature(2, 10600), {'timestamp': 10600, 'temperature': 101})
+        self.assertEqual(len(self.connection.get_speeds(2, 10000)), 144)
+
+
+    def test_bulk_insert_replaces(self):
+        print('('+self.test_bulk_insert_replaces.__name__+')', \
+              self.test_bulk_insert_replaces.__doc__)
+
+        rows = iter([{'timestamp': TIMESTAMP, 'speed': 9.5}])
+        self.assertEqual(self.connection.bulk_insert(ID, rows), 1)
+        self.assertEqual(self.connection.get_speed(ID, TIMESTAMP), {'timestamp': TIMESTAMP, 'speed': 9.5})
+        self.assertEqual(self.connection.get_temperature(ID, TIMESTAMP), {'timestamp': TIMESTAMP, 'temperature': None})
+        self.assertEqual(len(self.connection.get_speeds(ID)), ROWCOUNT)
+
+
+    def test_bulk_insert_malformed(self):
+        print('('+self.test_bulk_insert_malformed.__name__+')', \
+              self.test_bulk_insert_malformed.__doc__)
+
+        rows = [{'timestamp': 5000, 'speed': 1.0}, {'timestamp': 'j', 'speed': 1.0}]
+        with self.assertRaises(ValueError):
+            self.connection.bulk_insert(ID, rows)
+        with self.assertRaises(ValueError):
+            self.connection.bulk_insert(ID, [{'timestamp': 5000, 'wind': 1.0}])
+        with self.assertRaises(ValueError):
+            self.connection.bulk_insert("j", [])
+        with self.assertRaises(ValueError):
+            self.connection.bulk_insert(ID, [{'timestamp': 5000, 'speed': 1.0}, {'timestamp': 5600, 'speed': [1]}])
+        with self.assertRaises(ValueError):
+            self.connection.bulk_insert(ID, [{'timestamp': 5000, 'temperature': {'value': 1}}])
+
+        #nothing was written
+        self.assertIsNone(self.connection.get_speed(ID, 5000))
+
+
+class DbBatchModifyTests(DbTestCase):
+    '''
+    Tests for editing batches of temperature and humidity values
+    '''
+
+    def setUp(self):
+        super(DbBatchModifyTests, self).setUp()
+        self.connection = dbhandler.Engine(self.db_path).connect()
+
+    def tearDown(self):
+        self.connection.close()
+        super(DbBatchModifyTests, self).tearDown()
+
+    def test_batch_modify(self):
+        print('('+self.test_batch_modify.__name__+')', \
+              self.test_batch_modify.__doc__)
+
+        operations = [{'timestamp': TIMESTAMP, 'field': 'temperature', 'value': 120},
+                      {'timestamp': 2, 'field': 'humidity', 'value': None},
+                      {'timestamp': 2, 'field': 'humidity', 'value': None},
+                      {'timestamp': 5000, 'field': 'temperature', 'value': 90},
+                      {'timestamp': 5000, 'field': 'humidity', 'value': 60}]
+        self.assertEqual(self.connection.batch_modify(ID, operations), [204, 204, 404, 201, 204])
+        self.assertEqual(self.connection.get_temperature(ID, TIMESTAMP), {'timestamp': TIMESTAMP, 'temperature': 120})
+        self.assertFalse(self.connection.contains_value(ID, 2, 'humidity'))
+        self.assertEqual(self.connection.get_humidity(ID, 5000), {'timestamp': 5000, 'humidity': 60})
+
+
+    def test_batch_modify_malformed(self):
+        print('('+self.test_batch_modify_malformed.__name__+')', \
+              self.test_batch_modify_malformed.__doc__)
+
+        operations = [{'timestamp': 'j', 'field': 'temperature', 'value': 1},
+                      {'timestamp': TIMESTAMP, 'field': 'speed', 'value': 1},
+                      {'timestamp': TIMESTAMP, 'field': 'temperature'},
+                      'temperature',
+                      {'timestamp': TIMESTAMP, 'field': 'temperature', 'value': 130}]
+        self.assertEqual(self.connection.batch_modify(ID, operations), [400, 400, 400, 400, 204])
+        self.assertEqual(self.connection.get_speed(ID, TIMESTAMP), SPEED)
+        with self.assertRaises(ValueError):
+            self.connection.batch_modify("j", [])
+        with self.assertRaises(ValueError):
+            self.connection.batch_modify(ID, {})
+
+
+    def test_batch_modify_locked(self):
+        '''
+        The rows are read in the write transaction, after the other writers
+        '''
+        print('('+self.test_batch_modify_locked.__name__+')', \
+              self.test_batch_modify_locked.__doc__)
+
+        operations = [{'timestamp': TIMESTAMP, 'field': 'temperature', 'value': 120}]
+        other = sqlite3.connect(self.db_path, isolation_level=None)
+        try:
+            other.execute('BEGIN IMMEDIATE')
+            other.execute('DELETE FROM WIND_DATA WHERE device_id = ? AND date = ?', (ID, TIMESTAMP))
+            self.connection.con.execute('PRAGMA busy_timeout = 100')
+            self.assertIsNone(self.connection.batch_modify(ID, operations))
+            self.assertFalse(self.connection.con.in_transaction)
+            other.execute('COMMIT')
+        finally:
+            other.close()
+
+        #the row deleted by the other writer is added again
+        self.assertEqual(self.connection.batch_modify(ID, operations), [201])
+        self.assertEqual(self.connection.get_temperature(ID, TIMESTAMP), {'timestamp': TIMESTAMP, 'temperature': 120})
+
+
+class DbEngineProfileTests(DbTestCase):
+    '''
+    Tests for the connection profiles of the Engine
+    '''
+
+    def setUp(self):
+        super(DbEngineProfileTests, self).setUp()
+        self.engine = dbhandler.Engine(self.db_path, profile='performance', checkpoint_interval=0)
+
+    def tearDown(self):
+        self.engine.dispose()
+        super(DbEngineProfileTests, self).tearDown()
+
+    def test_performance_profile(self):
+        print('('+self.test_performance_profile.__name__+')', \
+              self.test_performance_profile.__doc__)
+
+        connection = self.engine.acquire()
+        self.assertEqual(connection.con.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+        #NORMAL
+        self.assertEqual(connection.con.execute('PRAGMA synchronous').fetchone()[0], 1)
+        self.assertEqual(connection.con.execute('PRAGMA cache_size').fetchone()[0], -65536)
+        self.engine.release(connection)
+
+    def test_read_while_writing(self):
+        print('('+self.test_read_while_writing.__name__+')', \
+              self.test_read_while_writing.__doc__)
+
+        writer = self.engine.acquire()
+        reader = self.engine.acquire()
+        writer.con.execute('UPDATE WIND_DATA SET temperature = 1 WHERE device_id = ? AND date = ?', (ID, TIMESTAMP))
+        #the open write transaction does not block readers
+        self.assertEqual(reader.get_temperature(ID, TIMESTAMP), TEMPERATURE)
+        self.engine.release(writer)
+        self.engine.release(reader)
+        self.assertEqual(self.engine.connect().get_temperature(ID, TIMESTAMP), {'timestamp': TIMESTAMP, 'temperature': 1})
+
+    def test_checkpoint(self):
+        print('('+self.test_checkpoint.__name__+')', \
+              self.test_checkpoint.__doc__)
+
+        connection = self.engine.acquire()
+        connection.modify_temperature(ID, TIMESTAMP, 1)
+        self.engine.release(connection)
+        busy, log, checkpointed = self.engine.checkpoint(mode='TRUNCATE')
+        self.assertEqual(busy, 0)
+        self.assertEqual(os.path.getsize(self.db_path + '-wal'), 0)
+
+    def test_unknown_profile(self):
+        print('('+self.test_unknown_profile.__name__+')', \
+              self.test_unknown_profile.__doc__)
+
+        with self.assertRaises(ValueError):
+            dbhandler.Engine(self.db_path, profile='fastest')
+
+
+class DbDataVersionTests(DbTestCase):
+    '''
+    Tests for the data version of devices used by conditional requests
+    '''
+
+    def setUp(self):
+        super(DbDataVersionTests, self).setUp()
+        self.connection = dbhandler.Engine(self.db_path).connect()
+
+    def tearDown(self):
+        self.connection.close()
+        super(DbDataVersionTests, self).tearDown()
+
+    def test_get_data_version(self):
+        print('('+self.test_get_data_version.__name__+')', \
+              self.test_get_data_version.__doc__)
+
+        version, modified = self.connection.get_data_version(ID)
+        self.assertEqual(version, 1)
+        self.assertIsNotNone(modified)
+        self.assertEqual(self.connection.get_data_version(3), (0, None))
+
+    def test_data_version_bumped_on_write(self):
+        print('('+self.test_data_version_bumped_on_write.__name__+')', \
+              self.test_data_version_bumped_on_write.__doc__)
+
+        self.connection.modify_temperature(ID, 56, 99)
+        self.assertEqual(self.connection.get_data_version(ID)[0], 2)
+        self.connection.delete_humidity(ID, 56)
+        self.assertEqual(self.connection.get_data_version(ID)[0], 3)
+        self.connection.add_temperature(ID, 5000, 99)
+        self.assertEqual(self.connection.get_data_version(ID)[0], 4)
+        self.connection.bulk_insert(3, [{'timestamp': 1, 'speed': 1.0}])
+        self.assertEqual(self.connection.get_data_version(3)[0], 1)
+
+        #other devices are not changed
+        self.assertEqual(self.connection.get_data_version(2)[0], 1)
+
+    def test_data_version_not_bumped_on_read(self):
+        print('('+self.test_data_version_not_bumped_on_read.__name__+')', \
+              self.test_data_version_not_bumped_on_read.__doc__)
+
+        self.connection.get_speeds(ID)
+        self.connection.get_aggregates(ID, 'speed', 3600, ['mean'])
+        self.assertEqual(self.connection.get_data_version(ID)[0], 1)
+
+
+
+class DbSyntheticDataTests(unittest.TestCase):
+    '''
+    Tests for generating synthetic data for the benchmarks
+    '''
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.tmpdir)
+
+    def test_populate_synthetic(self):
+        '''
+        An empty database file gets the devices and a reading every 10 minutes
+        '''
+        print('('+self.test_populate_synthetic.__name__+')', \
+              self.test_populate_synthetic.__doc__)
+
+        engine = dbhandler.Engine(os.path.join(self.tmpdir, 'synthetic.db'))
+        self.assertEqual(engine.populate_synthetic(devices=2, years=0.01), 2 * 525)
+
+        connection = engine.connect()
+        try:
+            self.assertEqual([d['device_id'] for d in connection.get_devices()], [1, 2])
+            speeds = connection.get_speeds(2)
+            self.assertEqual(len(speeds), 525)
+            self.assertEqual(speeds[1]['timestamp'] - speeds[0]['timestamp'], dbhandler.SYNTHETIC_INTERVAL)
+            #the rollups are filled by the triggers
+            days = connection.get_aggregates(1, 'temperature', 86400, ['count'])
+            self.assertEqual(sum(day['count'] for day in days), 525)
+        finally:
+            connection.close()
+
+    def test_populate_synthetic_reproducible(self):
+        '''
+        The same seed gives the same readings
+        '''
+        print('('+self.test_populate_synthetic_reproducible.__name__+')', \
+              self.test_populate_synthetic_reproducible.__doc__)
+
+        readings = []
+        for name in ('a.db', 'b.db'):
+            engine = dbhandler.Engine(os.path.join(self.tmpdir, name))
+            self.assertEqual(engine.populate_synthetic(seed=7, readings=144), 144)
+            connection = engine.connect()
+            readings.append(connection.get_temperatures(1))
+            connection.close()
+        self.assertEqual(len(readings[0]), 144)
+        self.assertEqual(readings[0], readings[1])
+
+
+class DbSlowQueryLogTests(DbTestCase):
+    '''
+    Tests for logging the slow statements with their query plan
+    '''
+
+    def test_slow_query_log_disabled(self):
+        print('('+self.test_slow_query_log_disabled.__name__+')', \
+              self.test_slow_query_log_disabled.__doc__)
+
+        engine = dbhandler.Engine(self.db_path)
+        self.assertIsNone(engine.slow_queries)
+        connection = engine.connect()
+        self.assertIsNone(connection.slow_query_log)
+        connection.close()
+
+    def test_slow_query_log(self):
+        '''
+        With threshold 0 every statement is slow
+        '''
+        print('('+self.test_slow_query_log.__name__+')', \
+              self.test_slow_query_log.__doc__)
+
+        engine = dbhandler.Engine(self.db_path, slow_query_threshold=0)
+        connection = engine.connect()
+        try:
+            with self.assertLogs('wind.slow_queries', 'WARNING') as logs:
+                connection.get_speed(ID, TIMESTAMP)
+                connection.get_speed(ID, 600)
+                connection.get_pressure(TIMESTAMP)
+                connection.bulk_insert(3, [{'timestamp': 1, 'speed': 1.0}])
+        finally:
+            connection.close()
+
+        self.assertEqual(len(logs.records), 4)
+        self.assertIn('parameters [1', logs.output[0])
+        statements = dict((s['sql'], s) for s in engine.slow_queries.stats())
+        self.assertEqual(len(statements), 3)
+
+        #the primary key is searched with a device, the table is scanned without
+        speed = statements[dbhandler.get_statement('value', 'speed')]
+        self.assertEqual(speed['count'], 2)
+        self.assertEqual(speed['parameters'], [600, ID])
+        self.assertTrue(any(step.startswith('SEARCH') for step in speed['plan']))
+        self.assertEqual(speed['full_scans'], [])
+        pressure = statements[dbhandler.get_statement('value_any_device', 'pressure')]
+        self.assertEqual(pressure['full_scans'], ['WIND_DATA'])
+
+        engine.slow_queries.clear()
+        self.assertEqual(engine.slow_queries.stats(), [])
+
+    def test_slow_query_log_rows(self):
+        '''
+        The time of a query includes fetching its rows
+        '''
+        print('('+self.test_slow_query_log_rows.__name__+')', \
+              self.test_slow_query_log_rows.__doc__)
+
+        engine = dbhandler.Engine(self.db_path, slow_query_threshold=0.05)
+        connection = engine.connect()
+        #every row takes 1 ms, the query is fast up to its first row
+        connection.con.create_function('slow', 1, lambda value: time.sleep(0.001) or value)
+        try:
+            with self.assertLogs('wind.slow_queries', 'WARNING') as logs:
+                cur = connection._execute('SELECT slow(date) FROM WIND_DATA WHERE device_id = ?', (ID,))
+                self.assertIsNotNone(cur.fetchone())
+                self.assertEqual(engine.slow_queries.stats(), [])
+                rows = [row for row in cur]
+        finally:
+            connection.close()
+
+        self.assertEqual(len(rows), ROWCOUNT - 1)
+        self.assertEqual(len(logs.records), 1)
+        statements = engine.slow_queries.stats()
+        self.assertEqual(len(statements), 1)
+        self.assertEqual(statements[0]['count'], 1)
+        self.assertGreaterEqual(statements[0]['max_ms'], (ROWCOUNT - 1) * 1)
+
 
 if __name__ == '__main__':
     print('Start running message tests')
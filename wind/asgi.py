@@ -0,0 +1,203 @@
+# ASGI serving mode of the wind API
+#
+# In the project wind folder, with an ASGI server installed (e.g. pip install uvicorn):
+#
+#   uvicorn asgi:application --port 5000
+#
+# or python asgi.py
+
+import asyncio, sys, tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+import resourcess
+
+# Request bodies larger than this are spooled to a temporary file
+MAX_BODY_IN_MEMORY = 1024 * 1024
+
+
+class AsgiAdapter(object):
+    '''
+    Serves a WSGI application (the Flask app) as an ASGI application.
+
+    The event loop only receives requests and sends responses. Each request
+    is handled by the WSGI application on a bounded thread pool, so a slow
+    request (e.g. a full history) keeps one worker thread busy while the
+    other requests are served by the others. The body of a response is sent
+    chunk by chunk while the application produces it, so the streamed
+    collections are not buffered; the worker waits until each chunk has
+    been sent.
+
+    :param wsgi_app: the WSGI application
+    :param max_workers: number of worker threads. It should not be larger
+        than the connection pool of the Engine, otherwise the workers wait
+        for database connections
+    :param on_shutdown: function called when the server shuts down
+    '''
+
+    def __init__(self, wsgi_app, max_workers, on_shutdown=None):
+        super(AsgiAdapter, self).__init__()
+        self.wsgi_app = wsgi_app
+        self.max_workers = max_workers
+        self.on_shutdown = on_shutdown
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='wind-asgi')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self.http(scope, receive, send)
+        else:
+            raise ValueError("Unsupported ASGI scope %s" % scope['type'])
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                #off the event loop, which must keep sending the responses
+                #the workers are waiting on
+                await asyncio.get_running_loop().run_in_executor(None, self.shutdown)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def shutdown(self):
+        '''
+        Waits for the requests being handled and calls on_shutdown.
+        '''
+        self.executor.shutdown(wait=True)
+        if self.on_shutdown is not None:
+            self.on_shutdown()
+
+    async def http(self, scope, receive, send):
+        body = await self.read_body(receive)
+        if body is None:
+            #the client went away before sending the whole body, a partial
+            #body must not reach the application (e.g. a truncated POST)
+            return
+        environ = self.get_environ(scope, body)
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(self.executor, self.run_wsgi, environ, send, loop)
+        finally:
+            body.close()
+
+    async def read_body(self, receive):
+        '''
+        :return: file with the whole request body, at the start, or None if
+            the client disconnected before sending all of it
+        '''
+        body = tempfile.SpooledTemporaryFile(max_size=MAX_BODY_IN_MEMORY)
+        more_body = True
+        while more_body:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                body.close()
+                return None
+            body.write(message.get('body', b''))
+            more_body = message.get('more_body', False)
+        body.seek(0)
+        return body
+
+    def get_environ(self, scope, body):
+        '''
+        Creates the WSGI environ of an ASGI http scope (PEP 3333).
+        '''
+        server = scope.get('server') or ('localhost', 80)
+        client = scope.get('client') or ('', 0)
+        #WSGI strings are bytes decoded as latin-1
+        path = scope['path'].encode('utf-8').decode('latin-1')
+        root_path = scope.get('root_path', '')
+        if root_path and path.startswith(root_path):
+            path = path[len(root_path):]
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': root_path,
+            'PATH_INFO': path,
+            'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+            'SERVER_NAME': server[0],
+            'SERVER_PORT': str(server[1]),
+            'REMOTE_ADDR': client[0],
+            'SERVER_PROTOCOL': 'HTTP/%s' % scope.get('http_version', '1.1'),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': body,
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+        for name, value in scope.get('headers', []):
+            name = name.decode('latin-1').upper().replace('-', '_')
+            value = value.decode('latin-1')
+            if name == 'CONTENT_TYPE' or name == 'CONTENT_LENGTH':
+                key = name
+            else:
+                key = 'HTTP_' + name
+            #repeated headers are joined as in a single header
+            environ[key] = environ[key] + ',' + value if key in environ else value
+        #the whole body has been read, also chunked uploads have a length now
+        environ['CONTENT_LENGTH'] = str(body.seek(0, 2))
+        body.seek(0)
+        return environ
+
+    def run_wsgi(self, environ, send, loop):
+        '''
+        Runs the WSGI application in a worker thread and sends the response
+        through the event loop.
+        '''
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info is not None and response.get('started'):
+                raise exc_info[1].with_traceback(exc_info[2])
+            response['status'] = int(status.split(' ', 1)[0])
+            response['headers'] = [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                                   for name, value in headers]
+
+        def send_message(message):
+            asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+        def start():
+            if not response.get('started'):
+                send_message({'type': 'http.response.start', 'status': response['status'],
+                              'headers': response['headers']})
+                response['started'] = True
+
+        result = self.wsgi_app(environ, start_response)
+        try:
+            for chunk in result:
+                if chunk:
+                    start()
+                    send_message({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            start()
+            send_message({'type': 'http.response.body', 'body': b''})
+        except OSError:
+            #the client went away
+            pass
+        finally:
+            #the request teardown gives the database connection back to the pool
+            if hasattr(result, 'close'):
+                result.close()
+
+
+def create_application(app=resourcess.app):
+    '''
+    :return: the ASGI application of the Flask app. The number of worker threads
+        is app.config["ASGI_WORKERS"], by default the size of the connection pool
+    '''
+    engine = app.config["Engine"]
+    workers = app.config.get("ASGI_WORKERS") or engine.pool.size
+    return AsgiAdapter(app, workers, on_shutdown=engine.dispose)
+
+
+application = create_application()
+
+
+#run app
+if __name__ == '__main__':
+    try:
+        import uvicorn
+    except ImportError:
+        sys.exit("The ASGI mode needs an ASGI server: pip install uvicorn")
+    uvicorn.run(application, port=5000)
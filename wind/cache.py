@@ -0,0 +1,117 @@
+# In-process cache of API responses
+
+from collections import OrderedDict
+import time, threading
+
+# Defaults for the response cache
+DEFAULT_MAX_ENTRIES = 512
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+DEFAULT_TTL = 300
+
+
+class ResponseCache(object):
+    '''
+    LRU cache of response bodies, bounded by the number of entries and by
+    the total size of the bodies. Entries expire after ttl seconds.
+
+    An entry belongs to a device and is stored with the data version of the
+    device (see :py:meth:`dbhandler.Connection.get_data_version`). It is only
+    returned while the version is the same, so an entry is never served after
+    the data changed, even if the change was made by another process.
+    Writes through this process also drop the entries of the device at once
+    with :py:meth:`invalidate_device`.
+
+    :Example:
+
+    >>> cache = ResponseCache()
+    >>> cache.put(('/wind/api/device/1/speeds/', ()), '1', 3, b'{}', 200, [])
+    >>> cache.get(('/wind/api/device/1/speeds/', ()), 3)
+    (b'{}', 200, [])
+
+    :param max_entries: maximum number of responses kept
+    :param max_bytes: maximum total size of the bodies kept
+    :param ttl: seconds a response is kept
+    '''
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, max_bytes=DEFAULT_MAX_BYTES, ttl=DEFAULT_TTL):
+        super(ResponseCache, self).__init__()
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        #key -> (expires, device id, version, body, status, headers), least recently used first
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key, version=None):
+        '''
+        :param key: (path, query parameters, representation)
+        :param version: current data version of the device
+        :return: (body, status, headers) or None if there is no valid entry
+        '''
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and (entry[0] < time.time() or entry[2] != version):
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[3:]
+
+    def put(self, key, device_id, version, body, status, headers):
+        '''
+        Stores a response. Bodies larger than max_bytes are not stored.
+
+        :param device_id: device the response belongs to, None if it belongs to no device
+        :param version: data version of the device the body was built from
+        :param body: bytes of the response body
+        :param headers: list of (name, value) restored on a hit
+        '''
+        if len(body) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.time() + self.ttl, device_id, version, body, status, headers)
+            self._bytes += len(body)
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate_device(self, device_id):
+        '''
+        Drops all the responses of a device.
+        '''
+        with self._lock:
+            keys = [key for key, entry in self._entries.items() if entry[1] == device_id]
+            for key in keys:
+                self._remove(key)
+            self.invalidations += len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        '''
+        :return: dict with the number of entries, their size and the hit/miss counters
+        '''
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'entries': len(self._entries), 'bytes': self._bytes,
+                    'max_entries': self.max_entries, 'max_bytes': self.max_bytes, 'ttl': self.ttl,
+                    'hits': self.hits, 'misses': self.misses,
+                    'hit_ratio': float(self.hits) / lookups if lookups else None,
+                    'evictions': self.evictions, 'invalidations': self.invalidations}
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self._bytes -= len(entry[3])
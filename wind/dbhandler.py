@@ -1,11 +1,351 @@
 # Provides the database API to access wind data
 
 from datetime import datetime
-import time, sqlite3, re, os
+from collections import deque, OrderedDict
+from array import array
+from functools import lru_cache
+import time, sqlite3, re, os, threading, json, math, random, logging
 
 # Default path for db
 DEFAULT_DB_PATH = '../db/PWP_DATA.db'
 
+# Defaults for the connection pool of the Engine
+DEFAULT_POOL_SIZE = 8
+DEFAULT_MAX_IDLE = 300
+
+# Size of the prepared statement cache of each connection (sqlite3 cached_statements).
+# Large enough for STATEMENTS for every quantity and the variants of the range queries
+DEFAULT_CACHED_STATEMENTS = 256
+
+# Logger of the statements slower than the slow_query_threshold of the Engine
+slow_query_logger = logging.getLogger('wind.slow_queries')
+
+# Maximum number of different statements kept by a SlowQueryLog
+DEFAULT_MAX_SLOW_STATEMENTS = 500
+
+# Rows fetched at a time when a timed query is iterated
+SLOW_QUERY_FETCH_SIZE = 256
+
+# Number of queries whose normalize_sql result is cached
+NORMALIZED_STATEMENTS = 1024
+
+# Connection profiles of the Engine: name -> PRAGMAs run on every new connection.
+# performance: readers are not blocked by the writer (WAL), a commit does not
+# wait for fsync of the database file, 64 MB page cache and 256 MB memory map
+PROFILES = {
+    'default': (),
+    'performance': (
+        ('journal_mode', 'WAL'),
+        ('synchronous', 'NORMAL'),
+        ('cache_size', -65536),
+        ('mmap_size', 268435456),
+        ('temp_store', 'MEMORY'),
+    ),
+}
+
+# Rows read at a time into the arrays of Connection.get_series_arrays
+ARRAY_FETCH_SIZE = 4096
+
+# PRAGMAs added to the connections of the read pool of the Engine, they can not write
+READ_ONLY_PRAGMAS = (('query_only', 'ON'),)
+
+# Columns of WIND_DATA in table order
+WIND_DATA_COLUMNS = ('date', 'battery_voltage', 'temperature', 'humidity', 'pressure', '"50_speed"',
+                     '"50_direction"', '"50_std_speed"', '"50_vertical_velocity"', '"50_std_w"',
+                     '"50_quality"', 'device_id')
+
+
+# Quantities measured in WIND_DATA: name used in the API -> column
+QUANTITIES = {
+    'speed': '"50_speed"',
+    'direction': '"50_direction"',
+    'battery': 'battery_voltage',
+    'temperature': 'temperature',
+    'humidity': 'humidity',
+    'pressure': 'pressure',
+    'std_speed': '"50_std_speed"',
+    'vertical_velocity': '"50_vertical_velocity"',
+    'std_vertical_velocity': '"50_std_w"',
+    'quality': '"50_quality"',
+}
+
+# Statements of Connection: name -> SQL. {column} is replaced by a column of
+# QUANTITIES by get_statement, the values are always passed as parameters
+STATEMENTS = {
+    'device': 'SELECT * FROM WIND_DEVICES WHERE device_id = ?',
+    'devices': 'SELECT * FROM WIND_DEVICES',
+    'contains_timestamp': 'SELECT 1 FROM WIND_DATA WHERE device_id = ? AND date = ?',
+    'value': 'SELECT date, {column} FROM WIND_DATA WHERE date = ? AND device_id = ?',
+    'value_any_device': 'SELECT date, {column} FROM WIND_DATA WHERE date = ?',
+    'set_value': 'UPDATE WIND_DATA SET {column} = ? WHERE device_id = ? AND date = ?',
+    'insert_value': 'INSERT INTO WIND_DATA (device_id, date, {column}) VALUES (?, ?, ?)',
+    'data_version': 'SELECT version, modified FROM WIND_DATA_VERSIONS WHERE device_id = ?',
+    'previous_start': 'SELECT MIN(date) FROM (SELECT date FROM WIND_DATA WHERE device_id = ? AND date < ? '
+                      'ORDER BY date DESC LIMIT ?)',
+    #the timestamps as one JSON array parameter, so the text is the same for any number of them.
+    #The columns are EDITABLE_QUANTITIES
+    'editable_values': 'SELECT date, temperature, humidity FROM WIND_DATA '
+                       'WHERE device_id = ? AND date IN (SELECT value FROM json_each(?))',
+}
+
+# Quantities that can be edited one value at a time, see Connection.batch_modify
+EDITABLE_QUANTITIES = ('temperature', 'humidity')
+
+
+@lru_cache(maxsize=None)
+def get_statement(name, quantity=None):
+    '''
+    Builds the SQL of a statement of :py:data:`STATEMENTS`. The same text is
+    returned for the same arguments, so sqlite finds the prepared statement
+    in the statement cache of the connection instead of compiling it again.
+
+    :param name: key of :py:data:`STATEMENTS`
+    :param quantity: key of :py:data:`QUANTITIES` for the statements with a {column}
+    :raises ValueError: if the quantity is not a key of :py:data:`QUANTITIES`
+    '''
+    if quantity is None:
+        return STATEMENTS[name]
+    if quantity not in QUANTITIES:
+        raise ValueError("Unknown quantity %s" % quantity)
+    return STATEMENTS[name].format(column=QUANTITIES[quantity])
+
+
+def get_range_filter(start=None, end=None, column='date'):
+    '''
+    Builds the condition of the time range of the range queries, the start
+    included and the end excluded. The text only depends on which of them
+    are given, so the queries stay in the statement cache of the connection.
+
+    :param start: first included timestamp or None
+    :param end: first excluded timestamp or None
+    :param column: the timestamp column, e.g. bucket of the rollup tables
+    :return: (SQL " AND ..." to add to a WHERE clause, list of its values)
+    '''
+    condition = ''
+    qvalue = []
+    if start is not None:
+        condition += ' AND {} >= ?'.format(column)
+        qvalue.append(start)
+    if end is not None:
+        condition += ' AND {} < ?'.format(column)
+        qvalue.append(end)
+    return condition, qvalue
+
+
+@lru_cache(maxsize=NORMALIZED_STATEMENTS)
+def normalize_sql(query):
+    '''
+    :return: the query with its literal numbers and strings replaced by ?
+        and the whitespace collapsed, so the statements that only differ
+        by their values are counted together. The results are cached, the
+        queries are mostly the texts of :py:data:`STATEMENTS`
+    '''
+    query = re.sub(r"'(?:[^']|'')*'", '?', query)
+    query = re.sub(r'(?<![\w"])-?\d+(?:\.\d+)?(?![\w"])', '?', query)
+    return ' '.join(query.split())
+
+
+# Aggregate functions of get_aggregates: name -> (SQL over the numeric values v
+# of WIND_DATA, SQL over the rows of a rollup table)
+AGGREGATES = {
+    'mean': ('AVG(v)', 'SUM(total) / SUM(count)'),
+    'min': ('MIN(v)', 'MIN(minimum)'),
+    'max': ('MAX(v)', 'MAX(maximum)'),
+    'count': ('COUNT(v)', 'SUM(count)'),
+    'sum': ('SUM(v)', 'SUM(total)'),
+    'variance': ('AVG(v * v) - AVG(v) * AVG(v)',
+                 'SUM(sum_squares) / SUM(count) - (SUM(total) / SUM(count)) * (SUM(total) / SUM(count))'),
+}
+
+# Rollup tables kept up to date by triggers on WIND_DATA: (table, bucket width in seconds)
+ROLLUPS = (('WIND_ROLLUP_DAILY', 86400), ('WIND_ROLLUP_HOURLY', 3600))
+
+# Synthetic data of Engine.populate_synthetic: first timestamp (2017-01-01 UTC)
+# and seconds between the readings, the resolution of the stations
+SYNTHETIC_START = 1483228800
+SYNTHETIC_INTERVAL = 600
+
+
+def synthetic_readings(rng, start, count, interval=SYNTHETIC_INTERVAL):
+    '''
+    Generates plausible readings of a station: a daily temperature cycle,
+    slowly changing wind speed and direction and noise on everything.
+
+    :param rng: random.Random, the same seed gives the same readings
+    :param start: timestamp of the first reading
+    :param count: number of readings
+    :return: generator of dicts as accepted by :py:meth:`Connection.bulk_insert`
+    '''
+    speed = rng.uniform(3, 8)
+    direction = rng.uniform(0, 360)
+    for i in range(count):
+        timestamp = start + i * interval
+        day = 2 * math.pi * (timestamp % 86400) / 86400
+        speed = min(max(speed + rng.gauss(0, 0.3), 0.0), 30.0)
+        direction = (direction + rng.gauss(0, 5)) % 360
+        yield {'timestamp': timestamp,
+               'speed': round(speed, 2),
+               'direction': round(direction, 1),
+               'battery': rng.randint(1200, 1300),
+               'temperature': int(100 - 50 * math.cos(day) + rng.gauss(0, 5)),
+               'humidity': min(max(int(80 + 15 * math.cos(day) + rng.gauss(0, 3)), 0), 100),
+               'pressure': rng.randint(990, 1030),
+               'std_speed': round(abs(rng.gauss(0.4, 0.1)), 2),
+               'vertical_velocity': round(rng.gauss(0, 0.05), 2),
+               'std_vertical_velocity': round(abs(rng.gauss(0.2, 0.05)), 2),
+               'quality': rng.randint(90, 110)}
+
+
+# SCHEMA MIGRATIONS
+# Each migration upgrades the schema by one version. The version of a database
+# file is stored in PRAGMA user_version, so a file at version n only runs
+# migrations n+1 ... SCHEMA_VERSION. Never edit an existing migration, add a new one.
+
+def _migration_1(con):
+    '''
+    Rebuilds WIND_DATA as a WITHOUT ROWID table clustered on (device_id, date).
+
+    Point lookups (device_id = ? AND date = ?) and per-device range scans
+    become primary key searches instead of full table scans. Rows without
+    device_id or date can not be addressed by the API and are dropped, and of
+    duplicated (device_id, date) rows the first one is kept.
+    '''
+    create = 'CREATE TABLE {} (date INTEGER NOT NULL, battery_voltage INTEGER, temperature INTEGER, ' \
+             'humidity INTEGER, pressure INTEGER, "50_speed" DOUBLE, "50_direction" DOUBLE, ' \
+             '"50_std_speed" DOUBLE, "50_vertical_velocity" DOUBLE, "50_std_w" DOUBLE, ' \
+             '"50_quality" INTEGER, device_id INTEGER NOT NULL, PRIMARY KEY (device_id, date)) WITHOUT ROWID'
+
+    cur = con.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'WIND_DATA'")
+    if cur.fetchone() is None:
+        #empty database file, just create the table
+        con.execute(create.format('WIND_DATA'))
+        return
+
+    columns = ', '.join(WIND_DATA_COLUMNS)
+    con.execute(create.format('WIND_DATA_new'))
+    con.execute('INSERT OR IGNORE INTO WIND_DATA_new ({0}) SELECT {0} FROM WIND_DATA '
+                'WHERE device_id IS NOT NULL AND date IS NOT NULL'.format(columns))
+    con.execute('DROP TABLE WIND_DATA')
+    con.execute('ALTER TABLE WIND_DATA_new RENAME TO WIND_DATA')
+
+
+def _migration_2(con):
+    '''
+    Creates the hourly and daily rollup tables of every quantity and the
+    triggers that keep them up to date.
+
+    A rollup row holds count, sum, min, max and sum of squares of the valid
+    values of one quantity of a device in one bucket. The triggers apply
+    each insert, update and delete of WIND_DATA as a delta, whoever does the
+    write. Only min and max can not be undone by a delta: when the removed
+    value was the min or the max of its bucket, they are recomputed from the
+    rows of that one bucket, which is a primary key range scan.
+    '''
+
+    for table, width in ROLLUPS:
+        con.execute('CREATE TABLE {} (device_id INTEGER NOT NULL, quantity TEXT NOT NULL, '
+                    'bucket INTEGER NOT NULL, count INTEGER NOT NULL, total REAL NOT NULL, minimum REAL, '
+                    'maximum REAL, sum_squares REAL NOT NULL, PRIMARY KEY (device_id, quantity, bucket)) '
+                    'WITHOUT ROWID'.format(table))
+
+        for quantity, column in sorted(QUANTITIES.items()):
+            #backfill from the existing rows
+            con.execute("INSERT INTO {0} SELECT device_id, ?, (date / {1}) * {1} AS b, COUNT(v), SUM(v), MIN(v), "
+                        "MAX(v), SUM(v * v) FROM (SELECT device_id, date, CAST({2} AS REAL) AS v FROM WIND_DATA "
+                        "WHERE {2} IS NOT NULL AND {2} != '') GROUP BY device_id, b".format(table, width, column),
+                        (quantity,))
+
+    for quantity, column in sorted(QUANTITIES.items()):
+        add = []
+        remove = []
+        for table, width in ROLLUPS:
+            add.append("INSERT INTO {0} (device_id, quantity, bucket, count, total, minimum, maximum, sum_squares) "
+                       "SELECT NEW.device_id, '{2}', (NEW.date / {1}) * {1}, 1, v, v, v, v * v "
+                       "FROM (SELECT CAST(NEW.{3} AS REAL) AS v) WHERE NEW.{3} IS NOT NULL AND NEW.{3} != '' "
+                       "ON CONFLICT (device_id, quantity, bucket) DO UPDATE SET count = count + 1, "
+                       "total = total + excluded.total, minimum = min(minimum, excluded.minimum), "
+                       "maximum = max(maximum, excluded.maximum), "
+                       "sum_squares = sum_squares + excluded.sum_squares;".format(table, width, quantity, column))
+            bucket_values = "(SELECT {{0}}(CAST({1} AS REAL)) FROM WIND_DATA WHERE device_id = OLD.device_id " \
+                            "AND date >= bucket AND date < bucket + {0} AND {1} IS NOT NULL AND {1} != '')" \
+                            .format(width, column)
+            remove.append("UPDATE {0} SET count = count - 1, total = total - CAST(OLD.{3} AS REAL), "
+                          "sum_squares = sum_squares - CAST(OLD.{3} AS REAL) * CAST(OLD.{3} AS REAL), "
+                          "minimum = CASE WHEN CAST(OLD.{3} AS REAL) <= minimum THEN {4} ELSE minimum END, "
+                          "maximum = CASE WHEN CAST(OLD.{3} AS REAL) >= maximum THEN {5} ELSE maximum END "
+                          "WHERE device_id = OLD.device_id AND quantity = '{2}' AND bucket = (OLD.date / {1}) * {1} "
+                          "AND OLD.{3} IS NOT NULL AND OLD.{3} != '';"
+                          .format(table, width, quantity, column, bucket_values.format('MIN'),
+                                  bucket_values.format('MAX')))
+            remove.append("DELETE FROM {0} WHERE device_id = OLD.device_id AND quantity = '{2}' "
+                          "AND bucket = (OLD.date / {1}) * {1} AND count <= 0;".format(table, width, quantity))
+
+        name = 'WIND_ROLLUP_{}'.format(quantity)
+        con.execute('CREATE TRIGGER {}_insert AFTER INSERT ON WIND_DATA BEGIN {} END'
+                    .format(name, ' '.join(add)))
+        con.execute('CREATE TRIGGER {}_delete AFTER DELETE ON WIND_DATA BEGIN {} END'
+                    .format(name, ' '.join(remove)))
+        con.execute('CREATE TRIGGER {0}_update AFTER UPDATE OF {1}, date, device_id ON WIND_DATA '
+                    'WHEN OLD.{1} IS NOT NEW.{1} OR OLD.date != NEW.date OR OLD.device_id != NEW.device_id '
+                    'BEGIN {2} {3} END'.format(name, column, ' '.join(remove), ' '.join(add)))
+
+
+def _migration_3(con):
+    '''
+    Creates WIND_DATA_VERSIONS, the data version of every device, and the
+    triggers that bump it on every insert, update and delete of WIND_DATA.
+    The version and the time of the last change are used for HTTP
+    conditional requests: nothing has changed while the version is the same.
+    '''
+
+    con.execute('CREATE TABLE WIND_DATA_VERSIONS (device_id INTEGER PRIMARY KEY, version INTEGER NOT NULL, '
+                'modified INTEGER NOT NULL)')
+    con.execute("INSERT INTO WIND_DATA_VERSIONS SELECT DISTINCT device_id, 1, CAST(strftime('%s', 'now') AS INTEGER) "
+                "FROM WIND_DATA")
+
+    #the WHERE of an INSERT ... SELECT is required before an upsert clause
+    bump = "INSERT INTO WIND_DATA_VERSIONS (device_id, version, modified) " \
+           "SELECT {0}.device_id, 1, CAST(strftime('%s', 'now') AS INTEGER) WHERE {1} " \
+           "ON CONFLICT (device_id) DO UPDATE SET version = version + 1, modified = excluded.modified;"
+    con.execute('CREATE TRIGGER WIND_DATA_VERSIONS_insert AFTER INSERT ON WIND_DATA BEGIN {} END'
+                .format(bump.format('NEW', '1')))
+    con.execute('CREATE TRIGGER WIND_DATA_VERSIONS_delete AFTER DELETE ON WIND_DATA BEGIN {} END'
+                .format(bump.format('OLD', '1')))
+    #a row moved to another device changes both
+    con.execute('CREATE TRIGGER WIND_DATA_VERSIONS_update AFTER UPDATE ON WIND_DATA BEGIN {} {} END'
+                .format(bump.format('NEW', '1'), bump.format('OLD', 'OLD.device_id != NEW.device_id')))
+
+
+MIGRATIONS = [_migration_1, _migration_2, _migration_3]
+
+# Schema version of a fully migrated database
+SCHEMA_VERSION = len(MIGRATIONS)
+
+# Oldest sqlite library the statements run on: upserts (ON CONFLICT DO UPDATE)
+# need 3.24 and the window functions of the decimation 3.25
+MIN_SQLITE_VERSION = (3, 25, 0)
+
+
+def check_sqlite(version=sqlite3.sqlite_version):
+    '''
+    Checks that the sqlite library python is linked with runs all the statements.
+
+    :param version: version of the sqlite library, e.g. "3.31.1"
+    :raises RuntimeError: if the library is older than :py:data:`MIN_SQLITE_VERSION`
+        or was built without the JSON1 extension (json_each)
+    '''
+    if tuple(int(part) for part in version.split('.')[:3]) < MIN_SQLITE_VERSION:
+        raise RuntimeError("sqlite %s is too old, the database needs sqlite %s or later"
+                           % (version, '.'.join(map(str, MIN_SQLITE_VERSION))))
+    con = sqlite3.connect(':memory:')
+    try:
+        con.execute("SELECT value FROM json_each('[1]')").fetchall()
+    except sqlite3.OperationalError:
+        raise RuntimeError("sqlite %s was built without the JSON1 extension (json_each), "
+                           "the database needs it" % version)
+    finally:
+        con.close()
+
 
 # slightly borrowed from exercises
 class Engine(object):
@@ -22,20 +362,60 @@ class Engine(object):
     >>> engine = Engine()
     >>> con = engine.connect()
 
+    The schema of the database file is upgraded to :py:data:`SCHEMA_VERSION`
+    the first time a connection is created, see :py:meth:`migrate`.
+
+    Long running processes (the REST API) should borrow pooled connections
+    with :py:meth:`acquire` and give them back with :py:meth:`release`
+    instead of opening a new connection for every request.
+
     :param db_path: The path of the database file (always with respect to the
         calling script. If not specified, the Engine will use the file located
         at *db/forum.db*
+    :param pool_size: Maximum number of connections checked out at the same time
+    :param max_idle: Seconds an unused pooled connection is kept open
+    :param profile: Name of a profile in :py:data:`PROFILES`, or a list of
+        (pragma, value) pairs, applied to every connection the Engine creates
+    :param checkpoint_interval: In WAL mode, seconds between the checkpoints
+        run when pooled connections are released. None disables them
+    :param cached_statements: Size of the prepared statement cache of each connection
+    :param connection_class: :py:class:`Connection` or a subclass of it, e.g.
+        one that measures the queries
+    :param slow_query_threshold: Seconds. If given, every statement of the
+        connections is timed and the slower ones are logged with their query
+        plan, see :py:class:`SlowQueryLog`. None (default) does not time them
+    :param read_pool_size: If given, a second pool of this many read only
+        connections (PRAGMA query_only) for :py:meth:`acquire` with read_only,
+        so readers never wait for the connections of the writers. None
+        (default) serves the readers from the same pool
+    :raises RuntimeError: if the sqlite library is too old, see :py:func:`check_sqlite`
 
     '''
-    def __init__(self, db_path=None):
+    def __init__(self, db_path=None, pool_size=DEFAULT_POOL_SIZE, max_idle=DEFAULT_MAX_IDLE,
+                 profile='default', checkpoint_interval=None, cached_statements=DEFAULT_CACHED_STATEMENTS,
+                 connection_class=None, slow_query_threshold=None, read_pool_size=None):
         '''
         '''
 
         super(Engine, self).__init__()
+        check_sqlite()
         if db_path is not None:
             self.db_path = db_path
         else:
             self.db_path = DEFAULT_DB_PATH
+        if isinstance(profile, str):
+            if profile not in PROFILES:
+                raise ValueError("Unknown profile %s" % profile)
+            profile = PROFILES[profile]
+        self.pragmas = tuple(profile)
+        self.checkpoint_interval = checkpoint_interval
+        self.cached_statements = cached_statements
+        self.connection_class = connection_class if connection_class is not None else Connection
+        self.slow_queries = SlowQueryLog(slow_query_threshold) if slow_query_threshold is not None else None
+        self._last_checkpoint = time.time()
+        self._migrated = False
+        self.pool = ConnectionPool(self, pool_size, max_idle)
+        self.read_pool = ConnectionPool(self, read_pool_size, max_idle, read_only=True) if read_pool_size else None
 
     def connect(self):
         '''
@@ -45,7 +425,422 @@ class Engine(object):
         :rtype: Connection
 
         '''
-        return Connection(self.db_path)
+        if not self._migrated:
+            self.migrate()
+        return self.connection_class(self.db_path, pragmas=self.pragmas, cached_statements=self.cached_statements,
+                                     slow_query_log=self.slow_queries)
+
+    def checkpoint(self, connection=None, mode='PASSIVE'):
+        '''
+        Copies the changes of the write-ahead log back to the database file
+        so the log does not grow without limit. Does nothing if the database
+        is not in WAL mode.
+
+        :param connection: Connection used for the checkpoint, a new one if None
+        :param mode: PASSIVE (never blocks), FULL, RESTART or TRUNCATE
+        :return: (busy, log pages, checkpointed pages) as returned by sqlite
+        '''
+        if mode not in ('PASSIVE', 'FULL', 'RESTART', 'TRUNCATE'):
+            raise ValueError("Unknown checkpoint mode %s" % mode)
+        own = connection is None
+        if own:
+            connection = self.connect()
+        try:
+            self._last_checkpoint = time.time()
+            return tuple(connection.con.execute('PRAGMA wal_checkpoint(%s)' % mode).fetchone())
+        finally:
+            if own:
+                connection.close()
+
+    def _maybe_checkpoint(self, connection):
+        #called by the pool when a connection is released
+        if self.checkpoint_interval is not None and \
+                time.time() - self._last_checkpoint >= self.checkpoint_interval:
+            self.checkpoint(connection)
+
+    def acquire(self, timeout=None, read_only=False):
+        '''
+        Borrows a connection from the pool. It must be given back with
+        :py:meth:`release`, not closed.
+
+        :param timeout: Seconds to wait for a free connection, None waits forever
+        :param read_only: borrow a read only connection from the read pool,
+            if the Engine has one (see read_pool_size)
+        :return: A Connection instance
+        :rtype: Connection
+        :raises PoolTimeoutError: if no connection was freed in time
+        '''
+        if read_only and self.read_pool is not None:
+            return self.read_pool.checkout(timeout)
+        return self.pool.checkout(timeout)
+
+    def release(self, connection, commit=True):
+        '''
+        Gives a connection borrowed with :py:meth:`acquire` back to the pool.
+
+        :param commit: commit pending changes if ``True``, roll them back otherwise
+        '''
+        (self.read_pool if connection.read_only else self.pool).checkin(connection, commit)
+
+    def dispose(self):
+        '''
+        Closes all idle pooled connections.
+        '''
+        self.pool.clear()
+        if self.read_pool is not None:
+            self.read_pool.clear()
+
+    def populate_synthetic(self, devices=1, years=1, interval=SYNTHETIC_INTERVAL, start=SYNTHETIC_START, seed=0,
+                           readings=None):
+        '''
+        Fills the database with reproducible synthetic data, e.g. for benchmarks.
+        Devices 1 ... devices are created (replacing devices with the same
+        ids) and each gets a reading every interval seconds for the given
+        number of years, see :py:func:`synthetic_readings`. The rollup tables
+        and data versions are updated by the triggers as for any other write.
+
+        :param devices: number of devices
+        :param years: years of readings per device, can be a fraction
+        :param seed: seed of the random values
+        :param readings: number of readings per device, instead of years
+        :return: number of readings written
+        '''
+        rng = random.Random(seed)
+        count = readings if readings is not None else int(years * 365 * 86400 / interval)
+        connection = self.connect()
+        try:
+            with connection.con:
+                #an empty database file only gets WIND_DATA from the migrations
+                connection.con.execute('CREATE TABLE IF NOT EXISTS WIND_DEVICES (device_id INTEGER PRIMARY KEY UNIQUE, '
+                                       'reg_nro STRING, device_type STRING, location STRING, data_id INTEGER)')
+                connection.con.executemany('INSERT OR REPLACE INTO WIND_DEVICES VALUES (?, ?, ?, ?, ?)',
+                                           [(id, 'SYN-%03d' % id, 'Met Mast', 'Synthetic %d' % id, id)
+                                            for id in range(1, devices + 1)])
+            written = 0
+            for id in range(1, devices + 1):
+                written += connection.bulk_insert(id, synthetic_readings(rng, start, count, interval))
+            return written
+        finally:
+            connection.close()
+
+    def get_schema_version(self):
+        '''
+        :return: the schema version stored in the database file
+        :rtype: int
+        '''
+        con = sqlite3.connect(self.db_path)
+        try:
+            return con.execute('PRAGMA user_version').fetchone()[0]
+        finally:
+            con.close()
+
+    def migrate(self):
+        '''
+        Upgrades the database file in place to :py:data:`SCHEMA_VERSION`.
+
+        Every pending migration runs in its own transaction together with the
+        version bump, so an interrupted upgrade is simply retried on the next
+        call. The write lock is taken before the version is read, so several
+        processes can call this at the same time.
+
+        :return: the schema version after the upgrade
+        :rtype: int
+        '''
+        con = sqlite3.connect(self.db_path, isolation_level=None)
+        try:
+            while True:
+                con.execute('BEGIN IMMEDIATE')
+                version = con.execute('PRAGMA user_version').fetchone()[0]
+                if version >= SCHEMA_VERSION:
+                    con.execute('COMMIT')
+                    break
+                try:
+                    MIGRATIONS[version](con)
+                    con.execute('PRAGMA user_version = %d' % (version + 1))
+                    con.execute('COMMIT')
+                except Exception:
+                    con.execute('ROLLBACK')
+                    raise
+        finally:
+            con.close()
+        self._migrated = True
+        return version
+
+    def _create_pooled_connection(self, read_only=False):
+        if not self._migrated:
+            self.migrate()
+        #pooled connections are handed between request threads
+        return self.connection_class(self.db_path, check_same_thread=False, pragmas=self.pragmas,
+                                     cached_statements=self.cached_statements, slow_query_log=self.slow_queries,
+                                     read_only=read_only)
+
+
+class PoolTimeoutError(Exception):
+    '''
+    Raised when no pooled connection becomes free in time.
+    '''
+    pass
+
+
+class ConnectionPool(object):
+    '''
+    Bounded, thread safe pool of :py:class:`Connection` instances.
+
+    At most *size* connections are checked out at the same time. Returned
+    connections are kept open for reuse and closed once they have been idle
+    for more than *max_idle* seconds. A connection is health checked before
+    it is handed out and replaced if the check fails.
+
+    An instance of this class should not be used directly, use
+    :py:meth:`Engine.acquire` and :py:meth:`Engine.release`.
+
+    :param read_only: the pool creates read only connections
+    '''
+
+    def __init__(self, engine, size, max_idle, read_only=False):
+        super(ConnectionPool, self).__init__()
+        self.engine = engine
+        self.size = size
+        self.max_idle = max_idle
+        self.read_only = read_only
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        #(connection, time it was returned), most recently used last
+        self._idle = deque()
+
+    def checkout(self, timeout=None):
+        if not self._slots.acquire(timeout=timeout):
+            raise PoolTimeoutError("No free database connection in %s seconds" % timeout)
+        try:
+            connection = self._take_idle()
+            if connection is None:
+                connection = self.engine._create_pooled_connection(self.read_only)
+            return connection
+        except:
+            self._slots.release()
+            raise
+
+    def checkin(self, connection, commit=True):
+        try:
+            if connection.isclosed():
+                return
+            try:
+                if commit:
+                    connection.con.commit()
+                else:
+                    connection.con.rollback()
+            except sqlite3.Error:
+                self._discard(connection)
+                return
+            try:
+                self.engine._maybe_checkpoint(connection)
+            except sqlite3.Error:
+                pass
+            with self._lock:
+                self._idle.append((connection, time.time()))
+        finally:
+            self._slots.release()
+
+    def clear(self):
+        with self._lock:
+            idle = list(self._idle)
+            self._idle.clear()
+        for connection, returned in idle:
+            self._discard(connection)
+
+    def idle_count(self):
+        '''
+        :return: number of open connections waiting in the pool
+        '''
+        with self._lock:
+            return len(self._idle)
+
+    def _take_idle(self):
+        evicted = []
+        connection = None
+        with self._lock:
+            #oldest connections are on the left
+            limit = time.time() - self.max_idle
+            while self._idle and self._idle[0][1] < limit:
+                evicted.append(self._idle.popleft()[0])
+            if self._idle:
+                connection = self._idle.pop()[0]
+        for old in evicted:
+            self._discard(old)
+        if connection is not None and not connection.ping():
+            self._discard(connection)
+            connection = None
+        return connection
+
+    def _discard(self, connection):
+        #a broken connection can not commit, just drop it
+        try:
+            connection.close()
+        except sqlite3.Error:
+            pass
+
+
+class SlowQueryLog(object):
+    '''
+    Statements that took longer than a threshold, aggregated by their
+    normalized SQL (see :py:func:`normalize_sql`).
+
+    Every slow statement is logged as a warning to :py:data:`slow_query_logger`
+    with its parameters and its EXPLAIN QUERY PLAN, which tells whether
+    sqlite searched the primary key (SEARCH ... USING PRIMARY KEY) or read
+    the whole table (SCAN). The plan is captured the first time a statement
+    is slow. The time of a query includes fetching its rows, it is recorded
+    when all of them were fetched or the cursor is closed, see
+    :py:class:`SlowQueryCursor`.
+
+    An instance of this class should not be created directly, use the
+    slow_query_threshold of the :py:class:`Engine`.
+
+    :param threshold: seconds
+    :param max_statements: maximum number of different statements kept
+    '''
+
+    def __init__(self, threshold, max_statements=DEFAULT_MAX_SLOW_STATEMENTS):
+        super(SlowQueryLog, self).__init__()
+        self.threshold = threshold
+        self.max_statements = max_statements
+        self._lock = threading.Lock()
+        #normalized SQL -> dict, see stats
+        self._statements = {}
+
+    def record(self, con, query, qvalue, seconds):
+        '''
+        Logs the statement if it took longer than the threshold.
+
+        :param con: sqlite3 connection the statement ran on, for the query plan
+        :param qvalue: values of the placeholders, None for an executemany
+        '''
+        if seconds < self.threshold:
+            return
+        normalized = normalize_sql(query)
+        with self._lock:
+            entry = self._statements.get(normalized)
+        if entry is None:
+            entry = {'sql': normalized, 'count': 0, 'total': 0.0, 'max': 0.0, 'parameters': None,
+                     'plan': self.explain(con, query, qvalue)}
+            with self._lock:
+                if len(self._statements) >= self.max_statements and normalized not in self._statements:
+                    #the first statements are kept, the others are only logged
+                    entry = dict(entry)
+                else:
+                    entry = self._statements.setdefault(normalized, entry)
+        with self._lock:
+            entry['count'] += 1
+            entry['total'] += seconds
+            entry['max'] = max(entry['max'], seconds)
+            entry['parameters'] = None if qvalue is None else list(qvalue)
+        slow_query_logger.warning("Slow query (%.1f ms): %s; parameters %r; plan: %s", seconds * 1000,
+                                  normalized, entry['parameters'], ' | '.join(entry['plan']) or 'unknown')
+
+    def explain(self, con, query, qvalue):
+        '''
+        :return: list of the steps of the EXPLAIN QUERY PLAN of the statement,
+            empty if it can not be explained (e.g. an executemany)
+        '''
+        if qvalue is None:
+            return []
+        try:
+            return [row[3] for row in con.execute('EXPLAIN QUERY PLAN ' + query, qvalue).fetchall()]
+        except sqlite3.Error:
+            return []
+
+    def stats(self):
+        '''
+        :return: list of the slow statements, the ones that took the longest in
+            total first: sql, count, total_ms, max_ms, the parameters of the
+            last one, the query plan and the tables read with a full scan
+        '''
+        with self._lock:
+            entries = [dict(entry) for entry in self._statements.values()]
+        entries.sort(key=lambda entry: entry['total'], reverse=True)
+        return [{'sql': entry['sql'], 'count': entry['count'], 'total_ms': round(entry['total'] * 1000, 3),
+                 'max_ms': round(entry['max'] * 1000, 3), 'parameters': entry['parameters'], 'plan': entry['plan'],
+                 'full_scans': [match.group(1) for match in
+                                (re.match(r'^SCAN (?:TABLE )?(\w+)', step) for step in entry['plan'])
+                                if match is not None and match.group(1) != 'CONSTANT'
+                                and 'VIRTUAL TABLE' not in match.string]}
+                for entry in entries]
+
+    def clear(self):
+        with self._lock:
+            self._statements.clear()
+
+
+class SlowQueryCursor(object):
+    '''
+    sqlite3 cursor that adds the time spent fetching rows to the time of
+    its query, and records the query to a :py:class:`SlowQueryLog` once all
+    the rows were fetched or the cursor is closed or dropped. The other
+    attributes are the ones of the cursor.
+
+    :param seconds: time spent running the query up to its first row
+    '''
+
+    def __init__(self, cursor, slow_query_log, con, query, qvalue, seconds):
+        super(SlowQueryCursor, self).__init__()
+        self.cursor = cursor
+        self.slow_query_log = slow_query_log
+        self.con = con
+        self.query = query
+        self.qvalue = qvalue
+        self.seconds = seconds
+        self._recorded = False
+
+    def _fetched(self, started, exhausted):
+        self.seconds += time.perf_counter() - started
+        if exhausted:
+            self._record()
+
+    def _record(self):
+        if not self._recorded:
+            self._recorded = True
+            self.slow_query_log.record(self.con, self.query, self.qvalue, self.seconds)
+
+    def fetchone(self):
+        started = time.perf_counter()
+        row = self.cursor.fetchone()
+        self._fetched(started, row is None)
+        return row
+
+    def fetchmany(self, size=None):
+        size = self.cursor.arraysize if size is None else size
+        started = time.perf_counter()
+        rows = self.cursor.fetchmany(size)
+        self._fetched(started, len(rows) < size)
+        return rows
+
+    def fetchall(self):
+        started = time.perf_counter()
+        rows = self.cursor.fetchall()
+        self._fetched(started, True)
+        return rows
+
+    def __iter__(self):
+        #timed per batch, timing every row would cost more than fetching it
+        while True:
+            rows = self.fetchmany(SLOW_QUERY_FETCH_SIZE)
+            for row in rows:
+                yield row
+            if len(rows) < SLOW_QUERY_FETCH_SIZE:
+                return
+
+    def close(self):
+        self._record()
+        self.cursor.close()
+
+    def __del__(self):
+        #a query whose rows were not all fetched, e.g. a fetchone of a single value
+        if not getattr(self, '_recorded', True):
+            self._record()
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
 
 #little bit borrowed from exercise
 class Connection(object):
@@ -64,13 +859,28 @@ class Connection(object):
 
        :param db_path: Location of the database file.
        :type dbpath: str
+       :param check_same_thread: ``False`` allows using the connection from
+           other threads than the one that created it (pooled connections)
+       :param pragmas: list of (pragma, value) pairs run when connecting
+       :param cached_statements: number of prepared statements kept by sqlite3.
+           The statements are found by their SQL text, see :py:func:`get_statement`
+       :param slow_query_log: :py:class:`SlowQueryLog` the statements are timed for, None to not time them
+       :param read_only: ``True`` adds :py:data:`READ_ONLY_PRAGMAS`, the writes then fail with sqlite3.OperationalError
 
        '''
 
-    def __init__(self, db_path):
+    def __init__(self, db_path, check_same_thread=True, pragmas=(), cached_statements=DEFAULT_CACHED_STATEMENTS,
+                 slow_query_log=None, read_only=False):
         super(Connection, self).__init__()
-        self.con = sqlite3.connect(db_path)
+        self.con = sqlite3.connect(db_path, check_same_thread=check_same_thread,
+                                   cached_statements=cached_statements)
+        self.slow_query_log = slow_query_log
+        self.read_only = read_only
         self._isclosed = False
+        #the read only PRAGMAs last, the others may have to write (e.g. journal_mode)
+        for pragma, value in tuple(pragmas) + (READ_ONLY_PRAGMAS if read_only else ()):
+            #PRAGMA does not take placeholders, the profiles come from code
+            self.con.execute('PRAGMA {} = {}'.format(pragma, value)).fetchall()
 
     def isclosed(self):
         '''
@@ -78,6 +888,18 @@ class Connection(object):
         '''
         return self._isclosed
 
+    def ping(self):
+        '''
+        :return: ``True`` if the database still answers on this connection.
+        '''
+        if self._isclosed:
+            return False
+        try:
+            self.con.execute('SELECT 1').fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
     def close(self):
         '''
         Closes the database connection, commiting all changes.
@@ -88,6 +910,48 @@ class Connection(object):
             self._isclosed = True
 
 
+    def _execute(self, query, qvalue=(), row_factory=None):
+        '''
+        Executes a statement on a new cursor. All the queries of the
+        Connection go through here. The row factory is set on the cursor
+        only, the connection is not changed.
+
+        :param query: SQL, from :py:func:`get_statement` for the fixed statements
+        :param qvalue: values of the placeholders
+        :param row_factory: e.g. sqlite3.Row, None for plain tuples
+        :return: the cursor, a :py:class:`SlowQueryCursor` for a query if the
+            statements are timed
+        '''
+        cur = self.con.cursor()
+        cur.row_factory = row_factory
+        if self.slow_query_log is None:
+            cur.execute(query, qvalue)
+            return cur
+        started = time.perf_counter()
+        cur.execute(query, qvalue)
+        seconds = time.perf_counter() - started
+        if cur.description is not None:
+            #a query, its rows are timed while the caller fetches them
+            return SlowQueryCursor(cur, self.slow_query_log, self.con, query, qvalue, seconds)
+        self.slow_query_log.record(self.con, query, qvalue, seconds)
+        return cur
+
+    def _executemany(self, query, qvalues):
+        '''
+        Executes a statement for every sequence of values, see :py:meth:`_execute`.
+
+        :return: the cursor
+        '''
+        cur = self.con.cursor()
+        if self.slow_query_log is None:
+            cur.executemany(query, qvalues)
+            return cur
+        started = time.perf_counter()
+        cur.executemany(query, qvalues)
+        self.slow_query_log.record(self.con, query, None, time.perf_counter() - started)
+        return cur
+
+
     # HELPERS
     # Here the helpers that transform database rows into dictionary. They work
     # Helper for speed
@@ -147,19 +1011,10 @@ class Connection(object):
         #if match is None:
         #    raise ValueError("The id is malformed")
 
-        #Query for speed
-        query = 'SELECT * FROM WIND_DEVICES WHERE device_id = ?'
-
-        #cursor & row init
-        self.con.row_factory = sqlite3.Row
-        cur = self.con.cursor()
-
         #Execute main SQL statement
-        qvalue = (id,)
-        cur.execute(query, qvalue)
+        row = self._execute(get_statement('device'), (id,), sqlite3.Row).fetchone()
 
         #Do the response shait
-        row = cur.fetchone()
         if row is None:
             return None
         #build return object
@@ -172,21 +1027,9 @@ class Connection(object):
         return a list of all devices from DB
         '''
 
-        #Create SQL statement
-        #query = 'SELECT * FROM WIND_DATA WHERE date > %s AND date < %s ORDER BY date ASC' % str(start) % str(end)
-        query = 'SELECT * FROM WIND_DEVICES'
-
-        #cursor & row init
-        self.con.row_factory = sqlite3.Row
-        cur = self.con.cursor()
-
         #Execute SQL statement
-        cur.execute(query)
+        rows = self._execute(get_statement('devices'), row_factory=sqlite3.Row).fetchall()
 
-        #results
-        rows = cur.fetchall()
-        if rows is None:
-            return None
         #build return object
         devices = []
         for row in rows:
@@ -200,50 +1043,15 @@ class Connection(object):
         Extracts speed from db
         :param timestamp:
             format integer value
-        :return: A dict with the format provided in
-            :py:meth:`_create_speed_object` or None if speed with given timestamp does not exist
+        :return: A dict with timestamp and speed (same format as
+            :py:meth:`_create_speed_object`) or None if speed with given timestamp does not exist
 
         '''
-
-        #Query for speed
-        query = 'SELECT * FROM WIND_DATA WHERE device_id = ? AND date = ?'
-
-        #cursor & row init
-        self.con.row_factory = sqlite3.Row
-        cur = self.con.cursor()
-
-        #Execute main SQL statement
-        qvalue = (id, timestamp,)
-        cur.execute(query, qvalue)
-
-        #Do the response shait
-        row = cur.fetchone()
-        if row is None:
-            return None
-        #build return object
-        else:
-            return self._create_speed_object(row)
+        return self._get_value(id, timestamp, 'speed')
 
 
     def get_temperature(self, id, timestamp):
-        #Query for temp
-        query = 'SELECT * FROM WIND_DATA WHERE device_id = ? AND date = ?'
-
-        #cursor & row init
-        self.con.row_factory = sqlite3.Row
-        cur = self.con.cursor()
-
-        #Execute main SQL statement
-        qvalue = (id, timestamp,)
-        cur.execute(query, qvalue)
-
-        #Do the response shait
-        row = cur.fetchone()
-        if row is None:
-            return None
-        #build return object
-        else:
-            return self._create_temperature_object(row)
+        return self._get_value(id, timestamp, 'temperature')
 
 
     def delete_temperature(self, id, timestamp):
@@ -253,43 +1061,7 @@ class Connection(object):
         :return: True (204) if value was deleted, else False (if deleted already, or timestamp does not exist)
         '''
 
-        try:
-            id = int(id)
-            timestamp = int(timestamp)
-        except(ValueError):
-            raise ValueError("The deviceid is malformed")
-
-        query1 = 'SELECT temperature FROM WIND_DATA WHERE device_id = ? AND date = ?'
-        query2 = 'UPDATE WIND_DATA SET temperature = "" WHERE device_id = ? AND date = ?'
-
-        #check if temperature already deleted
-        self.con.row_factory = sqlite3.Row
-        cur = self.con.cursor()
-        qvalue = (id, timestamp,)
-        cur.execute(query1, qvalue, )
-        row = cur.fetchone()
-        #print(row)
-
-        #if timestamp does not exist
-        if row is None:
-            return False
-        else:
-            temp = row["temperature"]
-        #if temperature is already deleted
-        if temp == "" or temp == None:
-            return False
-        else:
-            #remove value
-            self.con.row_factory = sqlite3.Row
-            cur = self.con.cursor()
-            qvalue = (id, timestamp,)
-            try:
-                cur.execute(query2, qvalue,)
-                self.con.commit()
-                return True
-            except sqlite3.Error as e:
-                print("Error %s:" % (e.args[0]))
-                return False
+        return self._delete_value(id, timestamp, 'temperature')
 
 
     def modify_temperature(self, id, timestamp, value):
@@ -300,40 +1072,7 @@ class Connection(object):
         :return: True (204) if value was deleted, else False (if deleted already, or timestamp does not exist)
         '''
 
-        try:
-            id = int(id)
-            timestamp = int(timestamp)
-        except(ValueError):
-            raise ValueError("The deviceid is malformed")
-
-        #check if noexisting timestamp
-        query2 = 'SELECT * FROM WIND_DATA WHERE device_id = ? AND date = ?'
-        qvalue2 = (id, timestamp,)
-
-        self.con.row_factory = sqlite3.Row
-        cur = self.con.cursor()
-
-        cur.execute(query2, qvalue2,)
-
-        #Do the response shait
-        row = cur.fetchone()
-        if row is None:
-            return False
-
-
-        query = 'UPDATE WIND_DATA SET temperature = ? WHERE device_id = ? AND date = ?'
-        qvalue = (value, id, timestamp,)
-
-        #modify value
-        self.con.row_factory = sqlite3.Row
-        cur = self.con.cursor()
-        try:
-            cur.execute(query, qvalue)
-            self.con.commit()
-            return True
-        except sqlite3.Error as e:
-            print("Error %s:" % (e.args[0]))
-            return False
+        return self._modify_value(id, timestamp, 'temperature', value)
 
 
     def add_temperature(self, id, timestamp, value):
@@ -344,77 +1083,163 @@ class Connection(object):
         :return: False if not added. dict with timestamp and value if added
         '''
 
-        # if there is a timestamp: temperature value is checked to be null already in method call
-        # add value to temperature with given timestamp
-        # created this for usability, we want to add value even if there is a timestamp already (RESTISH?)
+        return self._add_value(id, timestamp, 'temperature', value)
+
+
+    def bulk_insert(self, id, rows):
+        '''
+        Inserts or replaces many rows of a device in one transaction with
+        executemany. Rows that already exist (same timestamp) are replaced
+        as a whole. If a row is malformed nothing is written.
+
+        :param id: device id
+        :param rows: iterable of dicts with key timestamp and the quantities
+            of :py:data:`QUANTITIES` (e.g. speed, temperature). Missing
+            quantities are stored as null. The rows are consumed lazily, so
+            a generator reading a stream can be given.
+        :return: number of rows written
+        :raises ValueError: if id or a row is malformed
+        '''
 
         try:
             id = int(id)
-            timestamp = int(timestamp)
-        except(ValueError):
-            raise ValueError("The messageid is malformed")
+        except(ValueError, TypeError):
+            raise ValueError("The deviceid is malformed")
 
-        test = self.contains_timestamp(id, timestamp)
-        if test:
-            returnable_boolean = self.modify_temperature(id, timestamp, value)
-            return returnable_boolean
+        quantities = sorted(QUANTITIES)
+        columns = [QUANTITIES[q] for q in quantities]
+        query = 'INSERT INTO WIND_DATA (device_id, date, {}) VALUES (?, ?, {}) ' \
+                'ON CONFLICT (device_id, date) DO UPDATE SET {}'.format(
+                    ', '.join(columns), ', '.join('?' for c in columns),
+                    ', '.join('{0} = excluded.{0}'.format(c) for c in columns))
+
+        count = [0]
+        def values():
+            for row in rows:
+                if not isinstance(row, dict):
+                    raise ValueError("Row %d is not an object" % count[0])
+                unknown = set(row) - set(quantities) - {'timestamp'}
+                if unknown:
+                    raise ValueError("Row %d has unknown fields %s" % (count[0], ', '.join(sorted(unknown))))
+                try:
+                    timestamp = int(row['timestamp'])
+                except(KeyError, ValueError, TypeError):
+                    raise ValueError("Row %d has no valid timestamp" % count[0])
+                values = [row.get(q) for q in quantities]
+                if any(isinstance(value, (dict, list)) for value in values):
+                    raise ValueError("Row %d has a value that is not a number or a string" % count[0])
+                count[0] += 1
+                yield [id, timestamp] + values
+
+        #one transaction, rolled back if a row is malformed
+        with self.con:
+            self._executemany(query, values())
+        return count[0]
+
+
+    def batch_modify(self, id, operations):
+        '''
+        Applies a batch of edits of single temperature and humidity values in
+        one transaction. Each operation is a dict with timestamp, field
+        (a key of :py:data:`EDITABLE_QUANTITIES`) and value:
+         * value None deletes the value, as :py:meth:`delete_temperature`
+         * other values modify the value, or add it as :py:meth:`add_temperature`
+           if there is no row with the timestamp
+
+        The existing values are read for all the timestamps with one SELECT
+        instead of one SELECT per operation. The write transaction is begun
+        (BEGIN IMMEDIATE) before the SELECT, so no other writer can change
+        the rows between the read and the writes. The operations are
+        applied in order.
+
+        :param id: device id
+        :param operations: list of operations
+        :return: list with a status per operation: 204 modified or deleted,
+            201 added, 400 malformed operation (skipped), 404 nothing to delete.
+            None if the database could not be modified, nothing is written then.
+        :raises ValueError: if id or operations is malformed
+        '''
 
-        # if there is no timestamp create new entry
-        else:
-            query = 'INSERT INTO WIND_DATA (date, temperature, device_id) VALUES(?,?,?)'
-            qvalue = (timestamp, value, id)
+        try:
+            id = int(id)
+        except(ValueError, TypeError):
+            raise ValueError("The deviceid is malformed")
+        if not isinstance(operations, list):
+            raise ValueError("The operations must be a list")
 
-            #Add new entry
-            self.con.row_factory = sqlite3.Row
-            cur = self.con.cursor()
+        #validation pass, None for malformed operations
+        valid = []
+        for operation in operations:
             try:
-                cur.execute(query, qvalue)
-                self.con.commit()
-                return {"timestamp": timestamp, "temperature": value, "device_id": id}
-            except sqlite3.Error as e:
-                print("Error %s:" % (e.args[0]))
-                return False
-
+                timestamp = int(operation['timestamp'])
+                field = operation['field']
+                value = operation['value']
+            except(KeyError, ValueError, TypeError):
+                valid.append(None)
+                continue
+            if field not in EDITABLE_QUANTITIES or isinstance(value, (dict, list)):
+                valid.append(None)
+            else:
+                valid.append((timestamp, field, value))
+
+        timestamps = sorted(set(operation[0] for operation in valid if operation is not None))
+        statuses = []
+        try:
+            with self.con:
+                #take the write lock before reading, unless a write of this
+                #connection already holds it
+                if not self.con.in_transaction:
+                    self.con.execute('BEGIN IMMEDIATE')
+
+                #current values of the rows, timestamp -> {field: value}
+                rows = {}
+                for row in self._execute(get_statement('editable_values'), (id, json.dumps(timestamps))):
+                    rows[row[0]] = dict(zip(EDITABLE_QUANTITIES, row[1:]))
+
+                for operation in valid:
+                    if operation is None:
+                        statuses.append(400)
+                        continue
+                    timestamp, field, value = operation
+                    row = rows.get(timestamp)
+                    if value is None:
+                        #nothing to delete
+                        if row is None or row[field] == "" or row[field] is None:
+                            statuses.append(404)
+                            continue
+                        value = ""
+                        statuses.append(204)
+                    elif row is None:
+                        self._execute(get_statement('insert_value', field), (id, timestamp, value))
+                        rows[timestamp] = row = dict.fromkeys(EDITABLE_QUANTITIES)
+                        row[field] = value
+                        statuses.append(201)
+                        continue
+                    else:
+                        statuses.append(204)
+                    self._execute(get_statement('set_value', field), (value, id, timestamp))
+                    row[field] = value
+        except sqlite3.Error as e:
+            print("Error %s:" % (e.args[0]))
+            return None
+        return statuses
 
 
-    def get_speeds(self, id):
+    def get_speeds(self, id, start=None, end=None, limit=None, stream=False):
         '''
         return a list of all speed values from DB filtere by conditions provided in parameters
         start: starting timestamp
         end: ending timestamp
 
-        :param start: timestamp
-        :param end: timestamp
+        :param start: timestamp, first included value. None for no lower bound
+        :param end: timestamp, values before it are included. None for no upper bound
+        :param limit: maximum number of values, None for all
+        :param stream: if ``True`` a generator reading the values lazily from
+            the cursor is returned instead of a list
         :return: a list of speed values. each value is is a dict containing timestamp & speed value
         '''
 
-        #Create SQL statement
-        #query = 'SELECT * FROM WIND_DATA WHERE date > %s AND date < %s ORDER BY date ASC' % str(start) % str(end)
-        #query = 'SELECT * FROM WIND_DATA'
-        query = 'SELECT * FROM WIND_DATA WHERE device_ID = ?'
-
-        qvalue = (id,)
-
-        #sort
-        query += ' ORDER BY date ASC'
-
-        #cursor & row init
-        self.con.row_factory = sqlite3.Row
-        cur = self.con.cursor()
-
-        #Execute SQL statement
-        cur.execute(query, qvalue)
-
-        #results
-        rows = cur.fetchall()
-        if rows is None:
-            return None
-        #build return object
-        speeds = []
-        for row in rows:
-            speed = self._create_speed_object(row)
-            speeds.append(speed)
-        return speeds
+        return self._get_series(id, 'speed', start, end, limit, stream)
 
 
     def get_battery(self, id, timestamp):
@@ -422,43 +1247,15 @@ class Connection(object):
         Extracts battery voltage from db
         :param timestamp:
             format yyyymmdd hh:mm ***
-        :return: A dict with the format provided in
-            :py:meth:`_create_battery_` or None if speed with given timestamp does not exist or is 9999.
+        :return: A dict with timestamp and battery (same format as
+            :py:meth:`_create_battery_object`) or None if speed with given timestamp does not exist or is 9999.
 
         '''
-
-        #Query for battery
-        query = 'SELECT * FROM WIND_DATA WHERE device_id = ? AND date = ?'
-
-        #cursor & row init
-        self.con.row_factory = sqlite3.Row
-        cur = self.con.cursor()
-
-        #Execute main SQL statement
-        pvalue = (id, timestamp,)
-        cur.execute(query, pvalue)
-
-        #Do the response shait
-        row = cur.fetchone()
-        if row  is None:
-            return None
-        #build return object
-        return self._create_battery_object(row)
+        return self._get_value(id, timestamp, 'battery')
 
 
     def get_humidity(self, id, timestamp):
-        query = 'SELECT * FROM WIND_DATA WHERE device_id = ? AND date = ?'
-        self.con.row_factory = sqlite3.Row
-        cur = self.con.cursor()
-        pvalue = (id, timestamp,)
-        cur.execute(query, pvalue)
-
-        #Do the response shait
-        row = cur.fetchone()
-        if row  is None:
-            return None
-        #build return object
-        return self._create_humidity_object(row)
+        return self._get_value(id, timestamp, 'humidity')
 
 
     def delete_humidity(self, id, timestamp):
@@ -468,48 +1265,7 @@ class Connection(object):
         :return: True (204) if value was deleted, else False (if deleted already, or timestamp does not exist)
         '''
 
-        try:
-            id = int(id)
-            timestamp = int(timestamp)
-        except(ValueError):
-            raise ValueError("The deviceid is malformed")
-
-        query1 = 'SELECT humidity FROM WIND_DATA WHERE device_id = ? AND date = ?'
-        query2 = 'UPDATE WIND_DATA SET humidity = "" WHERE device_id = ? AND date = ?'
-
-        #check if temperature already deleted
-        self.con.row_factory = sqlite3.Row
-        cur = self.con.cursor()
-        qvalue = (id, timestamp,)
-        cur.execute(query1, qvalue,)
-        row = cur.fetchone()
-
-        #if timestamp does not exist
-        if row is None:
-            #print("1")
-            return False
-        else:
-            #print("2")
-            humi = row["humidity"]
-        #if temperature is already deleted
-        if humi == "" or None:
-            print("3")
-            return False
-        else:
-            #print("4")
-            #remove value
-            self.con.row_factory = sqlite3.Row
-            cur = self.con.cursor()
-            qvalue = (id, timestamp,)
-            try:
-                #print("5")
-                cur.execute(query2, qvalue,)
-                self.con.commit()
-                return True
-            except sqlite3.Error as e:
-                #print("6")
-                print("Error %s:" % (e.args[0]))
-                return False
+        return self._delete_value(id, timestamp, 'humidity')
 
 
     def modify_humidity(self, id, timestamp, value):
@@ -521,309 +1277,545 @@ class Connection(object):
         :return: True (204) if value was deleted, else False (if deleted already, or timestamp does not exist)
         '''
 
-        try:
-            id = int(id)
-            timestamp = int(timestamp)
-        except(ValueError):
-            raise ValueError("The deviceid is malformed")
+        return self._modify_value(id, timestamp, 'humidity', value)
 
-        #check if noexisting timestamp
-        query2 = 'SELECT * FROM WIND_DATA WHERE device_id = ? AND date = ?'
-        qvalue2 = (id, timestamp,)
 
-        self.con.row_factory = sqlite3.Row
-        cur = self.con.cursor()
+    def add_humidity(self, id, timestamp, value):
+        '''
+        Adds the humidity value with given timestamp
+        :param timestamp:
+        :param value:
+        :return: False if not added. dict with timestamp and value if added
+        '''
 
-        cur.execute(query2, qvalue2,)
+        return self._add_value(id, timestamp, 'humidity', value)
 
-        #Do the response shait
-        row = cur.fetchone()
-        if row is None:
-            return False
 
-        query = 'UPDATE WIND_DATA SET humidity = ? WHERE device_id = ? AND date = ?'
+    def get_batteries(self, id, start=None, end=None, limit=None, stream=False):
+        '''
+        return a list of battery values of device, see :py:meth:`get_speeds` for the parameters
+        '''
+        return self._get_series(id, 'battery', start, end, limit, stream)
 
-        #check if temperature already deleted
-        qvalue = (value, id, timestamp,)
 
-        #modify value
-        self.con.row_factory = sqlite3.Row
-        cur = self.con.cursor()
-        try:
-            cur.execute(query, qvalue)
-            self.con.commit()
-            return True
-        except sqlite3.Error as e:
-            print("Error %s:" % (e.args[0]))
-            return False
+    def get_direction(self, id, timestamp):
+        return self._get_value(id, timestamp, 'direction')
 
 
-    def add_humidity(self, id, timestamp, value):
+    def get_directions(self, id, start=None, end=None, limit=None, stream=False):
         '''
-        Adds the humidity value with given timestamp
-        :param timestamp:
-        :param value:
-        :return: False if not added. dict with timestamp and value if added
+        return a list of direction values of device, see :py:meth:`get_speeds` for the parameters
         '''
+        return self._get_series(id, 'direction', start, end, limit, stream)
 
-        # if there is a timestamp: humidity value is checked to be null already in method call
-        # add value to humidity with given timestamp
-        # created this for usability, we want to add value even if there is a timestamp already (RESTISH?)
 
-        try:
-            id = int(id)
-            timestamp = int(timestamp)
-        except(ValueError):
-            raise ValueError("The messageid is malformed")
+    def get_std_speed(self, timestamp):
+        return self._get_value(None, timestamp, 'std_speed')
 
-        test = self.contains_timestamp(id, timestamp)
-        if test:
-            returnable_boolean = self.modify_humidity(id, timestamp, value)
-            return returnable_boolean
+    def get_vertical_velocity(self, timestamp):
+        return self._get_value(None, timestamp, 'vertical_velocity')
 
-        # if there is no timestamp create new entry
-        else:
-            query = 'INSERT INTO WIND_DATA (date, humidity, device_id) VALUES(?,?,?)'
-            qvalue = (timestamp, value, id)
+    def get_std_vertical_velocity(self, timestamp):
+        return self._get_value(None, timestamp, 'std_vertical_velocity')
 
-            #Add new entry
-            self.con.row_factory = sqlite3.Row
-            cur = self.con.cursor()
-            try:
-                cur.execute(query, qvalue)
-                self.con.commit()
-                return {"timestamp": timestamp, "humidity": value, "device_id": id}
-            except sqlite3.Error as e:
-                print("Error %s:" % (e.args[0]))
-                return False
 
+    def get_quality(self, timestamp):
+        return self._get_value(None, timestamp, 'quality')
 
-    def get_batteries(self, id):
-        #Create SQL statement
-        #query = 'SELECT * FROM WIND_DATA WHERE date > %s AND date < %s ORDER BY date ASC' % str(start) % str(end)
-        query = 'SELECT * FROM WIND_DATA WHERE device_id = ?'
-        #sort
-        query += ' ORDER BY date ASC'
-        qvalue = (id,)
 
-        #cursor & row init
-        self.con.row_factory = sqlite3.Row
-        cur = self.con.cursor()
+    def get_pressure(self, timestamp):
+        return self._get_value(None, timestamp, 'pressure')
 
-        #Execute SQL statement
-        cur.execute(query, qvalue)
 
-        #results
-        rows = cur.fetchall()
-        if rows is None:
-            return None
-        #build return object
-        batteries = []
-        for row in rows:
-            battery = self._create_battery_object(row)
-            batteries.append(battery)
-        return batteries
+    def get_humidities(self, id, start=None, end=None, limit=None, stream=False):
+        '''
+        return a list of humidity values of device, see :py:meth:`get_speeds` for the parameters
+        '''
+        return self._get_series(id, 'humidity', start, end, limit, stream)
 
 
-    def get_direction(self, id, timestamp):
-        query = 'SELECT * FROM WIND_DATA WHERE device_id = ? AND date = ?'
-        self.con.row_factory = sqlite3.Row
-        cur = self.con.cursor()
-        pvalue = (id, timestamp,)
-        cur.execute(query, pvalue)
+    def get_temperatures(self, id, start=None, end=None, limit=None, stream=False):
+        '''
+        return a list of temperature values of device, see :py:meth:`get_speeds` for the parameters
+        '''
+        return self._get_series(id, 'temperature', start, end, limit, stream)
 
-        #Do the response shait
-        row = cur.fetchone()
-        if row  is None:
-            return None
-        #build return object
-        return self._create_direction_object(row)
 
 
-    def get_directions(self, id):
-        #Create SQL statement
-        #query = 'SELECT * FROM WIND_DATA WHERE date > %s AND date < %s ORDER BY date ASC' % str(start) % str(end)
-        query = 'SELECT * FROM WIND_DATA WHERE device_id = ?'
+    def get_data_version(self, id):
+        '''
+        Reads the data version of a device. The version is bumped by every
+        change of the values of the device (add_*, modify_*, delete_*,
+        bulk_insert), so equal versions mean equal data.
 
-        #sort
-        query += ' ORDER BY date ASC'
+        :return: (version, time of the last change as unix timestamp).
+            (0, None) if the device has no data
+        '''
 
-        qvalue = (id,)
+        row = self._execute(get_statement('data_version'), (id,)).fetchone()
+        if row is None:
+            return 0, None
+        return row
 
-        #cursor & row init
-        self.con.row_factory = sqlite3.Row
-        cur = self.con.cursor()
 
-        #Execute SQL statement
-        cur.execute(query, qvalue)
+    def get_previous_start(self, id, timestamp, limit):
+        '''
+        Finds where the page of values before given timestamp starts. Used
+        for the prev links of the paginated collections.
 
-        #results
-        rows = cur.fetchall()
-        if rows is None:
-            return None
-        #build return object
-        directions = []
-        for row in rows:
-            dir = self._create_direction_object(row)
-            directions.append(dir)
-        return directions
+        :param timestamp: first timestamp of the current page
+        :param limit: page size
+        :return: the first timestamp of the previous page, or None if there are
+            no values before timestamp
+        '''
 
+        return self._execute(get_statement('previous_start'), (id, timestamp, limit)).fetchone()[0]
 
-    def get_std_speed(self, timestamp):
-        query = 'SELECT * FROM WIND_DATA WHERE date = ?'
-        self.con.row_factory = sqlite3.Row
-        cur = self.con.cursor()
-        pvalue = (timestamp,)
-        cur.execute(query, pvalue)
 
-        #Do the response shait
-        row = cur.fetchone()
-        if row  is None:
-            return None
-        #build return object
-        return self._create_std_speed_object(row)
+    def get_aggregates(self, id, quantity, bucket, functions, start=None, end=None):
+        '''
+        Aggregates the values of one quantity of a device into fixed width time
+        buckets with a single GROUP BY query. Missing and deleted values are
+        left out.
+
+        :param quantity: key of :py:data:`QUANTITIES`, e.g. 'speed'
+        :param bucket: bucket width in timestamp units (seconds), buckets
+            start at multiples of the width. Whole hours and days (with
+            start and end on the same boundaries) are read from the rollup
+            tables instead of WIND_DATA.
+        :param functions: list of keys of :py:data:`AGGREGATES`
+        :param start: first included timestamp or None
+        :param end: first excluded timestamp or None
+        :return: list of dicts with the start timestamp of the bucket and a
+            value for every function, ordered by timestamp
+        :raises ValueError: if quantity, a function or bucket is not valid
+        '''
 
-    def get_vertical_velocity(self, timestamp):
-        query = 'SELECT * FROM WIND_DATA WHERE date = ?'
-        self.con.row_factory = sqlite3.Row
-        cur = self.con.cursor()
-        pvalue = (timestamp,)
-        cur.execute(query, pvalue)
+        if quantity not in QUANTITIES:
+            raise ValueError("Unknown quantity %s" % quantity)
+        unknown = [f for f in functions if f not in AGGREGATES]
+        if unknown or not functions:
+            raise ValueError("Unknown aggregate function %s" % ', '.join(unknown))
+        try:
+            bucket = int(bucket)
+        except(ValueError, TypeError):
+            raise ValueError("The bucket is malformed")
+        if bucket < 1:
+            raise ValueError("The bucket must be positive")
+
+        #whole hours or days are read from the rollup tables
+        for table, width in ROLLUPS:
+            if bucket % width == 0 and all(t is None or t % width == 0 for t in (start, end)):
+                return self._get_rollup_aggregates(table, id, quantity, bucket, functions, start, end)
+        return self._get_raw_aggregates(id, quantity, bucket, functions, start, end)
+
+    def _get_raw_aggregates(self, id, quantity, bucket, functions, start=None, end=None):
+        '''
+        :py:meth:`get_aggregates` computed from the rows of WIND_DATA
+        '''
 
-        # Do the response shait
-        row = cur.fetchone()
-        if row is None:
-            return None
-        # build return object
-        return self._create_vertical_velocity_object(row)
+        column = QUANTITIES[quantity]
+        query = "SELECT date, CAST({0} AS REAL) AS v FROM WIND_DATA WHERE device_id = ? " \
+                "AND {0} IS NOT NULL AND {0} != ''".format(column)
+        qvalue = [id]
+        condition, condition_values = get_range_filter(start, end)
+        query += condition
+        qvalue += condition_values
 
-    def get_std_vertical_velocity(self, timestamp):
-        query = 'SELECT * FROM WIND_DATA WHERE date = ?'
-        self.con.row_factory = sqlite3.Row
-        cur = self.con.cursor()
-        pvalue = (timestamp,)
-        cur.execute(query, pvalue)
+        query = 'SELECT (date / ?) * ? AS bucket, {} FROM ({}) GROUP BY bucket ORDER BY bucket'.format(
+            ', '.join(AGGREGATES[f][0] for f in functions), query)
+        qvalue = [bucket, bucket] + qvalue
+        return self._read_aggregates(query, qvalue, functions)
 
-        # Do the response shait
-        row = cur.fetchone()
-        if row is None:
-            return None
-        # build return object
-        return self._create_std_vertical_velocity_object(row)
+    def _get_rollup_aggregates(self, table, id, quantity, bucket, functions, start=None, end=None):
+        '''
+        :py:meth:`get_aggregates` computed from a rollup table. bucket, start
+        and end must be multiples of the width of the rollup buckets.
+        '''
 
+        query = 'SELECT (bucket / ?) * ? AS b, {} FROM {} WHERE device_id = ? AND quantity = ?'.format(
+            ', '.join(AGGREGATES[f][1] for f in functions), table)
+        qvalue = [bucket, bucket, id, quantity]
+        condition, condition_values = get_range_filter(start, end, 'bucket')
+        query += condition
+        qvalue += condition_values
+        query += ' GROUP BY b ORDER BY b'
+        return self._read_aggregates(query, qvalue, functions)
 
-    def get_quality(self, timestamp):
-        query = 'SELECT * FROM WIND_DATA WHERE date = ?'
-        self.con.row_factory = sqlite3.Row
-        cur = self.con.cursor()
-        pvalue = (timestamp,)
-        cur.execute(query, pvalue)
+    def _read_aggregates(self, query, qvalue, functions):
+        cur = self._execute(query, qvalue)
 
-        # Do the response shait
-        row = cur.fetchone()
-        if row is None:
-            return None
-        # build return object
-        return self._create_quality_object(row)
+        aggregates = []
+        for row in cur:
+            aggregate = {'timestamp': row[0]}
+            aggregate.update(zip(functions, row[1:]))
+            aggregates.append(aggregate)
+        return aggregates
 
 
-    def get_pressure(self, timestamp):
-        query = 'SELECT * FROM WIND_DATA WHERE date = ?'
-        self.con.row_factory = sqlite3.Row
-        cur = self.con.cursor()
-        pvalue = (timestamp,)
-        cur.execute(query, pvalue)
+    def get_decimated(self, id, quantity, points, start=None, end=None, columns=False):
+        '''
+        Decimates the values of one quantity of a device to at most points
+        values for plotting. The range is split into points/2 equal time
+        buckets and the minimum and the maximum value of each bucket are
+        kept (min/max per pixel), so peaks survive the decimation. The
+        buckets are computed by sqlite in two GROUP BY queries, there is no
+        loop over the rows in Python. Missing and deleted values are left out.
+
+        :param quantity: key of :py:data:`QUANTITIES`, e.g. 'speed'
+        :param points: maximum number of values returned, at least 2
+        :param start: first included timestamp or None
+        :param end: first excluded timestamp or None
+        :param columns: return the values as columns, see :py:meth:`get_series_columns`
+        :return: list of dicts with timestamp and the value, ordered by timestamp.
+            All the values are returned if there are no more than points of them.
+        :raises ValueError: if quantity or points is not valid
+        '''
+
+        if quantity not in QUANTITIES:
+            raise ValueError("Unknown quantity %s" % quantity)
+        try:
+            points = int(points)
+        except(ValueError, TypeError):
+            raise ValueError("The number of points is malformed")
+        if points < 2:
+            raise ValueError("The number of points must be at least 2")
+
+        column = QUANTITIES[quantity]
+        values = "SELECT date, CAST({0} AS REAL) AS v FROM WIND_DATA WHERE device_id = ? " \
+                 "AND {0} IS NOT NULL AND {0} != ''".format(column)
+        qvalue = [id]
+        condition, condition_values = get_range_filter(start, end)
+        values += condition
+        qvalue += condition_values
+
+        cur = self._execute('SELECT COUNT(*), MIN(date), MAX(date) FROM ({})'.format(values), qvalue)
+        count, first, last = cur.fetchone()
+        if count <= points:
+            cur = self._execute(values + ' ORDER BY date ASC', qvalue)
+        else:
+            #ceil of the range divided by the number of buckets
+            buckets = points // 2
+            width = (last - first + buckets) // buckets
+            #a bare column next to a single MIN/MAX comes from the row of the min/max
+            query = 'WITH v AS ({0}) SELECT date, value FROM (' \
+                    'SELECT date, MIN(v) AS value FROM v GROUP BY (date - ?) / ? UNION ' \
+                    'SELECT date, MAX(v) AS value FROM v GROUP BY (date - ?) / ?) ORDER BY date ASC'.format(values)
+            cur = self._execute(query, qvalue + [first, width, first, width])
+
+        if columns:
+            return self._read_columns(cur, [quantity])
+        return [{'timestamp': date, quantity: value} for date, value in cur]
+
+
+    #STUFF
+    def _get_series(self, id, quantity, start=None, end=None, limit=None, stream=False):
+        '''
+        Reads the values of one quantity of a device ordered by date. Only the
+        date and the column of the quantity are selected and the dicts are
+        built straight from the plain tuples of the cursor. The range is
+        filtered on the (device_id, date) primary key, so only the rows of
+        the page are read.
+
+        :param quantity: key of :py:data:`QUANTITIES`
+        :param start: first included timestamp or None
+        :param end: first excluded timestamp or None
+        :param limit: maximum number of rows or None
+        :param stream: return a generator over the cursor instead of a list
+        '''
+
+        cur = self._get_series_cursor(id, [quantity], start, end, limit)
 
-        #Do the response shait
-        row = cur.fetchone()
-        if row  is None:
-            return None
         #build return object
-        return self._create_pressure_object(row)
+        items = ({'timestamp': date, quantity: value} for date, value in cur)
+        if stream:
+            return items
+        return list(items)
 
+    def get_series_columns(self, id, quantity, start=None, end=None, limit=None):
+        '''
+        Reads the same values as the collection getters (e.g.
+        :py:meth:`get_speeds`) as two parallel lists instead of a list of
+        dicts. The lists are filled straight from the rows of the cursor.
+
+        :param quantity: key of :py:data:`QUANTITIES`, e.g. 'speed'
+        :param start: first included timestamp or None
+        :param end: first excluded timestamp or None
+        :param limit: maximum number of values or None
+        :return: dict {'timestamp': [...], quantity: [...]}, the lists are empty if there are no values
+        '''
 
-    def get_humidities(self, id):
-        # Create SQL statement
-        # query = 'SELECT * FROM WIND_DATA WHERE date > %s AND date < %s ORDER BY date ASC' % str(start) % str(end)
-        query = 'SELECT * FROM WIND_DATA WHERE device_id = ?'
+        if quantity not in QUANTITIES:
+            raise ValueError("Unknown quantity %s" % quantity)
+        return self._read_columns(self._get_series_cursor(id, [quantity], start, end, limit), [quantity])
 
-        # sort
-        query += ' ORDER BY date ASC'
+    def get_series_fields(self, id, fields, start=None, end=None, limit=None, columns=False):
+        '''
+        Reads the values of several quantities of a device in one query, so
+        the rows are read only once for all of them.
+
+        :param fields: list of keys of :py:data:`QUANTITIES`, e.g. ['speed', 'temperature']
+        :param start: first included timestamp or None
+        :param end: first excluded timestamp or None
+        :param limit: maximum number of rows or None
+        :param columns: return the values as columns, see :py:meth:`get_series_columns`
+        :return: list of dicts with timestamp and a value per field, ordered by
+            timestamp, or dict {'timestamp': [...], field: [...], ...} with columns
+        :raises ValueError: if a field is not valid
+        '''
 
-        qvalue = (id,)
+        fields = self._check_fields(fields)
+        cur = self._get_series_cursor(id, fields, start, end, limit)
+        if columns:
+            return self._read_columns(cur, fields)
+        keys = ['timestamp'] + fields
+        return [dict(zip(keys, row)) for row in cur]
 
-        # cursor & row init
-        self.con.row_factory = sqlite3.Row
-        cur = self.con.cursor()
+    def get_decimated_fields(self, id, fields, points, start=None, end=None, columns=False):
+        '''
+        Decimates the values of several quantities of a device to at most
+        points rows for plotting, in one query. The range is split into
+        equal time buckets and for every field the rows with the smallest
+        and the largest value of each bucket are kept, with the values of
+        all the fields at those rows. The number of buckets is
+        points / (2 * number of fields). See :py:meth:`get_decimated` for one quantity.
+
+        :param fields: list of keys of :py:data:`QUANTITIES`
+        :param points: maximum number of rows returned, at least 2 per field
+        :return: as :py:meth:`get_series_fields`, the values are REAL and
+            missing and deleted values are None. All the rows are returned
+            if there are no more than points of them.
+        :raises ValueError: if a field or points is not valid
+        '''
 
-        # Execute SQL statement
-        cur.execute(query, qvalue)
+        fields = self._check_fields(fields)
+        try:
+            points = int(points)
+        except(ValueError, TypeError):
+            raise ValueError("The number of points is malformed")
+        if points < 2 * len(fields):
+            raise ValueError("The number of points must be at least 2 per field")
+
+        #'' would be cast to 0.0, keep it NULL
+        values = "SELECT date, {} FROM WIND_DATA WHERE device_id = ?".format(', '.join(
+            "CASE WHEN {0} IS NULL OR {0} = '' THEN NULL ELSE CAST({0} AS REAL) END AS f{1}".format(QUANTITIES[field], i)
+            for i, field in enumerate(fields)))
+        qvalue = [id]
+        condition, condition_values = get_range_filter(start, end)
+        values += condition
+        qvalue += condition_values
+        selected = ', '.join('f%d' % i for i in range(len(fields)))
+
+        cur = self._execute('SELECT COUNT(*), MIN(date), MAX(date) FROM ({})'.format(values), qvalue)
+        count, first, last = cur.fetchone()
+        if count <= points:
+            cur = self._execute('SELECT date, {} FROM ({}) ORDER BY date ASC'.format(selected, values), qvalue)
+        else:
+            buckets = points // (2 * len(fields))
+            width = (last - first + buckets) // buckets
+            #rank the rows of each bucket from both ends for every field, missing values last
+            ranks = ', '.join(
+                'ROW_NUMBER() OVER (PARTITION BY b ORDER BY f{0} IS NULL, f{0}) AS low{0}, '
+                'ROW_NUMBER() OVER (PARTITION BY b ORDER BY f{0} IS NULL, f{0} DESC) AS high{0}'.format(i)
+                for i in range(len(fields)))
+            kept = ' OR '.join('(f{0} IS NOT NULL AND (low{0} = 1 OR high{0} = 1))'.format(i)
+                               for i in range(len(fields)))
+            query = 'SELECT date, {0} FROM (SELECT *, {1} FROM (SELECT *, (date - ?) / ? AS b FROM ({2}))) ' \
+                    'WHERE {3} ORDER BY date ASC'.format(selected, ranks, values, kept)
+            cur = self._execute(query, [first, width] + qvalue)
+
+        if columns:
+            return self._read_columns(cur, fields)
+        keys = ['timestamp'] + fields
+        return [dict(zip(keys, row)) for row in cur]
+
+    def _check_fields(self, fields):
+        '''
+        :return: fields as a list without duplicates
+        :raises ValueError: if there are no fields or a field is not a key of :py:data:`QUANTITIES`
+        '''
+        fields = list(OrderedDict.fromkeys(fields))
+        if not fields:
+            raise ValueError("No fields given")
+        for field in fields:
+            if field not in QUANTITIES:
+                raise ValueError("Unknown quantity %s" % field)
+        return fields
+
+    def get_series_arrays(self, id, quantity, start=None, end=None):
+        '''
+        Reads the values of one quantity of a device into typed buffers for
+        binary export (see export.py). The values are cast to REAL by sqlite.
+
+        :param quantity: key of :py:data:`QUANTITIES`, e.g. 'speed'
+        :param start: first included timestamp or None
+        :param end: first excluded timestamp or None
+        :return: (dates, values) as array.array of typecode 'q' (int64) and
+            'd' (float64). Missing and deleted values are NaN.
+        :raises ValueError: if quantity is not valid
+        '''
 
-        # results
+        if quantity not in QUANTITIES:
+            raise ValueError("Unknown quantity %s" % quantity)
+
+        #'' would be cast to 0.0. The missing values are the text 'nan' so that
+        #float() makes every value of a column, sqlite cannot store a NaN
+        query = "SELECT date, CASE WHEN {0} IS NULL OR {0} = '' THEN 'nan' ELSE CAST({0} AS REAL) END " \
+                "FROM WIND_DATA WHERE device_id = ?".format(QUANTITIES[quantity])
+        qvalue = [id]
+        condition, condition_values = get_range_filter(start, end)
+        query += condition
+        qvalue += condition_values
+        query += ' ORDER BY date ASC'
+
+        cur = self._execute(query, qvalue)
+        dates = array('q')
+        values = array('d')
+        #the arrays are filled a batch of rows at a time, the columns of the
+        #batch are split and converted by zip, map and extend without a Python loop
+        while True:
+            rows = cur.fetchmany(ARRAY_FETCH_SIZE)
+            if not rows:
+                return dates, values
+            batch_dates, batch_values = zip(*rows)
+            dates.extend(batch_dates)
+            values.extend(map(float, batch_values))
+
+    def _read_columns(self, cur, fields):
         rows = cur.fetchall()
-        if rows is None:
-            return None
-        # build return object
-        humidities = []
-        for row in rows:
-            humi = self._create_humidity_object(row)
-            humidities.append(humi)
-        return humidities
+        columns = {'timestamp': [row[0] for row in rows]}
+        for i, field in enumerate(fields, 1):
+            columns[field] = [row[i] for row in rows]
+        return columns
 
+    def _get_series_cursor(self, id, fields, start, end, limit):
+        '''
+        Executes the query of :py:meth:`_get_series` for the given list of quantities.
+
+        :return: cursor over (date, value, ...) tuples
+        '''
 
-    def get_temperatures(self, id):
         #Create SQL statement
-        #query = 'SELECT * FROM WIND_DATA WHERE date > %s AND date < %s ORDER BY date ASC' % str(start) % str(end)
-        query = 'SELECT * FROM WIND_DATA WHERE device_id = ?'
+        query = 'SELECT date, {} FROM WIND_DATA WHERE device_id = ?'.format(
+            ', '.join(QUANTITIES[field] for field in fields))
+        qvalue = [id]
+        condition, condition_values = get_range_filter(start, end)
+        query += condition
+        qvalue += condition_values
 
         #sort
         query += ' ORDER BY date ASC'
+        if limit is not None:
+            query += ' LIMIT ?'
+            qvalue.append(limit)
 
-        qvalue = (id,)
+        #plain tuples, no sqlite3.Row
+        cur = self._execute(query, qvalue)
+        return cur
 
-        #cursor & row init
-        self.con.row_factory = sqlite3.Row
-        cur = self.con.cursor()
+    def _get_value(self, id, timestamp, quantity):
+        '''
+        Reads the value of one quantity at timestamp.
 
-        #Execute SQL statement
-        cur.execute(query, qvalue)
+        :param id: device id, None to match any device
+        :param quantity: key of :py:data:`QUANTITIES`
+        :return: dict with timestamp and the value or None if there is no row
+        '''
 
-        #results
-        rows = cur.fetchall()
-        if rows is None:
+        if id is None:
+            row = self._execute(get_statement('value_any_device', quantity), (timestamp,)).fetchone()
+        else:
+            row = self._execute(get_statement('value', quantity), (timestamp, id)).fetchone()
+        if row is None:
             return None
-        #build return object
-        temperatures = []
-        for row in rows:
-            temp = self._create_temperature_object(row)
-            temperatures.append(temp)
-        return temperatures
+        return {'timestamp': row[0], quantity: row[1]}
 
+    def _delete_value(self, id, timestamp, quantity):
+        '''
+        Deletes the value of one quantity at timestamp. A deleted value is "".
 
-    def get_pressure(self, timestamp):
-        query = 'SELECT * FROM WIND_DATA WHERE date = ?'
-        self.con.row_factory = sqlite3.Row
-        cur = self.con.cursor()
-        pvalue = (timestamp,)
-        cur.execute(query, pvalue)
+        :param quantity: key of :py:data:`QUANTITIES`
+        :return: True if the value was deleted, False if there is no row at
+            timestamp or the value is already deleted
+        :raises ValueError: if id or timestamp is malformed
+        '''
 
-        #Do the response shait
-        row = cur.fetchone()
-        if row  is None:
-            return None
-        #build return object
-        return self._create_pressure_object(row)
+        try:
+            id = int(id)
+            timestamp = int(timestamp)
+        except(ValueError, TypeError):
+            raise ValueError("The deviceid is malformed")
 
+        #check if value already deleted
+        if not self.contains_value(id, timestamp, quantity):
+            return False
+
+        #remove value
+        try:
+            self._execute(get_statement('set_value', quantity), ("", id, timestamp))
+            self.con.commit()
+            return True
+        except sqlite3.Error as e:
+            print("Error %s:" % (e.args[0]))
+            return False
+
+    def _modify_value(self, id, timestamp, quantity, value):
+        '''
+        Modifies the value of one quantity at timestamp.
+
+        :param quantity: key of :py:data:`QUANTITIES`
+        :return: True if the value was modified, False if there is no row at timestamp
+        :raises ValueError: if id or timestamp is malformed
+        '''
+
+        try:
+            id = int(id)
+            timestamp = int(timestamp)
+        except(ValueError, TypeError):
+            raise ValueError("The deviceid is malformed")
+
+        #modify value, no row is changed if the timestamp does not exist
+        try:
+            cur = self._execute(get_statement('set_value', quantity), (value, id, timestamp))
+            self.con.commit()
+            return cur.rowcount > 0
+        except sqlite3.Error as e:
+            print("Error %s:" % (e.args[0]))
+            return False
+
+    def _add_value(self, id, timestamp, quantity, value):
+        '''
+        Adds the value of one quantity at timestamp. If there is a row at
+        timestamp already its value is modified instead.
+
+        :param quantity: key of :py:data:`QUANTITIES`
+        :return: dict with timestamp, the value and device_id if a row was
+            added, True if the value of an existing row was modified, False if
+            the value could not be written
+        :raises ValueError: if id or timestamp is malformed
+        '''
+
+        try:
+            id = int(id)
+            timestamp = int(timestamp)
+        except(ValueError, TypeError):
+            raise ValueError("The messageid is malformed")
+
+        if self.contains_timestamp(id, timestamp):
+            return self._modify_value(id, timestamp, quantity, value)
+
+        # if there is no timestamp create new entry
+        try:
+            self._execute(get_statement('insert_value', quantity), (id, timestamp, value))
+            self.con.commit()
+            return {"timestamp": timestamp, quantity: value, "device_id": id}
+        except sqlite3.Error as e:
+            print("Error %s:" % (e.args[0]))
+            return False
 
-    #STUFF
     def contains_timestamp(self, id, timestamp):
-        query = 'SELECT * FROM WIND_DATA WHERE device_id = ? AND date = ?'
         #check if there is timestamp in DB
-        self.con.row_factory = sqlite3.Row
-        cur = self.con.cursor()
-        qvalue = (id, timestamp,)
-        cur.execute(query, qvalue,)
-        row = cur.fetchone()
+        row = self._execute(get_statement('contains_timestamp'), (id, timestamp)).fetchone()
 
         #if timestamp does not exist
         if row is None:
@@ -832,22 +1824,19 @@ class Connection(object):
             return True
 
     def contains_value(self, id, timestamp, column):
-        self.con.row_factory = sqlite3.Row
-        cur = self.con.cursor()
-        #NO plaeholders for tables or column names - WTF!
-        #Ok, might be valid idea for security reasons, however  roundabout -->
-        cur.execute('SELECT {} FROM WIND_DATA WHERE device_id = {} AND date = {}'.format(column, id, timestamp))
-        row = cur.fetchone()
+        '''
+        :param column: key of :py:data:`QUANTITIES`, e.g. 'temperature'
+        :return: True if there is a value that is not null or deleted ("") at timestamp
+        :raises ValueError: if column is not a key of :py:data:`QUANTITIES`
+        '''
+        #the column comes from the whitelist, id and timestamp are parameters
+        row = self._execute(get_statement('value', column), (timestamp, id)).fetchone()
         #if value in column does not exist
-        #print(row[0])
         if row is None:
-            #print("1")
             return False
-        elif row[0] is "" or row[0] is None:
-            #print(2)
+        elif row[1] == "" or row[1] is None:
             return False
         else:
-            #print(3)
             return True
 
 
@@ -0,0 +1,83 @@
+# Binary export of device series in the NumPy .npy/.npz formats
+
+import io, struct, sys, zipfile
+
+NPY = "application/x-npy"
+NPZ = "application/x-npz"
+
+#numpy dtype of the typecodes of the arrays from dbhandler.Connection.get_series_arrays
+DTYPES = {'q': '<i8', 'd': '<f8'}
+
+NPY_MAGIC = b'\x93NUMPY\x01\x00'
+
+
+def npy_header(descr, length):
+    '''
+    Creates the header of a version 1.0 .npy file of a one dimensional array.
+    The header is padded so that the data starts at a multiple of 64 bytes.
+
+    :param descr: numpy dtype descr, e.g. '<f8' or [('date', '<i8'), ('speed', '<f8')]
+    :param length: number of items in the array
+    '''
+    header = "{'descr': %r, 'fortran_order': False, 'shape': (%d,), }" % (descr, length)
+    padding = 64 - (len(NPY_MAGIC) + 2 + len(header) + 1) % 64
+    header = (header + ' ' * padding + '\n').encode('latin1')
+    return NPY_MAGIC + struct.pack('<H', len(header)) + header
+
+
+def little_endian(values):
+    '''
+    :param values: array.array
+    :return: the bytes of the array in little endian order
+    '''
+    if sys.byteorder == 'big':
+        values = values[:]
+        values.byteswap()
+    return values.tobytes()
+
+
+def to_npy(values):
+    '''
+    :param values: array.array of typecode 'q' or 'd'
+    :return: bytes of the .npy file of the array
+    '''
+    return npy_header(DTYPES[values.typecode], len(values)) + little_endian(values)
+
+
+def to_npz(columns):
+    '''
+    Creates a .npz file with one array per column. numpy.load of the file
+    gives a mapping from the column names to the arrays. The members are
+    stored uncompressed.
+
+    :param columns: list of (name, array.array)
+    :return: bytes of the .npz file
+    '''
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_STORED) as npz:
+        for name, values in columns:
+            npz.writestr(name + '.npy', to_npy(values))
+    return buffer.getvalue()
+
+
+def to_npy_records(columns):
+    '''
+    Creates a .npy file of a structured array with one field per column,
+    e.g. numpy.load(...)['speed'].
+
+    :param columns: list of (name, array.array) of the same length
+    :return: bytes of the .npy file
+    '''
+    descr = [(name, DTYPES[values.typecode]) for name, values in columns]
+    length = len(columns[0][1]) if columns else 0
+    row_size = sum(values.itemsize for name, values in columns)
+    records = bytearray(row_size * length)
+    #each byte of a field is copied into every record with one extended slice
+    #assignment, which interleaves the columns without packing the rows one by one
+    offset = 0
+    for name, values in columns:
+        data = little_endian(values)
+        for byte in range(values.itemsize):
+            records[offset + byte::row_size] = data[byte::values.itemsize]
+        offset += values.itemsize
+    return npy_header(descr, length) + bytes(records)
@@ -0,0 +1,311 @@
+# Request and database metrics of the wind API
+
+from contextlib import contextmanager
+import os, threading, time
+
+import dbhandler
+
+# Upper bounds of the buckets of the latency histograms, in milliseconds
+BUCKETS = (0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+# Maximum number of different statements counted, the others are counted together
+MAX_QUERIES = 500
+OTHER_QUERIES = '(other statements)'
+
+# Rows fetched at a time when a measured cursor is iterated
+FETCH_SIZE = 256
+
+#the timer of the request handled by each thread
+_local = threading.local()
+
+
+class Histogram(object):
+    '''
+    Counts of durations in the buckets of :py:data:`BUCKETS`. The percentiles
+    are estimated as the upper bound of the bucket they fall in.
+    Not thread safe, :py:class:`Metrics` holds its lock while using it.
+    '''
+
+    def __init__(self, buckets=BUCKETS):
+        super(Histogram, self).__init__()
+        self.buckets = buckets
+        #the last count is of the durations over the largest bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, ms):
+        index = 0
+        while index < len(self.buckets) and ms > self.buckets[index]:
+            index += 1
+        self.counts[index] += 1
+        self.count += 1
+        self.total += ms
+        self.max = max(self.max, ms)
+
+    def percentile(self, p):
+        if not self.count:
+            return None
+        rank = p * self.count / 100.0
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return round(min(bound, self.max), 3)
+        return round(self.max, 3)
+
+    def stats(self):
+        return {'count': self.count,
+                'mean': round(self.total / self.count, 3) if self.count else None,
+                'p50': self.percentile(50), 'p95': self.percentile(95), 'p99': self.percentile(99),
+                'max': round(self.max, 3),
+                'buckets': dict([(str(bound), count) for bound, count in zip(self.buckets, self.counts)] +
+                                [('+Inf', self.counts[-1])])}
+
+
+class RequestTimer(object):
+    '''
+    Time spent by one request in each phase: waiting for a database
+    connection (pool), running queries and fetching rows (db) and
+    serializing the response (serialize).
+    '''
+
+    def __init__(self, metrics):
+        super(RequestTimer, self).__init__()
+        self.metrics = metrics
+        self.started = time.perf_counter()
+        #phase -> seconds
+        self.phases = {}
+        self.queries = 0
+        self.rows = 0
+        #"hit" or "miss" of the response cache, None if not cached
+        self.cache = None
+
+    def add(self, phase, seconds):
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def server_timing(self):
+        '''
+        :return: value of the Server-Timing header with the phases so far
+        '''
+        metrics = []
+        for phase in ('pool', 'db', 'serialize'):
+            if phase in self.phases:
+                description = ';desc="%d queries, %d rows"' % (self.queries, self.rows) if phase == 'db' else ''
+                metrics.append('%s;dur=%.3f%s' % (phase, self.phases[phase] * 1000, description))
+        if self.cache is not None:
+            metrics.append('cache;desc="%s"' % self.cache)
+        metrics.append('app;dur=%.3f' % (self.elapsed() * 1000))
+        return ', '.join(metrics)
+
+
+class Metrics(object):
+    '''
+    Latency histograms of the routes and timings of the SQL statements of
+    one process. With several worker processes each one has its own.
+
+    :Example:
+
+    >>> metrics = Metrics()
+    >>> timer = metrics.start_request()
+    >>> metrics.end_request('GET speeds', 200)
+    >>> metrics.stats()['routes']['GET speeds']['statuses']
+    {'200': 1}
+
+    :param max_queries: maximum number of different statements counted
+    '''
+
+    def __init__(self, max_queries=MAX_QUERIES):
+        super(Metrics, self).__init__()
+        self.max_queries = max_queries
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.started = time.time()
+            #route -> {'latency', 'db', 'serialize': Histogram, 'statuses': {status: count}}
+            self.routes = {}
+            #normalized SQL -> [calls, seconds, max seconds of an execution, rows]
+            self.queries = {}
+
+    def start_request(self):
+        '''
+        Starts timing the request handled by the current thread.
+        '''
+        timer = RequestTimer(self)
+        _local.timer = timer
+        return timer
+
+    def end_request(self, route, status):
+        '''
+        Records the request handled by the current thread.
+
+        :param route: e.g. "GET speeds"
+        :param status: HTTP status code of the response
+        '''
+        timer = current_timer()
+        _local.timer = None
+        if timer is None:
+            return
+        elapsed = timer.elapsed()
+        with self._lock:
+            entry = self.routes.get(route)
+            if entry is None:
+                entry = self.routes[route] = {'latency': Histogram(), 'db': Histogram(), 'serialize': Histogram(),
+                                              'statuses': {}}
+            entry['latency'].observe(elapsed * 1000)
+            entry['db'].observe(timer.phases.get('db', 0.0) * 1000)
+            entry['serialize'].observe(timer.phases.get('serialize', 0.0) * 1000)
+            status = str(status)
+            entry['statuses'][status] = entry['statuses'].get(status, 0) + 1
+
+    def record_query(self, query, seconds, rows, calls=1):
+        '''
+        Adds the time and rows of an execution (calls=1) or of fetching
+        more rows of it (calls=0) to the statement.
+        '''
+        query = dbhandler.normalize_sql(query)
+        with self._lock:
+            entry = self.queries.get(query)
+            if entry is None:
+                if len(self.queries) >= self.max_queries:
+                    query = OTHER_QUERIES
+                entry = self.queries.setdefault(query, [0, 0.0, 0.0, 0])
+            entry[0] += calls
+            entry[1] += seconds
+            if calls:
+                entry[2] = max(entry[2], seconds)
+            entry[3] += rows
+
+    def stats(self, queries=None):
+        '''
+        :param queries: number of statements returned, the ones that took the
+            longest in total first. All of them if None
+        :return: dict of the metrics
+        '''
+        with self._lock:
+            routes = dict((route, {'count': entry['latency'].count, 'statuses': dict(entry['statuses']),
+                                   'latency_ms': entry['latency'].stats(), 'db_ms': entry['db'].stats(),
+                                   'serialize_ms': entry['serialize'].stats()})
+                          for route, entry in self.routes.items())
+            statements = sorted(self.queries.items(), key=lambda item: item[1][1], reverse=True)
+        statements = [{'sql': query, 'calls': calls, 'total_ms': round(seconds * 1000, 3),
+                       'mean_ms': round(seconds * 1000 / calls, 3) if calls else None,
+                       'max_ms': round(longest * 1000, 3), 'rows': rows}
+                      for query, (calls, seconds, longest, rows) in statements[:queries]]
+        return {'pid': os.getpid(), 'uptime': round(time.time() - self.started, 1),
+                'routes': routes, 'queries': statements}
+
+
+def current_timer():
+    '''
+    :return: the RequestTimer of the request handled by the current thread, or None
+    '''
+    return getattr(_local, 'timer', None)
+
+
+@contextmanager
+def phase(name):
+    '''
+    Adds the time spent in the block to a phase of the current request.
+
+    >>> with phase('serialize'):
+    ...     body = json.dumps(dump)
+    '''
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timer = current_timer()
+        if timer is not None:
+            timer.add(name, time.perf_counter() - started)
+
+
+class TimedCursor(object):
+    '''
+    sqlite3 cursor that adds the time spent fetching rows, and their number,
+    to its statement and to the current request. The other attributes are
+    the ones of the cursor.
+    '''
+
+    def __init__(self, cursor, timer, query):
+        super(TimedCursor, self).__init__()
+        self.cursor = cursor
+        self.timer = timer
+        self.query = query
+
+    def _fetched(self, started, rows):
+        seconds = time.perf_counter() - started
+        self.timer.add('db', seconds)
+        self.timer.rows += rows
+        self.timer.metrics.record_query(self.query, seconds, rows, calls=0)
+
+    def fetchone(self):
+        started = time.perf_counter()
+        row = self.cursor.fetchone()
+        self._fetched(started, row is not None)
+        return row
+
+    def fetchmany(self, size=None):
+        started = time.perf_counter()
+        rows = self.cursor.fetchmany(self.cursor.arraysize if size is None else size)
+        self._fetched(started, len(rows))
+        return rows
+
+    def fetchall(self):
+        started = time.perf_counter()
+        rows = self.cursor.fetchall()
+        self._fetched(started, len(rows))
+        return rows
+
+    def __iter__(self):
+        #timed per batch, timing every row would cost more than fetching it
+        while True:
+            rows = self.fetchmany(FETCH_SIZE)
+            if not rows:
+                return
+            for row in rows:
+                yield row
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+
+class InstrumentedConnection(dbhandler.Connection):
+    '''
+    :py:class:`dbhandler.Connection` that measures every statement executed
+    while a request is timed, see :py:meth:`Metrics.start_request`. Use it
+    as the connection_class of the Engine.
+    '''
+
+    def _execute(self, query, qvalue=(), row_factory=None):
+        timer = current_timer()
+        if timer is None:
+            return super(InstrumentedConnection, self)._execute(query, qvalue, row_factory)
+        started = time.perf_counter()
+        cur = super(InstrumentedConnection, self)._execute(query, qvalue, row_factory)
+        self._executed(timer, query, started, cur)
+        return TimedCursor(cur, timer, query)
+
+    def _executemany(self, query, qvalues):
+        timer = current_timer()
+        if timer is None:
+            return super(InstrumentedConnection, self)._executemany(query, qvalues)
+        started = time.perf_counter()
+        cur = super(InstrumentedConnection, self)._executemany(query, qvalues)
+        self._executed(timer, query, started, cur)
+        return cur
+
+    def _executed(self, timer, query, started, cur):
+        seconds = time.perf_counter() - started
+        #rows changed by a write, -1 for a query
+        rows = max(cur.rowcount, 0)
+        timer.add('db', seconds)
+        timer.queries += 1
+        timer.rows += rows
+        timer.metrics.record_query(query, seconds, rows)
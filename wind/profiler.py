@@ -0,0 +1,121 @@
+# Profiling of single requests of the wind API
+
+import cProfile, os, sys, threading, time
+
+# Profilers a request can be run under: the sampling profiler writes
+# collapsed stacks (flame graphs), cProfile writes pstats files
+MODES = ('sample', 'cprofile')
+
+# Seconds between the samples of the sampling profiler. While the request
+# holds the GIL the sampler only runs every sys.getswitchinterval() seconds
+DEFAULT_INTERVAL = 0.001
+
+
+class SamplingProfiler(object):
+    '''
+    Samples the stack of one thread from a background thread.
+
+    The samples are written in the collapsed stack format, one line
+    "outermost;...;innermost count" per stack, which is the input of
+    flamegraph.pl, speedscope and inferno.
+
+    :Example:
+
+    >>> profiler = SamplingProfiler()
+    >>> profiler.start()
+    >>> handle_request()
+    >>> profiler.stop()
+    >>> profiler.dump('speeds.folded')
+
+    :param interval: seconds between the samples
+    :param thread_id: thread sampled, by default the one calling start
+    '''
+
+    extension = '.folded'
+
+    def __init__(self, interval=DEFAULT_INTERVAL, thread_id=None):
+        super(SamplingProfiler, self).__init__()
+        self.interval = interval
+        self.thread_id = thread_id
+        #stack -> number of samples
+        self.stacks = {}
+        self.samples = 0
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self.thread_id is None:
+            self.thread_id = threading.get_ident()
+        self._thread = threading.Thread(target=self._run, name='wind-profiler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None or self._stopped.is_set():
+                return
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                frame = frame.f_back
+            stack = ';'.join(reversed(stack))
+            self.stacks[stack] = self.stacks.get(stack, 0) + 1
+            self.samples += 1
+
+    def dump(self, path):
+        with open(path, 'w') as f:
+            for stack, count in sorted(self.stacks.items()):
+                f.write('%s %d\n' % (stack, count))
+
+
+class CProfileProfiler(object):
+    '''
+    Runs the calls of the current thread under cProfile. The statistics are
+    written as a pstats file (python -m pstats, snakeviz, flameprof).
+    '''
+
+    extension = '.pstats'
+
+    def __init__(self):
+        super(CProfileProfiler, self).__init__()
+        self.profile = cProfile.Profile()
+
+    def start(self):
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+
+    def dump(self, path):
+        self.profile.dump_stats(path)
+
+
+def create_profiler(mode, interval=DEFAULT_INTERVAL):
+    '''
+    :param mode: a value of :py:data:`MODES`
+    :raises ValueError: if the mode is unknown
+    '''
+    if mode == 'sample':
+        return SamplingProfiler(interval)
+    if mode == 'cprofile':
+        return CProfileProfiler()
+    raise ValueError("Unknown profiler %s" % mode)
+
+
+def get_profile_path(directory, route, profiler):
+    '''
+    :param route: e.g. "GET speeds", the profiles of a route are kept in their own folder
+    :return: path of a new profile file of the route
+    '''
+    folder = os.path.join(directory, route.replace(' ', '-'))
+    os.makedirs(folder, exist_ok=True)
+    #the pid and the thread keep the names of concurrent requests apart
+    name = '%s-%06d-%d-%d%s' % (time.strftime('%Y%m%d-%H%M%S'), int(time.time() * 1e6) % 1000000,
+                                os.getpid(), threading.get_ident(), profiler.extension)
+    return os.path.join(folder, name)
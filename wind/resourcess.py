@@ -1,9 +1,10 @@
 # -*- coding: utf-8 -*-
-import json
+import json, re, gzip, hashlib, os
 
-from urllib.parse import unquote
+from urllib.parse import unquote, urlencode
 
-from flask import Flask, request, g, _request_ctx_stack, redirect, send_from_directory, jsonify, make_response
+from flask import Flask, request, g, _request_ctx_stack, redirect, send_from_directory, jsonify, make_response, \
+    abort as flask_abort, stream_with_context, after_this_request
 from flask_restful import Resource, Api, abort
 
 from flask_hal import HALResponse as Response
@@ -14,19 +15,83 @@ from flask_cors import CORS
 from werkzeug.exceptions import NotFound,  UnsupportedMediaType
 
 import dbhandler
+import cache
+import export
+import metrics
+import profiler
+
+#brotli is optional, without it the responses are only gzipped
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 #Constants for formats
 #input
 JSON = "application/json"
+NDJSON = "application/x-ndjson"
 
 #output
 JSONHAL = "application/hal+json"
+#collections as {"timestamp": [...], "<quantity>": [...]}, see series_response
+COLUMNS_JSON = "application/vnd.wind.columns+json"
+
+#number of items serialized per chunk of a streamed collection
+STREAM_CHUNK_ITEMS = 500
+
+#collections of a device: url name -> quantity in dbhandler.QUANTITIES
+COLLECTIONS = {
+    'speeds': 'speed',
+    'batteries': 'battery',
+    'directions': 'direction',
+    'temperatures': 'temperature',
+    'humidities': 'humidity',
+}
+
+#units accepted in the bucket of an aggregate, in seconds
+BUCKET_UNITS = {'': 1, 's': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+#endpoints whose GET responses are kept in the response cache
+CACHED_ENDPOINTS = ('devices', 'device', 'speeds', 'batteries', 'directions', 'temperatures', 'humidities', 'export', 'series',
+                    'aggregate')
+
+#headers restored with a cached response
+CACHED_HEADERS = ('Content-Type', 'ETag', 'Last-Modified', 'Cache-Control', 'Content-Disposition', 'Vary')
+
+#Content types compressed when the client accepts it, and the encodings in order of preference
+COMPRESSED_TYPES = (JSON, JSONHAL, NDJSON, COLUMNS_JSON, "text/html", "text/css", "application/javascript")
+ENCODINGS = ("br", "gzip") if brotli is not None else ("gzip",)
+
+
+def create_engine(db_path=None, slow_query_threshold=None, read_pool_size=None):
+    '''
+    :param slow_query_threshold: seconds, log the slower statements (see dbhandler.SlowQueryLog)
+    :param read_pool_size: size of the pool of read only connections of the
+        GET requests, None to serve them from the pool of the writers
+    :return: the database Engine of the API: WAL so that readers are not
+        blocked by the writer, with periodic checkpoints
+    '''
+    return dbhandler.Engine(db_path, profile="performance", checkpoint_interval=60,
+                            connection_class=metrics.InstrumentedConnection,
+                            slow_query_threshold=slow_query_threshold, read_pool_size=read_pool_size)
+
 
 #for testing
 app = Flask(__name__)
 #app = Flask(__name__, static_folder="static", static_url_path="/.")
 app.debug = True
-app.config.update({"Engine": dbhandler.Engine()})
+app.config.update({"Engine": create_engine(), "POOL_TIMEOUT": 10,
+                   "RESPONSE_CACHE": cache.ResponseCache(),
+                   #request and query timings, SERVER_TIMING sends them in the Server-Timing header
+                   "METRICS": metrics.Metrics(), "SERVER_TIMING": True,
+                   #admin mode: /wind/api/_metrics lists the routes and the SQL statements
+                   "METRICS_ENDPOINT": False,
+                   #admin mode: requests can ask to be profiled (X-Profile header or _profile
+                   #query parameter), the profiles are written to PROFILE_DIR
+                   "PROFILING": False, "PROFILE_DIR": "../profiles", "PROFILE_INTERVAL": profiler.DEFAULT_INTERVAL,
+                   #smaller bodies are not worth compressing
+                   "COMPRESSION_MIN_SIZE": 1024, "COMPRESSION_LEVEL": 6,
+                   "COMPRESSED_CACHE": cache.ResponseCache(max_bytes=16 * 1024 * 1024)})
 
 #for hal
 app.response_class = Response
@@ -49,6 +114,331 @@ app.debug = True
 api = Api(app)
 '''
 
+#Helpers for the collection resources
+def dump_json(obj):
+    '''
+    json.dumps, timed as the serialization of the request (see metrics.phase)
+    '''
+    with metrics.phase('serialize'):
+        return json.dumps(obj)
+
+
+# Query parameters of the pages of a collection that do not apply to its aggregates
+PAGE_ARGUMENTS = ('limit', 'points', 'stream', 'format', 'delta')
+
+
+def get_integer_argument(name):
+    '''
+    :return: the integer value of the query parameter, None if it is missing.
+        Aborts with 400 if it is not an integer
+    '''
+    value = request.args.get(name)
+    try:
+        return None if value is None else int(value)
+    except ValueError:
+        flask_abort(create_error_response(400, "Malformed query parameter",
+                                          "Query parameter %s must be an integer" % name))
+
+
+def get_series_arguments(formats=('items', 'columns')):
+    '''
+    Reads the time range, the page size and the response mode of a collection
+    request from the query string:
+     * start: first included timestamp
+     * end: first excluded timestamp
+     * limit: maximum number of items in the page
+     * stream: if true, the items are streamed from the database cursor
+       as a chunked response instead of being serialized in one go
+     * points: decimate the collection to at most this many items for plotting
+     * format: "items" (default) or "columns" for the columnar representation,
+       which is also chosen by asking for COLUMNS_JSON in the Accept header
+     * delta: if true, the columnar timestamps are sent as differences
+
+    Aborts with 400 if a value is not a (positive for limit, at least 2 for
+    points) integer or the format is unknown.
+
+    :param formats: accepted values of format, the first one is the default
+    :return: dict with start, end, limit, points (None for the missing ones), stream, format, columns, delta
+        and representation: "columns" if the columns are asked, the format otherwise
+    '''
+
+    args = dict((name, get_integer_argument(name)) for name in ('start', 'end', 'limit', 'points'))
+    if args['limit'] is not None and args['limit'] < 1:
+        flask_abort(create_error_response(400, "Malformed query parameter", "Query parameter limit must be positive"))
+    if args['points'] is not None and args['points'] < 2:
+        flask_abort(create_error_response(400, "Malformed query parameter", "Query parameter points must be at least 2"))
+    args['stream'] = request.args.get('stream', '').lower() in ('1', 'true', 'yes')
+    args['delta'] = request.args.get('delta', '').lower() in ('1', 'true', 'yes')
+    args['format'] = request.args.get('format', formats[0])
+    if args['format'] not in formats:
+        flask_abort(create_error_response(400, "Malformed query parameter",
+                                          "Query parameter format must be " + " or ".join(formats)))
+    args['columns'] = wants_columns()
+    args['representation'] = 'columns' if args['columns'] else args['format']
+    return args
+
+
+def wants_columns():
+    '''
+    :return: True if the columnar representation of a collection is asked
+        with ?format=columns or with the COLUMNS_JSON media type in Accept
+    '''
+    if 'format' in request.args:
+        return request.args['format'] == 'columns'
+    return COLUMNS_JSON in request.accept_mimetypes.values()
+
+
+def vary_on_accept():
+    '''
+    Adds Vary: Accept to the response of the current request, whatever its
+    status, because the Accept header can choose the columnar representation.
+    '''
+    @after_this_request
+    def add_vary(response):
+        response.vary.add("Accept")
+        return response
+
+
+def page_url(**params):
+    '''
+    :return: url of the current resource with given query parameters, None values are left out.
+        The other query parameters of the request (e.g. format) are kept.
+    '''
+    params = dict(request.args.items(), **params)
+    params.pop("_profile", None)
+    query = urlencode([(k, v) for k, v in sorted(params.items()) if v is not None])
+    return request.path + ('?' + query if query else '')
+
+
+def get_page_links(id, args, first, last, has_next):
+    '''
+    Creates the next and prev links of a collection page.
+
+    :param first: timestamp of the first item of the page
+    :param last: timestamp of the last item of the page
+    :param has_next: True if there are items after the page
+    :return: list of Links, empty if the collection is not paginated
+    '''
+
+    limit = args['limit']
+    links = []
+    if limit is None:
+        return links
+    if has_next:
+        links.append(Link('next', page_url(start=last + 1, end=args['end'], limit=limit)))
+    previous = g.con.get_previous_start(id, first, limit)
+    if previous is not None:
+        links.append(Link('prev', page_url(start=previous, end=first, limit=limit)))
+    return links
+
+
+def get_series_page(get_items, id, args):
+    '''
+    Extracts one page of a device collection from db using the getter of dbhandler.
+    One extra item is asked to know if there is a next page.
+
+    :param get_items: getter of dbhandler, e.g. g.con.get_speeds
+    :param args: arguments from :py:func:`get_series_arguments`
+    :return: (items, links) where links contains the next and prev links of the page
+    '''
+
+    limit = args['limit']
+    items = get_items(id, args['start'], args['end'], None if limit is None else limit + 1)
+    if not items:
+        return items, []
+    has_next = limit is not None and len(items) > limit
+    if has_next:
+        items = items[:limit]
+    return items, get_page_links(id, args, items[0]['timestamp'], items[-1]['timestamp'], has_next)
+
+
+def get_data_version(id):
+    '''
+    :return: (version, modified) of the data of the device, read once per request
+    '''
+    if g.get('data_version') is None or g.data_version[0] != id:
+        g.data_version = (id, g.con.get_data_version(id))
+    return g.data_version[1]
+
+
+def get_validators(id, representation=None):
+    '''
+    :param representation: representation of the response (e.g. "items",
+        "columns" or "npy"), the representations of the same data have different ETags
+    :return: (etag, last modified unix time or None) of the data of a device,
+        from the data version kept by dbhandler
+    '''
+    version, modified = get_data_version(id)
+    #the time tells apart versions of a database file that was replaced
+    etag = '%s-%d-%s' % (id, version, modified)
+    if representation is not None:
+        etag += '-' + representation
+    return etag, modified
+
+
+def is_not_modified(validators):
+    '''
+    :return: True if the If-None-Match or If-Modified-Since headers of the
+        request show that the client already has this version of the data
+    '''
+    etag, modified = validators
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    if request.if_modified_since and modified is not None:
+        return modified <= request.if_modified_since.timestamp()
+    return False
+
+
+def set_validators(response, validators):
+    '''
+    Adds ETag and Last-Modified to the response. Clients may store the
+    response but must revalidate it, which costs a 304 if nothing has changed.
+    '''
+    etag, modified = validators
+    response.set_etag(etag, weak=True)
+    if modified is not None:
+        response.last_modified = modified
+    response.cache_control.no_cache = True
+    return response
+
+
+def not_modified_response(validators):
+    '''
+    :return: 304 response if the client has the current data of the device, None otherwise
+    '''
+    if is_not_modified(validators):
+        return set_validators(Response(status=304), validators)
+    return None
+
+
+def series_response(get_items, quantity, id, links, not_found):
+    '''
+    Creates the response of a device collection: one page of items and the HAL links.
+    With the points query parameter the items are decimated for plotting
+    instead, see :py:meth:`dbhandler.Connection.get_decimated`.
+
+    :param get_items: getter of dbhandler, e.g. g.con.get_speeds
+    :param quantity: name of the value in the items, e.g. 'speed'
+    :param links: list of Links of the collection
+    :param not_found: (title, message, resource_type) of the 404 error if there are no items
+    '''
+
+    args = get_series_arguments()
+    vary_on_accept()
+
+    #answer conditional requests without reading the rows
+    validators = get_validators(id, args['representation'])
+    not_modified = not_modified_response(validators)
+    if not_modified is not None:
+        return not_modified
+
+    if args['columns']:
+        return columns_series_response([quantity], id, args, links, not_found, validators)
+    if args['points'] is not None:
+        items = g.con.get_decimated(id, quantity, args['points'], args['start'], args['end'])
+        page_links = []
+    elif args['stream']:
+        return stream_series_response(get_items, id, args, links, not_found, validators)
+    else:
+        items, page_links = get_series_page(get_items, id, args)
+    if not items:
+        return create_error_response(404, *not_found)
+
+    # links to dict
+    dump = Collection(*(links + page_links)).to_dict()
+
+    # combine links and items to one dict
+    dump.update({'items': items})
+
+    # return Response
+    return set_validators(Response(dump_json(dump), 200, mimetype=JSONHAL), validators)
+
+
+def columns_series_response(fields, id, args, links, not_found, validators):
+    '''
+    Columnar version of :py:func:`series_response`: the items are sent as
+    {"timestamp": [...], "<quantity>": [...]} next to the links, which leaves
+    out the keys repeated in every item. With the delta query parameter the
+    timestamps are replaced by "timestamp_delta": the first timestamp
+    followed by the differences between consecutive timestamps. The stream
+    query parameter is ignored.
+
+    :param fields: list of the quantities, one column each
+    '''
+
+    limit = args['limit']
+    if args['points'] is not None and len(fields) == 1:
+        columns = g.con.get_decimated(id, fields[0], args['points'], args['start'], args['end'], columns=True)
+    elif args['points'] is not None:
+        columns = g.con.get_decimated_fields(id, fields, args['points'], args['start'], args['end'], columns=True)
+    else:
+        columns = g.con.get_series_fields(id, fields, args['start'], args['end'],
+                                          None if limit is None else limit + 1, columns=True)
+    timestamps = columns['timestamp']
+    if not timestamps:
+        return create_error_response(404, *not_found)
+
+    page_links = []
+    if args['points'] is None:
+        has_next = limit is not None and len(timestamps) > limit
+        if has_next:
+            for values in columns.values():
+                del values[limit:]
+        page_links = get_page_links(id, args, timestamps[0], timestamps[-1], has_next)
+
+    dump = Collection(*(links + page_links)).to_dict()
+    if args['delta']:
+        del columns['timestamp']
+        columns['timestamp_delta'] = timestamps[:1] + [b - a for a, b in zip(timestamps, timestamps[1:])]
+    dump.update(columns)
+
+    mimetype = JSONHAL if 'format' in request.args else COLUMNS_JSON
+    return set_validators(Response(dump_json(dump), 200, mimetype=mimetype), validators)
+
+
+def stream_series_response(get_items, id, args, links, not_found, validators):
+    '''
+    Streaming version of :py:func:`series_response`. The items are read
+    lazily from the database cursor and written out in chunks of
+    STREAM_CHUNK_ITEMS, so memory use does not grow with the collection.
+    The links are written after the items because the next link is only
+    known at the end.
+    '''
+
+    limit = args['limit']
+    items = get_items(id, args['start'], args['end'], None if limit is None else limit + 1, stream=True)
+
+    #the status must be known before the first byte is sent
+    first = next(items, None)
+    if first is None:
+        return create_error_response(404, *not_found)
+
+    def generate():
+        yield '{"items": [' + dump_json(first)
+        last = first
+        count = 1
+        has_next = False
+        chunk = []
+        for item in items:
+            if count == limit:
+                has_next = True
+                break
+            chunk.append(dump_json(item))
+            count += 1
+            last = item
+            if len(chunk) == STREAM_CHUNK_ITEMS:
+                yield ', ' + ', '.join(chunk)
+                chunk = []
+        if chunk:
+            yield ', ' + ', '.join(chunk)
+
+        page_links = get_page_links(id, args, first['timestamp'], last['timestamp'], has_next)
+        #'{"_links": {..}}' without the opening brace closes the document
+        yield '], ' + dump_json(Collection(*(links + page_links)).to_dict())[1:]
+
+    return set_validators(Response(stream_with_context(generate()), 200, mimetype=JSONHAL), validators)
+
+
 #Define the resources
 class Device(Resource):
     '''
@@ -81,7 +471,7 @@ class Device(Resource):
         dump = dict(list(l.items()) + list(device_db.items()))
 
         #return Response
-        return Response(json.dumps(dump), 200, mimetype=JSONHAL)
+        return Response(dump_json(dump), 200, mimetype=JSONHAL)
 
 
 class Devices(Resource):
@@ -114,7 +504,7 @@ class Devices(Resource):
         dump.update({'items': devices_db})
 
         # return Response
-        return Response(json.dumps(dump), 200, mimetype=JSONHAL)
+        return Response(dump_json(dump), 200, mimetype=JSONHAL)
 
 
 class Speed(Resource):
@@ -147,7 +537,7 @@ class Speed(Resource):
         dump = dict(list(l.items()) + list(speed_db.items()))
 
         #return Response
-        return Response(json.dumps(dump), 200, mimetype=JSONHAL)
+        return Response(dump_json(dump), 200, mimetype=JSONHAL)
 
 
 class Battery(Resource):
@@ -181,7 +571,7 @@ class Battery(Resource):
         dump = dict(list(l.items()) + list(battery_db.items()))
 
         #return Response
-        return Response(json.dumps(dump), 200, mimetype=JSONHAL)
+        return Response(dump_json(dump), 200, mimetype=JSONHAL)
 
 
 class Direction(Resource):
@@ -215,7 +605,7 @@ class Direction(Resource):
         dump = dict(list(l.items()) + list(direction_db.items()))
 
         #return Response
-        return Response(json.dumps(dump), 200, mimetype=JSONHAL)
+        return Response(dump_json(dump), 200, mimetype=JSONHAL)
 
 
 class Speeds(Resource):
@@ -229,28 +619,19 @@ class Speeds(Resource):
         params: id
 
         '''
-        #extract speeds from db
-        speeds_db = g.con.get_speeds(id)
-        if not speeds_db:
-            return create_error_response(404, "No speeds found",
-                                     'There is no speeds data on given device id %s' % id, 'Speeds')
 
         # create collection of links
-        links = Collection(
+        links = [
             Self(),
             Link('device', '/wind/api/device/' + id + '/'),
-            Link('speed', '/wind/api/device/' + id + '/speed/{timestamp}')
-        )
-
-        # links to dict
-        l = links.to_dict()
-
-        # combine links and speed to one dict
-        dump = l
-        dump.update({'items': speeds_db})
+            Link('speed', '/wind/api/device/' + id + '/speed/{timestamp}'),
+            Link('aggregate', '/wind/api/device/' + id + '/speeds/aggregate'),
+            Link('export', '/wind/api/device/' + id + '/speeds/export')
+        ]
 
-        # return Response
-        return Response(json.dumps(dump), 200, mimetype=JSONHAL)
+        #extract speeds from db
+        return series_response(g.con.get_speeds, 'speed', id, links,
+                               ("No speeds found", 'There is no speeds data on given device id %s' % id, 'Speeds'))
 
 
 class Batteries(Resource):
@@ -260,106 +641,417 @@ class Batteries(Resource):
         :param id:
         '''
 
-        batteries_db = g.con.get_batteries(id)
+        # create collection of links
+        links = [
+            Self(),
+            Link('device', '/wind/api/device/' + id + '/'),
+            Link('battery', '/wind/api/device/' + id + '/battery/{timestamp}'),
+            Link('aggregate', '/wind/api/device/' + id + '/batteries/aggregate'),
+            Link('export', '/wind/api/device/' + id + '/batteries/export')
+        ]
+
+        return series_response(g.con.get_batteries, 'battery', id, links,
+                               ("No batteries found", 'There is no batteries data on given device id %s' % id, 'Batteries'))
 
-        if not batteries_db:
-            return create_error_response(404, "No batteries found",
-                                     'There is no batteries data on given device id %s' % id, 'Batteries')
 
+class Directions(Resource):
+    def get(self, id):
         # create collection of links
-        links = Collection(
+        links = [
             Self(),
             Link('device', '/wind/api/device/' + id + '/'),
-            Link('battery', '/wind/api/device/' + id + '/battery/{timestamp}')
-        )
+            Link('direction', '/wind/api/device/' + id + '/direction/{timestamp}'),
+            Link('aggregate', '/wind/api/device/' + id + '/directions/aggregate'),
+            Link('export', '/wind/api/device/' + id + '/directions/export')
+        ]
 
-        # links to dict
-        l = links.to_dict()
+        return series_response(g.con.get_directions, 'direction', id, links,
+                               ("No directions found", 'There is no directions data on given device id %s' % id, 'Diretions'))
 
-        # combine links and speed to one dict
-        dump = l
-        dump.update({'items': batteries_db})
 
-        # return Response
-        return Response(json.dumps(dump), 200, mimetype=JSONHAL)
+class Temperatures(Resource):
+    def get(self, id):
+        # create collection of links
+        links = [
+            Self(),
+            Link('device', '/wind/api/device/' + id + '/'),
+            Link('temperature', '/wind/api/device/' + id + '/temperature/{timestamp}'),
+            Link('aggregate', '/wind/api/device/' + id + '/temperatures/aggregate'),
+            Link('export', '/wind/api/device/' + id + '/temperatures/export')
+        ]
 
+        return series_response(g.con.get_temperatures, 'temperature', id, links,
+                               ("No temperatures found", 'There is no temperatures data on given device id %s' % id, 'Temperatures'))
 
-class Directions(Resource):
+
+class Humidities(Resource):
     def get(self, id):
-        directions_db = g.con.get_directions(id)
+        # create collection of links
+        links = [
+            Self(),
+            Link('device', '/wind/api/device/' + id + '/'),
+            Link('humidity', '/wind/api/device/' + id + '/humidity/{timestamp}'),
+            Link('aggregate', '/wind/api/device/' + id + '/humidities/aggregate'),
+            Link('export', '/wind/api/device/' + id + '/humidities/export')
+        ]
 
-        if not directions_db:
-            return create_error_response(404, "No directions found",
-                                     'There is no directions data on given device id %s' % id, 'Diretions')
+        return series_response(g.con.get_humidities, 'humidity', id, links,
+                               ("No humidities found", 'There is no humidities data on given device id %s' % id, 'Humidities'))
+
+
+class Aggregate(Resource):
+    '''
+    Implements resource aggregate: values of a device collection reduced
+    to min/max/mean... per time bucket
+    '''
+
+    def get(self, id, quantity):
+        '''
+        QUERY PARAMETERS:
+         * bucket: width of the bucket, number of seconds optionally followed
+           by unit s, m, h or d (e.g. 10m, 1h). Default 1h
+         * fn: comma separated aggregate functions (mean, min, max, count, sum, variance).
+           Default mean,min,max
+         * start, end: time range as in the collections
+
+        OUTPUT:
+         * Returns 200 with the buckets in items
+         * Returns 400 if a query parameter is malformed or is one of the pages
+           of the collection (limit, points, stream, format, delta)
+         * Returns 404 if the collection is unknown or there are no values
+        '''
+
+        if quantity not in COLLECTIONS:
+            return create_error_response(404, "Unknown collection",
+                                         'There is no collection %s on devices' % quantity, 'Aggregate')
+
+        match = re.match(r'^(\d+)([smhd]?)$', request.args.get('bucket', '1h'))
+        if match is None:
+            return create_error_response(400, "Malformed query parameter",
+                                         "Query parameter bucket must be e.g. 600, 10m, 1h or 1d", 'Aggregate')
+        bucket = int(match.group(1)) * BUCKET_UNITS[match.group(2)]
+        functions = [f for f in request.args.get('fn', 'mean,min,max').split(',') if f]
+        for name in PAGE_ARGUMENTS:
+            if name in request.args:
+                return create_error_response(400, "Malformed query parameter",
+                                             "Query parameter %s does not apply to aggregates" % name, 'Aggregate')
+        start = get_integer_argument('start')
+        end = get_integer_argument('end')
+
+        validators = get_validators(id)
+        not_modified = not_modified_response(validators)
+        if not_modified is not None:
+            return not_modified
+
+        try:
+            aggregates_db = g.con.get_aggregates(id, COLLECTIONS[quantity], bucket, functions, start, end)
+        except ValueError as e:
+            return create_error_response(400, "Malformed query parameter", str(e), 'Aggregate')
+
+        if not aggregates_db:
+            return create_error_response(404, "No %s found" % quantity,
+                                         'There is no %s data on given device id %s' % (quantity, id), 'Aggregate')
 
         # create collection of links
         links = Collection(
             Self(),
             Link('device', '/wind/api/device/' + id + '/'),
-            Link('direction', '/wind/api/device/' + id + '/direction/{timestamp}')
+            Link('list', '/wind/api/device/' + id + '/' + quantity + '/')
         )
 
-        # links to dict
-        l = links.to_dict()
-
-        # combine links and speed to one dict
-        dump = l
-        dump.update({'items': directions_db})
+        # combine links and buckets to one dict
+        dump = links.to_dict()
+        dump.update({'bucket': bucket, 'functions': functions, 'items': aggregates_db})
 
         # return Response
-        return Response(json.dumps(dump), 200, mimetype=JSONHAL)
+        return set_validators(Response(dump_json(dump), 200, mimetype=JSONHAL), validators)
 
 
-class Temperatures(Resource):
+class Series(Resource):
+    '''
+    Implements resource series: several quantities of a device read
+    together in one query
+    '''
+
     def get(self, id):
-        temperatures_db = g.con.get_temperatures(id)
+        '''
+        QUERY PARAMETERS:
+         * fields: comma separated quantities (e.g. speed,temperature).
+           Default speed,battery,direction,temperature,humidity
+         * start, end, limit, points, format, delta: as in the collections.
+           With points the rows with the smallest and the largest value of
+           every field are kept, see dbhandler.Connection.get_decimated_fields
+
+        OUTPUT:
+         * Returns 200 with the items, or the columns with format=columns
+         * Returns 400 if a query parameter is malformed
+         * Returns 404 if there are no values
+        '''
+
+        fields = request.args.get('fields', ','.join(COLLECTIONS.values())).split(',')
+        #without empty and repeated names
+        fields = [f for i, f in enumerate(fields) if f and f not in fields[:i]]
+        args = get_series_arguments()
+        vary_on_accept()
+        unknown = [f for f in fields if f not in dbhandler.QUANTITIES]
+        if not fields:
+            return create_error_response(400, "Malformed query parameter",
+                                         "Query parameter fields must name at least one quantity", 'Series')
+        if unknown:
+            return create_error_response(400, "Malformed query parameter",
+                                         "Unknown fields: %s" % ','.join(unknown), 'Series')
+        if args['points'] is not None and args['points'] < 2 * len(fields):
+            return create_error_response(400, "Malformed query parameter",
+                                         "Query parameter points must be at least 2 per field", 'Series')
+
+        validators = get_validators(id, args['representation'])
+        not_modified = not_modified_response(validators)
+        if not_modified is not None:
+            return not_modified
+
+        # create collection of links
+        links = [
+            Self(),
+            Link('device', '/wind/api/device/' + id + '/')
+        ]
+        not_found = ("No values found", 'There is no data on given device id %s' % id, 'Series')
+        if args['columns']:
+            return columns_series_response(fields, id, args, links, not_found, validators)
+
+        limit = args['limit']
+        page_links = []
+        if args['points'] is not None:
+            items = g.con.get_decimated_fields(id, fields, args['points'], args['start'], args['end'])
+        else:
+            items = g.con.get_series_fields(id, fields, args['start'], args['end'],
+                                            None if limit is None else limit + 1)
+            has_next = limit is not None and len(items) > limit
+            if has_next:
+                items = items[:limit]
+            if items:
+                page_links = get_page_links(id, args, items[0]['timestamp'], items[-1]['timestamp'], has_next)
+        if not items:
+            return create_error_response(404, *not_found)
+
+        dump = Collection(*(links + page_links)).to_dict()
+        dump.update({'fields': fields, 'items': items})
+        return set_validators(Response(dump_json(dump), 200, mimetype=JSONHAL), validators)
+
+
+class Export(Resource):
+    '''
+    Implements resource export: the values of a device collection as
+    binary NumPy files for analysis
+    '''
+
+    def get(self, id, quantity):
+        '''
+        QUERY PARAMETERS:
+         * format: npz (default) for a .npz file with the arrays date (int64)
+           and <quantity> (float64), npy for a .npy file of a structured
+           array with the fields date and <quantity>
+         * start, end: time range as in the collections
+
+        Missing and deleted values are NaN.
+
+        OUTPUT:
+         * Returns 200 with the file
+         * Returns 400 if a query parameter is malformed
+         * Returns 404 if the collection is unknown or there are no values
+        '''
+
+        if quantity not in COLLECTIONS:
+            return create_error_response(404, "Unknown collection",
+                                         'There is no collection %s on devices' % quantity, 'Export')
+        args = get_series_arguments(('npz', 'npy'))
+
+        validators = get_validators(id, args['format'])
+        not_modified = not_modified_response(validators)
+        if not_modified is not None:
+            return not_modified
+
+        name = COLLECTIONS[quantity]
+        dates, values = g.con.get_series_arrays(id, name, args['start'], args['end'])
+        if not dates:
+            return create_error_response(404, "No %s found" % quantity,
+                                         'There is no %s data on given device id %s' % (quantity, id), 'Export')
+
+        columns = [('date', dates), (name, values)]
+        with metrics.phase('serialize'):
+            if args['format'] == 'npz':
+                response = Response(export.to_npz(columns), 200, mimetype=export.NPZ)
+            else:
+                response = Response(export.to_npy_records(columns), 200, mimetype=export.NPY)
+        response.headers['Content-Disposition'] = 'attachment; filename=device-%s-%s.%s' % (id, quantity, args['format'])
+        return set_validators(response, validators)
 
-        if not temperatures_db:
-            return create_error_response(404, "No temperatures found",
-                                         'There is no temperatures data on given device id %s' % id, 'Temperatures')
+
+class Data(Resource):
+    '''
+    Implements resource data: bulk ingest of full rows of station readings
+    and batches of temperature/humidity edits
+    '''
+
+    def post(self, id):
+        '''
+        Inserts or replaces a batch of readings of the device in one transaction.
+
+        REQUEST ENTITY BODY:
+         * Media type: JSON (an array of readings) or NDJSON (one reading per line)
+         * A reading is an object with timestamp and any of the values
+           speed, direction, battery, temperature, humidity, pressure,
+           std_speed, vertical_velocity, std_vertical_velocity and quality.
+           Missing values are stored as null, an existing reading with the
+           same timestamp is replaced.
+
+        RESPONSE STATUS CODE:
+         * Returns 200 and the number of readings written
+         * Returns 400 if a reading is malformed, nothing is written then
+         * Returns 404 if there is no device with given id
+         * Returns 415 if the format of the request is not JSON or NDJSON
+        '''
+
+        if not g.con.get_device(id):
+            return create_error_response(404, "No device found",
+                                         'There is no device info on given device id %s' % id, 'Data')
+
+        content_type = request.headers.get("Content-Type", "").split(";")[0].strip()
+        if content_type == NDJSON:
+            #parsed line by line while the rows are written
+            rows = (json.loads(line) for line in request.stream if line.strip())
+        elif content_type == JSON:
+            rows = request.get_json(force=True, silent=True)
+            if not isinstance(rows, list):
+                return create_error_response(400, "Wrong request format", "Send an array of readings", 'Data')
+        else:
+            return create_error_response(415, "UnsupportedMediaType", "Use JSON or NDJSON format", 'Data')
+
+        try:
+            count = g.con.bulk_insert(id, rows)
+        except ValueError as e:
+            return create_error_response(400, "Wrong request format", str(e), 'Data')
 
         # create collection of links
         links = Collection(
             Self(),
-            Link('device', '/wind/api/device/' + id + '/'),
-            Link('temperature', '/wind/api/device/' + id + '/temperature/{timestamp}')
+            Link('device', '/wind/api/device/' + id + '/')
         )
 
-        # links to dict
-        l = links.to_dict()
-
-        # combine links and speed to one dict
-        dump = l
-        dump.update({'items': temperatures_db})
+        dump = links.to_dict()
+        dump.update({'count': count})
+        return Response(dump_json(dump), 200, mimetype=JSONHAL)
 
-        # return Response
-        return Response(json.dumps(dump), 200, mimetype=JSONHAL)
+    def patch(self, id):
+        '''
+        Modifies, adds or deletes many temperature and humidity values of
+        the device in one transaction.
 
+        REQUEST ENTITY BODY:
+         * Media type: JSON
+         * An array of operations {"timestamp": 12, "field": "temperature", "value": 104}.
+           field is temperature or humidity, value null deletes the value.
 
-class Humidities(Resource):
-    def get(self, id):
-        humidities_db = g.con.get_humidities(id)
+        RESPONSE STATUS CODE:
+         * Returns 200 and the status of each operation in items, in the
+           order of the request: 204 modified or deleted, 201 added,
+           400 malformed operation (skipped), 404 no value to delete
+         * Returns 400 if the body is not an array
+         * Returns 404 if there is no device with given id
+         * Returns 415 if the format of the request is not JSON
+         * Returns 500 if the database cannot be modified, nothing is written then
+        '''
 
-        if not humidities_db:
-            return create_error_response(404, "No humidities found",
-                                     'There is no humidities data on given device id %s' % id, 'Humidities')
+        if not g.con.get_device(id):
+            return create_error_response(404, "No device found",
+                                         'There is no device info on given device id %s' % id, 'Data')
+        if JSON != request.headers.get("Content-Type", "").split(";")[0].strip():
+            return create_error_response(415, "UnsupportedMediaType", "Use a JSON compatible format", 'Data')
+        operations = request.get_json(force=True, silent=True)
+        if not isinstance(operations, list):
+            return create_error_response(400, "Wrong request format", "Send an array of operations", 'Data')
+
+        statuses = g.con.batch_modify(id, operations)
+        if statuses is None:
+            return create_error_response(500, "Internal error", "The values cannot be updated", 'Data')
+
+        items = []
+        for operation, status in zip(operations, statuses):
+            item = {'status': status}
+            if isinstance(operation, dict):
+                item.update((k, operation[k]) for k in ('timestamp', 'field') if k in operation)
+            items.append(item)
 
         # create collection of links
         links = Collection(
             Self(),
-            Link('device', '/wind/api/device/' + id + '/'),
-            Link('humidity', '/wind/api/device/' + id + '/humidity/{timestamp}')
+            Link('device', '/wind/api/device/' + id + '/')
         )
 
-        # links to dict
-        l = links.to_dict()
+        dump = links.to_dict()
+        dump.update({'items': items})
+        return Response(dump_json(dump), 200, mimetype=JSONHAL)
 
-        # combine links and speed to one dict
-        dump = l
-        dump.update({'items': humidities_db})
 
-        # return Response
-        return Response(json.dumps(dump), 200, mimetype=JSONHAL)
+class RequestMetrics(Resource):
+    '''
+    Implements resource metrics: latency of the routes and timings of the
+    SQL statements of this server process. Only served in admin mode
+    (METRICS_ENDPOINT), otherwise the resource does not exist.
+    '''
+
+    def dispatch_request(self, *args, **kwargs):
+        if not app.config["METRICS_ENDPOINT"]:
+            return create_error_response(404, "Resource not found", "This resource url does not exist!!!!")
+        return super(RequestMetrics, self).dispatch_request(*args, **kwargs)
+
+    def get(self):
+        '''
+        QUERY PARAMETERS:
+         * queries: number of statements listed, the ones that took the longest
+           in total first. Default 50
+
+        OUTPUT:
+         * Returns 200 with the routes (latency, database and serialization
+           time histograms in ms), the statements, the slow statements if the
+           slow query log is on and the cache and pool statistics
+         * Returns 400 if queries is not an integer
+        '''
+        try:
+            queries = int(request.args.get('queries', 50))
+        except ValueError:
+            return create_error_response(400, "Malformed query parameter",
+                                         "Query parameter queries must be an integer", 'Metrics')
+        engine = app.config["Engine"]
+        dump = Collection(Self(), Link('cache', '/wind/api/_cache')).to_dict()
+        dump.update(app.config["METRICS"].stats(max(queries, 0)))
+        dump.update({'response_cache': app.config["RESPONSE_CACHE"].stats(),
+                     'compressed_cache': app.config["COMPRESSED_CACHE"].stats(),
+                     'pool': {'size': engine.pool.size, 'idle': engine.pool.idle_count()}})
+        if engine.read_pool is not None:
+            dump['read_pool'] = {'size': engine.read_pool.size, 'idle': engine.read_pool.idle_count()}
+        if engine.slow_queries is not None:
+            dump['slow_queries'] = engine.slow_queries.stats()[:max(queries, 0)]
+        return Response(dump_json(dump), 200, mimetype=JSONHAL)
+
+    def delete(self):
+        '''
+        Starts counting again.
+        '''
+        app.config["METRICS"].reset()
+        if app.config["Engine"].slow_queries is not None:
+            app.config["Engine"].slow_queries.clear()
+        return Response("", 204, mimetype=JSONHAL)
+
+
+class CacheStatistics(Resource):
+    '''
+    Implements resource cache statistics: hits and misses of the response cache
+    '''
+
+    def get(self):
+        dump = Collection(Self()).to_dict()
+        dump.update(app.config["RESPONSE_CACHE"].stats())
+        return Response(dump_json(dump), 200, mimetype=JSONHAL)
 
 
 class Humidity(Resource):
@@ -393,7 +1085,7 @@ class Humidity(Resource):
         dump = dict(list(l.items()) + list(humidity_db.items()))
 
         #return Response
-        return Response(json.dumps(dump), 200, mimetype=JSONHAL)
+        return Response(dump_json(dump), 200, mimetype=JSONHAL)
 
     #modifies the humidity value with @ timestamp
     def put(self, id, timestamp):
@@ -506,7 +1198,7 @@ class Temperature(Resource):
         dump = dict(list(l.items()) + list(temperature_db.items()))
 
         #return Response
-        return Response(json.dumps(dump), 200, mimetype=JSONHAL)
+        return Response(dump_json(dump), 200, mimetype=JSONHAL)
 
     #edit old value
     def put(self, id, timestamp):
@@ -607,7 +1299,7 @@ def create_error_response(status_code, title, message, resource_type=None):
 
     # Muotoillaan errorin palautus ja pistellään responsensa
     dump = {"resource_url": resource_url, "resource_type": resource_type, "message": title, "info": message}
-    return Response(json.dumps(dump), status_code, mimetype=JSONHAL)
+    return Response(dump_json(dump), status_code, mimetype=JSONHAL)
 
 
 @app.errorhandler(404)
@@ -622,28 +1314,211 @@ def resource_not_found(error):
 def unknown_error(error):
     return create_error_response(500, "Error", "The system has failed. Please, contact the administrator")
 
+@app.errorhandler(dbhandler.PoolTimeoutError)
+def database_busy(error):
+    return create_error_response(503, "Service unavailable", "All database connections are busy. Please, try again later")
+
+@app.before_request
+def start_profiler():
+    """
+    Runs the request under a profiler when PROFILING is on and the request
+    asks for it with the X-Profile header or the _profile query parameter:
+    sample (also 1, true or yes) or cprofile. Without PROFILING they are ignored.
+    """
+
+    mode = request.headers.get("X-Profile") or request.args.get("_profile")
+    if not app.config["PROFILING"] or not mode:
+        return None
+    mode = "sample" if mode.lower() in ("1", "true", "yes") else mode.lower()
+    if mode not in profiler.MODES:
+        return create_error_response(400, "Malformed profiler", "The profiler must be one of " + ", ".join(profiler.MODES))
+
+    g.profiler = profiler.create_profiler(mode, app.config["PROFILE_INTERVAL"])
+    g.profile_path = profiler.get_profile_path(app.config["PROFILE_DIR"],
+                                               "%s %s" % (request.method, request.endpoint or "unknown"), g.profiler)
+    g.profiler.start()
+
+@app.before_request
+def start_request_timer():
+    """
+    Starts measuring the request, see :py:func:`record_request`.
+    """
+
+    g.timer = app.config["METRICS"].start_request()
+
 @app.before_request
 def connect_db():
     """
-    Creates a database connection before the request is proccessed.
+    Borrows a database connection from the Engine pool before the request is proccessed.
+    The GET requests get a read only connection if the Engine has a read pool.
 
     The connection is stored in the application context variable flask.g .
     Hence it is accessible from the request object.
     """
 
-    g.con = app.config["Engine"].connect()
+    with metrics.phase('pool'):
+        g.con = app.config["Engine"].acquire(app.config["POOL_TIMEOUT"],
+                                             read_only=request.method in ("GET", "HEAD", "OPTIONS"))
+
+@app.before_request
+def serve_cached_response():
+    """
+    Answers GET requests of the cached endpoints from the response cache.
+    A cached response is only used while the data version of the device is
+    the one it was built from. On a miss the key is left in flask.g for
+    :py:func:`store_cached_response`.
+    """
+
+    if request.method != "GET" or request.endpoint not in CACHED_ENDPOINTS or "stream" in request.args:
+        return None
+    #a profiled request does the work
+    if "profiler" in g:
+        return None
+
+    id = (request.view_args or {}).get("id")
+    version = get_data_version(id)[0] if id is not None else None
+    #the path holds all the url parameters (e.g. the quantity), wants_columns the Accept header
+    key = (request.path, tuple(sorted(request.args.items(multi=True))), wants_columns())
+    cached = app.config["RESPONSE_CACHE"].get(key, version)
+    g.timer.cache = "miss" if cached is None else "hit"
+    if cached is None:
+        g.cache_entry = (key, id, version)
+        return None
+
+    body, status, headers = cached
+    response = Response(body, status, headers=headers)
+    #304 if the client has the same version
+    return response.make_conditional(request)
+
+def compress_body(body, encoding):
+    '''
+    :param body: bytes to compress
+    :param encoding: "br" or "gzip"
+    :return: the compressed bytes
+    '''
+    level = app.config["COMPRESSION_LEVEL"]
+    if encoding == "br":
+        return brotli.compress(body, quality=min(level, 11))
+    return gzip.compress(body, compresslevel=level, mtime=0)
+
+#registered first so it runs last
+@app.after_request
+def add_profile_path(response):
+    """
+    Tells where the profile of a profiled request is written, once it has been sent.
+    """
+
+    if "profile_path" in g:
+        response.headers["X-Profile"] = os.path.abspath(g.profile_path)
+    return response
+
+#registered before compress_response so it runs after it and the compression is included
+@app.after_request
+def add_server_timing(response):
+    """
+    Sends the time spent so far in each phase of the request in the
+    Server-Timing header. The body of a streamed response is sent later.
+    """
+
+    g.status = response.status_code
+    if app.config["SERVER_TIMING"] and "timer" in g:
+        response.headers["Server-Timing"] = g.timer.server_timing()
+    return response
+
+#registered before store_cached_response so it runs after it and the
+#response cache keeps the uncompressed bodies
+@app.after_request
+def compress_response(response):
+    """
+    Compresses the response body with the best encoding accepted by the
+    client (Accept-Encoding). Streamed responses, bodies under
+    COMPRESSION_MIN_SIZE and responses that are not text are sent as they are.
+    The compressed bodies are cached by the digest of the body, so a
+    response served again is not compressed again.
+    """
+
+    if response.mimetype not in COMPRESSED_TYPES:
+        return response
+    response.vary.add("Accept-Encoding")
+    if response.status_code != 200 or response.is_streamed or response.direct_passthrough \
+            or "Content-Encoding" in response.headers:
+        return response
+
+    encoding = request.accept_encodings.best_match(ENCODINGS)
+    if encoding is None:
+        return response
+    body = response.get_data()
+    if len(body) < app.config["COMPRESSION_MIN_SIZE"]:
+        return response
+
+    compressed_cache = app.config["COMPRESSED_CACHE"]
+    key = (encoding, hashlib.sha1(body).digest())
+    cached = compressed_cache.get(key)
+    if cached is None:
+        compressed = compress_body(body, encoding)
+        compressed_cache.put(key, None, None, compressed, 200, [])
+    else:
+        compressed = cached[0]
+    response.set_data(compressed)
+    response.headers["Content-Encoding"] = encoding
+    return response
+
+@app.after_request
+def store_cached_response(response):
+    """
+    Stores the complete 200 responses of cache misses, and drops the cached
+    responses of a device when one of its values was changed.
+    """
+
+    response_cache = app.config["RESPONSE_CACHE"]
+    if "cache_entry" in g and response.status_code == 200 and not response.is_streamed:
+        key, id, version = g.cache_entry
+        headers = [(name, response.headers[name]) for name in CACHED_HEADERS if name in response.headers]
+        response_cache.put(key, id, version, response.get_data(), response.status_code, headers)
+    elif request.method in ("PUT", "POST", "DELETE", "PATCH") and response.status_code < 400:
+        id = (request.view_args or {}).get("id")
+        if id is not None:
+            response_cache.invalidate_device(id)
+    return response
 
 # HOOKS
+@app.teardown_request
+def dump_profile(exc):
+    """
+    Writes the profile of a profiled request. A streamed response is
+    profiled until its body has been sent.
+    """
+
+    if "profiler" in g:
+        g.profiler.stop()
+        try:
+            g.profiler.dump(g.profile_path)
+        except OSError as e:
+            print("Error %s:" % e)
+
+@app.teardown_request
+def record_request(exc):
+    """
+    Records the latency of the request in the metrics of its route. A
+    streamed response is recorded when its body has been sent.
+    """
+
+    if "timer" in g:
+        status = 500 if exc is not None else g.get("status", 500)
+        app.config["METRICS"].end_request("%s %s" % (request.method, request.endpoint or "unknown"), status)
+
 @app.teardown_request
 def close_connection(exc):
     """
-    Closes the database connection
+    Gives the database connection back to the pool, commiting the changes
+    unless the request failed.
     Check if the connection is created. It might be exception appear before
     the connection is created.
     """
 
     if hasattr(g, "con"):
-        g.con.close()
+        app.config["Engine"].release(g.con, commit=exc is None)
+        del g.con
 
 
 # routes for resources
@@ -655,6 +1530,12 @@ api.add_resource(Temperatures, '/wind/api/device/<id>/temperatures/', endpoint='
 api.add_resource(Directions, '/wind/api/device/<id>/directions/', endpoint='directions')
 api.add_resource(Humidities, '/wind/api/device/<id>/humidities/', endpoint='humidities')
 api.add_resource(Devices, '/wind/api/devices/', endpoint='devices')
+api.add_resource(Aggregate, '/wind/api/device/<id>/<quantity>/aggregate', endpoint='aggregate')
+api.add_resource(Export, '/wind/api/device/<id>/<quantity>/export', endpoint='export')
+api.add_resource(Series, '/wind/api/device/<id>/series', endpoint='series')
+api.add_resource(Data, '/wind/api/device/<id>/data/', endpoint='data')
+api.add_resource(CacheStatistics, '/wind/api/_cache', endpoint='cache')
+api.add_resource(RequestMetrics, '/wind/api/_metrics', endpoint='metrics')
 
 
 api.add_resource(Speed, '/wind/api/device/<id>/speed/<timestamp>', endpoint='speed')
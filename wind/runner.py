@@ -0,0 +1,269 @@
+# Production runner of the wind API: pre-forked worker processes
+#
+# In the project wind folder (Linux/macOS):
+#
+#   python runner.py --workers 4 --port 5000
+#
+# Signals to the master process:
+#   SIGHUP          replace the workers one by one (graceful reload). The
+#                   master never imports the API, so the new workers load
+#                   the current code and config of resourcess.py
+#   SIGTERM/SIGINT  stop the workers after their current requests and exit
+
+import argparse, logging, os, random, signal, socket, sys, threading, time, traceback
+
+from werkzeug.serving import make_server, WSGIRequestHandler
+
+# Defaults of the command line options
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 5000
+DEFAULT_MAX_REQUESTS = 10000
+DEFAULT_MAX_REQUESTS_JITTER = 1000
+# Seconds a stopping worker gets to finish its requests before it is killed
+DEFAULT_GRACEFUL_TIMEOUT = 30
+# Seconds an idle keep-alive connection is kept open by a worker
+KEEPALIVE_TIMEOUT = 10
+# Read only database connections of a worker for the GET requests
+DEFAULT_READ_CONNECTIONS = 8
+
+
+class RequestHandler(WSGIRequestHandler):
+    #idle connections are closed, so a stopping worker does not wait for them
+    timeout = KEEPALIVE_TIMEOUT
+
+
+class Worker(object):
+    '''
+    One worker process. It serves the API from the socket of the master
+    with its own Engine and connection pools, which are created after the
+    fork so no database handle is shared between processes. The GET
+    requests are served from a pool of read only connections, the writes
+    from the pool of the Engine. The API is imported by the worker, after
+    the fork. The worker exits after max_requests requests and the master
+    starts a new one.
+
+    :param sock: listening socket created by the master
+    :param options: parsed command line options
+    '''
+
+    def __init__(self, sock, options):
+        super(Worker, self).__init__()
+        self.sock = sock
+        self.options = options
+        self.requests = 0
+        jitter = random.randint(0, options.max_requests_jitter) if options.max_requests_jitter else 0
+        #spread the restarts of the workers
+        self.max_requests = options.max_requests + jitter if options.max_requests else None
+        self.server = None
+        self._lock = threading.Lock()
+
+    def run(self):
+        signal.signal(signal.SIGTERM, lambda signum, frame: self.stop())
+        #the master stops the workers, Ctrl+C in the terminal only reaches it
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGHUP, signal.SIG_DFL)
+
+        import resourcess
+        app = resourcess.app
+        app.debug = False
+        slow_query_threshold = self.options.slow_query_ms / 1000.0 if self.options.slow_query_ms else None
+        app.config["Engine"] = resourcess.create_engine(self.options.db, slow_query_threshold,
+                                                        read_pool_size=self.options.read_connections)
+        if self.options.profile_dir:
+            app.config.update({"PROFILING": True, "PROFILE_DIR": self.options.profile_dir})
+        if self.options.metrics:
+            app.config["METRICS_ENDPOINT"] = True
+        self.server = make_server(self.options.host, self.options.port, self.count_requests(app),
+                                  threaded=True, request_handler=RequestHandler, fd=self.sock.fileno())
+        #server_close waits for the requests being served
+        self.server.daemon_threads = False
+        self.server.block_on_close = True
+        try:
+            self.server.serve_forever()
+        finally:
+            self.server.server_close()
+            app.config["Engine"].dispose()
+
+    def count_requests(self, app):
+        '''
+        :return: WSGI app that stops the worker after max_requests requests
+        '''
+        def counting_app(environ, start_response):
+            with self._lock:
+                self.requests += 1
+                recycle = self.max_requests is not None and self.requests == self.max_requests
+            if recycle:
+                self.stop()
+            return app(environ, start_response)
+        return counting_app
+
+    def stop(self):
+        '''
+        Stops accepting requests. The requests being served are finished.
+        '''
+        if self.server is None:
+            #not serving yet, nothing to finish
+            os._exit(0)
+        #shutdown waits for serve_forever, so it can not run in the serving thread
+        threading.Thread(target=self.server.shutdown).start()
+
+
+class Master(object):
+    '''
+    Opens the listening socket and keeps options.workers worker processes
+    running. Dead or recycled workers are replaced.
+
+    :param options: parsed command line options
+    '''
+
+    def __init__(self, options):
+        super(Master, self).__init__()
+        self.options = options
+        self.sock = None
+        #pid -> time it was started
+        self.workers = {}
+        self.running = True
+        self.reload = False
+
+    def run(self):
+        self.migrate()
+
+        self.sock = socket.create_server((self.options.host, self.options.port), backlog=2048)
+        self.sock.set_inheritable(True)
+        print("Serving on http://%s:%d with %d workers (master pid %d)" % (
+            self.options.host, self.options.port, self.options.workers, os.getpid()))
+
+        signal.signal(signal.SIGHUP, self.handle_reload)
+        signal.signal(signal.SIGTERM, self.handle_stop)
+        signal.signal(signal.SIGINT, self.handle_stop)
+
+        while self.running:
+            self.reap_workers()
+            if self.reload:
+                self.reload = False
+                self.reload_workers()
+            while self.running and len(self.workers) < self.options.workers:
+                self.spawn_worker()
+            time.sleep(0.2)
+
+        self.stop_workers(list(self.workers))
+        self.sock.close()
+
+    def fork(self, function):
+        '''
+        Runs function in a child process.
+
+        :return: pid of the child
+        '''
+        pid = os.fork()
+        if pid == 0:
+            status = 0
+            try:
+                function()
+            except BaseException:
+                traceback.print_exc()
+                status = 1
+            finally:
+                #never return into the loop of the master
+                os._exit(status)
+        return pid
+
+    def migrate(self):
+        '''
+        Upgrades the database once, before the workers open it. The upgrade
+        runs in a child process so the master does not import the API.
+        '''
+        def migrate():
+            import dbhandler
+            dbhandler.Engine(self.options.db).migrate()
+
+        pid = self.fork(migrate)
+        if os.waitpid(pid, 0)[1] != 0:
+            sys.exit("The database could not be upgraded")
+
+    def spawn_worker(self):
+        pid = self.fork(Worker(self.sock, self.options).run)
+        self.workers[pid] = time.time()
+        return pid
+
+    def reap_workers(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            self.workers.pop(pid, None)
+
+    def reload_workers(self):
+        '''
+        Replaces the workers one at a time: a new worker is started before
+        an old one is stopped, so there are always workers serving. The new
+        workers import the current code, the database is upgraded first if
+        the code has new migrations.
+        '''
+        self.migrate()
+        for pid in list(self.workers):
+            self.spawn_worker()
+            self.stop_workers([pid])
+
+    def stop_workers(self, pids):
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        deadline = time.time() + self.options.graceful_timeout
+        for pid in pids:
+            while pid in self.workers and time.time() < deadline:
+                self.reap_workers()
+                time.sleep(0.05)
+            if pid in self.workers:
+                os.kill(pid, signal.SIGKILL)
+                os.waitpid(pid, 0)
+                self.workers.pop(pid, None)
+
+    def handle_reload(self, signum, frame):
+        self.reload = True
+
+    def handle_stop(self, signum, frame):
+        self.running = False
+
+
+def parse_options(args=None):
+    parser = argparse.ArgumentParser(description="Runs the wind API in pre-forked worker processes")
+    parser.add_argument('--host', default=DEFAULT_HOST)
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help="number of worker processes, default the number of CPUs")
+    parser.add_argument('--max-requests', type=int, default=DEFAULT_MAX_REQUESTS,
+                        help="requests after which a worker is replaced, 0 for never")
+    parser.add_argument('--max-requests-jitter', type=int, default=DEFAULT_MAX_REQUESTS_JITTER,
+                        help="random extra requests per worker, so they are not replaced at the same time")
+    parser.add_argument('--graceful-timeout', type=int, default=DEFAULT_GRACEFUL_TIMEOUT,
+                        help="seconds a stopping worker gets to finish its requests")
+    parser.add_argument('--db', default=None, help="path of the database file")
+    parser.add_argument('--read-connections', type=int, default=DEFAULT_READ_CONNECTIONS,
+                        help="read only database connections of a worker for the GET requests")
+    parser.add_argument('--slow-query-ms', type=float, default=None,
+                        help="log the statements slower than this with their query plan")
+    parser.add_argument('--profile-dir', default=None,
+                        help="admin mode: profile the requests that ask for it and write the profiles here")
+    parser.add_argument('--metrics', action='store_true',
+                        help="admin mode: serve the route and SQL statement metrics at /wind/api/_metrics")
+    options = parser.parse_args(args)
+    if options.workers < 1:
+        parser.error("--workers must be at least 1")
+    if options.read_connections < 1:
+        parser.error("--read-connections must be at least 1")
+    return options
+
+
+#run app
+if __name__ == '__main__':
+    if not hasattr(os, 'fork'):
+        sys.exit("The runner needs os.fork (Linux or macOS), use asgi.py or resourcess.py instead")
+    #the slow statements are logged as warnings
+    logging.basicConfig(format="%(asctime)s [%(process)d] %(name)s: %(message)s")
+    Master(parse_options()).run()